@@ -14,14 +14,21 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from offlineimap import mbnames, CustomConfig, OfflineImapError
+from offlineimap import mbnames, CustomConfig, OfflineImapError, \
+    controlsocket
 from offlineimap.repository import Repository
+from offlineimap.folder.Base import invert_idsizes
+from offlineimap.folder.Maildir import MaildirFolder
+from offlineimap.folderlease import FolderLeases
+from offlineimap.folderstats import FolderStats
 from offlineimap.ui import getglobalui
-from offlineimap.threadutil import InstanceLimitedThread
+from offlineimap.threadutil import InstanceLimitedThread, PriorityLane
 from subprocess import Popen, PIPE
-from threading import Event
+from threading import Condition, Event
 import os
+import re
 from sys import exc_info
+import time
 import traceback
 
 try:
@@ -53,6 +60,8 @@ class Account(CustomConfig.ConfigHelperMixin):
     abort_soon_signal = Event()
     #signal gets set on CTRL-C/SIGTERM
     abort_NOW_signal = Event()
+    #notified when sleeping accounts should check whether to wake up
+    wakeup = Condition()
 
     def __init__(self, config, name):
         """
@@ -70,6 +79,18 @@ class Account(CustomConfig.ConfigHelperMixin):
         self.refreshperiod = self.getconffloat('autorefresh', 0.0)
         # should we run in "dry-run" mode?
         self.dryrun = self.config.getboolean('general', 'dry-run')
+        self.leases = None
+        """:class:`FolderLeases` if several processes share this account"""
+        self.prioritylane = PriorityLane()
+        """Bulk transfers pause while priority folders are synced"""
+        self.folderstats = None
+        """:class:`FolderStats` if folders are scheduled individually"""
+        self.progress = controlsocket.SyncProgress()
+        self.paused = False
+        self.requestedfolders = set()
+        """Folders to sync in the next run instead of all of them"""
+        self.bulkimport = self.config.getdefaultboolean('general',
+                                                        'bulk-import', False)
         self.quicknum = 0
         if self.refreshperiod == 0.0:
             self.refreshperiod = None
@@ -116,6 +137,64 @@ class Account(CustomConfig.ConfigHelperMixin):
         elif signum == 3:
             # abort ASAP
             cls.abort_NOW_signal.set()
+        with cls.wakeup:
+            cls.wakeup.notifyAll()
+
+    def wake(self):
+        """Make this account skip its current or next sleep"""
+        with Account.wakeup:
+            self.config.set(self.getsection(), "skipsleep", '1')
+            Account.wakeup.notifyAll()
+
+    def requestfolder(self, foldername):
+        """Make this account wake up and sync only `foldername`
+
+        The folder may be given by its name on the remote side, or the
+        translated one."""
+        with Account.wakeup:
+            self.requestedfolders.add(foldername)
+            self.config.set(self.getsection(), "skipsleep", '1')
+            Account.wakeup.notifyAll()
+
+    def takerequestedfolders(self):
+        """Return and forget the folders requestfolder() asked for"""
+        with Account.wakeup:
+            requested, self.requestedfolders = self.requestedfolders, set()
+        return requested
+
+    def pause(self):
+        """Stop syncing after the current message until resume()"""
+        with Account.wakeup:
+            self.paused = True
+
+    def resume(self):
+        with Account.wakeup:
+            self.paused = False
+            Account.wakeup.notifyAll()
+
+    def waitwhilepaused(self):
+        """Block while the account is paused, unless we abort"""
+        with Account.wakeup:
+            while self.paused and not Account.abort_NOW_signal.is_set():
+                # with a timeout, signals still reach the main thread
+                Account.wakeup.wait(60)
+
+    def waitforwakeup(self, timeout):
+        """Sleep up to `timeout` seconds, or until get_abort_event()
+
+        Sleeping accounts wait on the process wide :attr:`wakeup`
+        condition, which set_abort_event() and wake() notify, so they
+        wake up right away instead of polling.
+
+        :returns: True if get_abort_event() ended the sleep"""
+        end = time.time() + timeout
+        with Account.wakeup:
+            while not self.get_abort_event():
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                Account.wakeup.wait(remaining)
+            return True
 
     def get_abort_event(self):
         """Checks if an abort signal had been sent
@@ -154,7 +233,11 @@ class Account(CustomConfig.ConfigHelperMixin):
             item.startkeepalive()
 
         refreshperiod = int(self.refreshperiod * 60)
+        self.progress.setstate('sleeping', time.time() + refreshperiod)
         sleepresult = self.ui.sleep(refreshperiod, self)
+        if self.paused:
+            self.progress.setstate('paused')
+            self.waitwhilepaused()
 
         # Cancel keepalive
         for item in kaobjs:
@@ -192,10 +275,15 @@ class SyncableAccount(Account):
                                           "%s.lock" % self)
 
     def lock(self):
-        """Lock the account, throwing an exception if it is locked already"""
-        self._lockfd = open(self._lockfilepath, 'w')
+        """Lock the account, throwing an exception if it is locked already
+
+        With folder leases, several processes can hold a shared lock,
+        which still keeps out processes that want an exclusive one."""
+        shared = self.leases is not None
+        self._lockfd = open(self._lockfilepath, 'a+' if shared else 'w')
         try:
-            fcntl.lockf(self._lockfd, fcntl.LOCK_EX|fcntl.LOCK_NB)
+            fcntl.lockf(self._lockfd, (fcntl.LOCK_SH if shared else
+                                        fcntl.LOCK_EX) | fcntl.LOCK_NB)
         except NameError:
             #fcntl not available (Windows), disable file locking... :(
             pass
@@ -210,6 +298,8 @@ class SyncableAccount(Account):
         #If we own the lock file, delete it
         if self._lockfd and not self._lockfd.closed:
             self._lockfd.close()
+            if self.leases is not None:
+                return # other processes might still share it
             try:
                 os.unlink(self._lockfilepath)
             except OSError:
@@ -217,6 +307,7 @@ class SyncableAccount(Account):
 
     def syncrunner(self):
         self.ui.registerthread(self)
+        controlsocket.accounts[self.name] = self
         try:
             accountmetadata = self.getaccountmeta()
             if not os.path.exists(accountmetadata):
@@ -225,6 +316,18 @@ class SyncableAccount(Account):
             self.remoterepos = Repository(self, 'remote')
             self.localrepos  = Repository(self, 'local')
             self.statusrepos = Repository(self, 'status')
+            if self.getconfboolean('folder-leases', False):
+                self.leases = FolderLeases(
+                    os.path.join(accountmetadata, 'leases'),
+                    self.getconfint('folder-lease-duration', 300))
+            refresh = None
+            if self.config.has_option(self.getsection(), 'folder-refresh'):
+                refresh = self.localeval.eval(self.getconf('folder-refresh'),
+                                              {'re': re})
+            if refresh is not None or \
+                    self.getconfboolean('schedule-folders', False):
+                self.folderstats = FolderStats(
+                    os.path.join(accountmetadata, 'folderstats'), refresh)
         except OfflineImapError as e:
             self.ui.error(e, exc_info()[2])
             if e.severity >= OfflineImapError.ERROR.CRITICAL:
@@ -260,6 +363,7 @@ class SyncableAccount(Account):
                 self.unlock()
                 if looping and self.sleeper() >= 2:
                     looping = 0
+        self.progress.setstate('done')
 
     def get_local_folder(self, remotefolder):
         """Return the corresponding local folder for a given remotefolder"""
@@ -275,6 +379,7 @@ class SyncableAccount(Account):
         be called from the :meth:`syncrunner` function.
         """
         folderthreads = []
+        self.progress.setstate('syncing')
 
         hook = self.getconf('presynchook', '')
         self.callhook(hook)
@@ -291,27 +396,53 @@ class SyncableAccount(Account):
                 quick = True
         else:
             quick = False
+        # Copy at most 'window' messages per folder in the first round
+        window = self.getconfint('progressive-sync', 0)
 
         try:
             remoterepos = self.remoterepos
             localrepos = self.localrepos
             statusrepos = self.statusrepos
 
+            remoterepos.prewarm()
+            localrepos.prewarm()
             # init repos with list of folders, so we have them (and the
             # folder delimiter etc)
             remoterepos.getfolders()
             localrepos.getfolders()
 
-            remoterepos.sync_folder_structure(localrepos, statusrepos)
-            # replicate the folderstructure between REMOTE to LOCAL
-            if not localrepos.getconfboolean('readonly', False):
-                self.ui.syncfolders(remoterepos, localrepos)
-
-            # try to short circuit moves
-            localrepos.syncmoves(remoterepos, statusrepos)
-
-            # iterate through all folders on the remote repo and sync
-            for remotefolder in remoterepos.getfolders():
+            # With several processes syncing this account, only one of
+            # them may work on more than the folders it holds leases for
+            if self.leases is None or \
+                    self.leases.acquire(FolderLeases.ACCOUNT):
+                remoterepos.sync_folder_structure(localrepos, statusrepos)
+                # replicate the folderstructure between REMOTE to LOCAL
+                if not localrepos.getconfboolean('readonly', False):
+                    self.ui.syncfolders(remoterepos, localrepos)
+
+                # try to short circuit moves
+                localrepos.syncmoves(remoterepos, statusrepos)
+            # Moves span folders, which other processes might hold
+            loaded = []
+            if self.getconfboolean('detect-moves', False) and not quick \
+                    and not self.dryrun and self.leases is None \
+                    and not localrepos.getconfboolean('readonly', False):
+                loaded = localrepos.syncremotemoves(remoterepos, statusrepos)
+
+            # iterate through all folders on the remote repo and sync,
+            # priority folders first and in their own reserved slot
+            remotefolders = remoterepos.getfolders()
+            requested = self.takerequestedfolders()
+            if requested:
+                # asked for through the control socket
+                remotefolders = [folder for folder in remotefolders
+                                 if folder.getvisiblename() in requested or
+                                 folder.getname() in requested]
+            elif self.folderstats is not None:
+                # only the due ones, most likely changed first
+                remotefolders = self.folderstats.schedule(remotefolders)
+            for remotefolder in sorted(remotefolders,
+                                       key = lambda f: not f.priority):
                 # check for CTRL-C or SIGTERM
                 if Account.abort_NOW_signal.is_set(): break
 
@@ -324,19 +455,44 @@ class SyncableAccount(Account):
                     self.ui.debug('', "Not syncing filtered folder '%s'"
                                  "[%s]" % (localfolder, localfolder.repository))
                     continue # Ignore filtered folder
+                remotefolder.copywindow = window if window > 0 else None
+                lane = 'PRIORITY_' if remotefolder.priority else 'FOLDER_'
                 thread = InstanceLimitedThread(\
-                    instancename = 'FOLDER_' + self.remoterepos.getname(),
+                    instancename = lane + self.remoterepos.getname(),
                     target = syncfolder,
                     name = "Folder %s [acc: %s]" % (remotefolder, self),
-                    args = (self, remotefolder, quick))
+                    args = (self, remotefolder, quick,
+                            remotefolder in loaded))
+                self.progress.queuefolders(1)
                 thread.start()
-                folderthreads.append(thread)
+                folderthreads.append((remotefolder, thread))
             # wait for all threads to finish
-            for thr in folderthreads:
+            for remotefolder, thr in folderthreads:
+                thr.join()
+            # Backfill the older messages postponed by progressive-sync,
+            # now that all folders have their most recent messages.
+            backfillthreads = []
+            for remotefolder, thr in folderthreads:
+                if Account.abort_NOW_signal.is_set(): break
+                if not remotefolder.copypostponed:
+                    continue
+                remotefolder.copywindow = None
+                thread = InstanceLimitedThread(\
+                    instancename = 'FOLDER_' + self.remoterepos.getname(),
+                    target = syncfolder,
+                    name = "Backfill folder %s [acc: %s]" % (remotefolder,
+                                                             self),
+                    args = (self, remotefolder, False, True))
+                self.progress.queuefolders(1)
+                thread.start()
+                backfillthreads.append(thread)
+            for thr in backfillthreads:
                 thr.join()
             # Write out mailbox names if required and not in dry-run mode
             if not self.dryrun:
                 mbnames.write()
+            if self.folderstats is not None:
+                self.folderstats.save()
             localrepos.forgetfolders()
             remoterepos.forgetfolders()
         except:
@@ -349,6 +505,9 @@ class SyncableAccount(Account):
             # sync went fine. Hold or drop depending on config
             localrepos.holdordropconnections()
             remoterepos.holdordropconnections()
+        finally:
+            if self.leases is not None:
+                self.leases.releaseall()
 
         hook = self.getconf('postsynchook', '')
         self.callhook(hook)
@@ -374,17 +533,65 @@ class SyncableAccount(Account):
         except Exception as e:
             self.ui.error(e, exc_info()[2], msg = "Calling hook")
 
-def syncfolder(account, remotefolder, quick):
+def statussnapshot(statusfolder):
+    """Return the UIDs and flags of a status folder's messages"""
+    return dict((uid, frozenset(statusfolder.getmessageflags(uid)))
+                for uid in statusfolder.getmessageuidlist())
+
+def recover_uidvalidity(remotefolder, localfolder, statusfolder):
+    """Re-associate local messages with a remote folder's new UIDs
+
+    Invoked when the server has reset the UIDVALIDITY of
+    `remotefolder`. Rather than downloading the whole folder again,
+    we fetch Message-ID and size of all remote messages and match them
+    against the messages in the (Maildir) `localfolder`. Matched
+    messages are renamed to their new UID, previously synced messages
+    that could not be matched are removed locally, and the status cache
+    is rebuilt from the matches. The following regular sync then
+    downloads only the remote messages we could not match.
+
+    Messages that were never synced (negative UIDs) are left alone."""
+    ui = getglobalui()
+    ui.recoveringvalidity(remotefolder)
+    remoteidsizes = remotefolder.getmessageidsizes()
+    remotekeys = invert_idsizes(remoteidsizes)
+    localidsizes = localfolder.getmessageidsizes()
+    localkeys = invert_idsizes(dict((uid, key) for uid, key in
+                                 localidsizes.items() if uid > 0))
+
+    uidmap = {}
+    for key, uid in localkeys.items():
+        if key in remotekeys:
+            uidmap[uid] = remotekeys[key]
+    unmatched = [uid for uid in localidsizes if uid > 0 and not uid in uidmap]
+
+    localfolder.deletemessages(unmatched)
+    localfolder.change_message_uids(uidmap)
+    statusfolder.replacemessagelist(dict((uid, localfolder.getmessageflags(uid))
+                                         for uid in uidmap.values()))
+    remotefolder.save_uidvalidity()
+    ui.recoveredvalidity(remotefolder, len(uidmap), len(unmatched),
+                         len(remoteidsizes) - len(uidmap))
+
+def syncfolder(account, remotefolder, quick, reuselists=False):
     """This function is called as target for the
     InstanceLimitedThread invokation in SyncableAccount.
 
-    Filtered folders on the remote side will not invoke this function."""
+    Filtered folders on the remote side will not invoke this function.
+
+    :param reuselists: The message lists of the remote, local and status
+        folder have been loaded (and kept up to date) during this sync
+        run already, so don't load them again."""
     remoterepos = account.remoterepos
     localrepos = account.localrepos
     statusrepos = account.statusrepos
 
     ui = getglobalui()
     ui.registerthread(account)
+    stats = account.folderstats
+    start = time.time()
+    if remotefolder.priority:
+        account.prioritylane.enter()
     try:
         # Load local folder.
         localfolder = account.get_local_folder(remotefolder)
@@ -392,10 +599,20 @@ def syncfolder(account, remotefolder, quick):
         # Write the mailboxes
         mbnames.add(account.name, localfolder.getname())
 
+        # With several processes syncing this account, only sync the
+        # folder if it has not been claimed by another one. We keep the
+        # lease (named like the status folder) until the end of this
+        # sync run.
+        statusname = remotefolder.getvisiblename().\
+            replace(remoterepos.getsep(), statusrepos.getsep())
+        if account.leases is not None and \
+                not account.leases.acquire(statusname):
+            ui.debug('', "Folder %s [acc: %s] is synced by another process" %
+                     (remotefolder, account))
+            return
+
         # Load status folder.
-        statusfolder = statusrepos.getfolder(remotefolder.getvisiblename().\
-                                             replace(remoterepos.getsep(),
-                                                     statusrepos.getsep()))
+        statusfolder = statusrepos.getfolder(statusname)
         if localfolder.get_uidvalidity() == None:
             # This is a new folder, so delete the status cache to be
             # sure we don't have a conflict.
@@ -403,19 +620,25 @@ def syncfolder(account, remotefolder, quick):
             # to rework this...
             statusfolder.deletemessagelist()
 
-        statusfolder.cachemessagelist()
+        if not reuselists:
+            statusfolder.cachemessagelist()
+        if stats is not None:
+            before = statussnapshot(statusfolder)
 
         if quick:
             if not localfolder.quickchanged(statusfolder) \
                    and not remotefolder.quickchanged(statusfolder):
                 ui.skippingfolder(remotefolder)
                 localrepos.restore_atime()
+                if stats is not None:
+                    stats.record(remotefolder.getvisiblename(), start, False)
                 return
 
         # Load local folder
         ui.syncingfolder(remoterepos, remotefolder, localrepos, localfolder)
         ui.loadmessagelist(localrepos, localfolder)
-        localfolder.cachemessagelist()
+        if not reuselists:
+            localfolder.cachemessagelist()
         ui.messagelistloaded(localrepos, localfolder, localfolder.getmessagecount())
 
         # If either the local or the status folder has messages and
@@ -429,9 +652,17 @@ def syncfolder(account, remotefolder, quick):
                 localrepos.restore_atime()
                 return
             if not remotefolder.check_uidvalidity():
-                ui.validityproblem(remotefolder)
-                localrepos.restore_atime()
-                return
+                if not account.getconfboolean('uidvalidity-recovery', False)\
+                        or not isinstance(localfolder, MaildirFolder):
+                    ui.validityproblem(remotefolder)
+                    localrepos.restore_atime()
+                    return
+                if account.dryrun:
+                    ui.info("[DRYRUN] Would recover from UID validity change "
+                            "of folder %s" % remotefolder)
+                    localrepos.restore_atime()
+                    return
+                recover_uidvalidity(remotefolder, localfolder, statusfolder)
         else:
             # Both folders empty, just save new UIDVALIDITY
             localfolder.save_uidvalidity()
@@ -449,7 +680,8 @@ def syncfolder(account, remotefolder, quick):
 
         # Load remote folder.
         ui.loadmessagelist(remoterepos, remotefolder)
-        remotefolder.cachemessagelist()
+        if not reuselists:
+            remotefolder.cachemessagelist()
         ui.messagelistloaded(remoterepos, remotefolder,
                              remotefolder.getmessagecount())
 
@@ -462,6 +694,8 @@ def syncfolder(account, remotefolder, quick):
                          % localrepos.getname())
 
         # Synchronize local changes
+        if account.leases is not None:
+            account.leases.check(statusname)
         if not remoterepos.getconfboolean('readonly', False):
             ui.syncingmessages(localrepos, localfolder, remoterepos, remotefolder)
             localfolder.syncmessagesto(remotefolder, statusfolder, True)
@@ -469,8 +703,13 @@ def syncfolder(account, remotefolder, quick):
             ui.debug('', "Not syncing to read-only repository '%s'" \
                          % remoterepos.getname())
 
+        if account.leases is not None:
+            account.leases.check(statusname)
         statusfolder.save()
         localrepos.restore_atime()
+        if stats is not None:
+            stats.record(remotefolder.getvisiblename(), start,
+                         statussnapshot(statusfolder) != before)
     except (KeyboardInterrupt, SystemExit):
         raise
     except OfflineImapError as e:
@@ -484,3 +723,87 @@ def syncfolder(account, remotefolder, quick):
         ui.error(e, msg = "ERROR in syncfolder for %s folder %s: %s" % \
                 (account, remotefolder.getvisiblename(),
                  traceback.format_exc()))
+    finally:
+        if remotefolder.priority:
+            account.prioritylane.leave()
+        account.progress.folderdone()
+
+def syncnewmessages(account, remotefolder):
+    """Sync the remote changes IDLE or NOTIFY reported for a folder
+
+    This is the fast path of syncfolder() for a folder that has been
+    synced before. Rather than loading the whole remote, local and
+    status message lists, it fetches the messages with UIDs above the
+    highest one in the status folder and downloads just those. Only if
+    the message count of the remote folder shows that messages were
+    expunged, it asks the server which of the known UIDs are gone and
+    scans the local folder to delete them. Local changes are left for
+    the next regular sync.
+
+    :returns: False if the folder needs a full syncfolder() instead,
+        e.g. as it has not been synced yet, maxage or maxsize limit the
+        synced messages, or its UIDVALIDITY changed."""
+    remoterepos = account.remoterepos
+    localrepos = account.localrepos
+    statusrepos = account.statusrepos
+    if account.dryrun or account.leases is not None or \
+            localrepos.getconfboolean('readonly', False) or \
+            account.getconfint('maxage', -1) != -1 or \
+            account.getconfint('maxsize', -1) != -1:
+        return False
+
+    ui = getglobalui()
+    ui.registerthread(account)
+    start = time.time()
+    if remotefolder.priority:
+        account.prioritylane.enter()
+    try:
+        localfolder = account.get_local_folder(remotefolder)
+        if not isinstance(localfolder, MaildirFolder):
+            return False
+        statusname = remotefolder.getvisiblename().\
+            replace(remoterepos.getsep(), statusrepos.getsep())
+        statusfolder = statusrepos.getfolder(statusname)
+        statusfolder.cachemessagelist()
+        uids = [uid for uid in statusfolder.getmessageuidlist() if uid > 0]
+        if not uids or not remotefolder.check_uidvalidity():
+            return False
+
+        ui.syncingfolder(remoterepos, remotefolder, localrepos, localfolder)
+        minuid = max(uids) + 1
+        exists = remotefolder.cachenewmessages(minuid)
+        ui.messagelistloaded(remoterepos, remotefolder,
+                             remotefolder.getmessagecount())
+        expunged = exists != len(uids) + remotefolder.getmessagecount()
+        if expunged:
+            # Messages were expunged (or are still to be synced)
+            localfolder.cachemessagelist()
+            ui.syncingmessages(remoterepos, remotefolder, localrepos,
+                               localfolder)
+            remotefolder.syncmessagesto(localfolder, statusfolder, False)
+        elif remotefolder.getmessagecount():
+            localfolder.cachenewmessages(minuid)
+            ui.syncingmessages(remoterepos, remotefolder, localrepos,
+                               localfolder)
+            remotefolder.syncmessagesto_copy(localfolder, statusfolder, False)
+        statusfolder.save()
+        localrepos.restore_atime()
+        if account.folderstats is not None:
+            account.folderstats.record(remotefolder.getvisiblename(), start,
+                expunged or remotefolder.getmessagecount() > 0)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except OfflineImapError as e:
+        # bubble up severe Errors, skip folder otherwise
+        if e.severity > OfflineImapError.ERROR.FOLDER:
+            raise
+        ui.error(e, exc_info()[2], msg = "Aborting sync, folder '%s' "
+                 "[acc: '%s']" % (remotefolder, account))
+    except Exception as e:
+        ui.error(e, msg = "ERROR in syncnewmessages for %s folder %s: %s" % \
+                (account, remotefolder.getvisiblename(),
+                 traceback.format_exc()))
+    finally:
+        if remotefolder.priority:
+            account.prioritylane.leave()
+    return True
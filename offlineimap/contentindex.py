@@ -0,0 +1,80 @@
+# Content index of locally stored messages
+# Copyright (C) 2012 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import os
+from threading import Lock
+
+
+class ContentIndex(object):
+    """Per-account index of message files stored in local folders
+
+    Maps the key (Message-ID, size, header digest) of a message to the
+    MD5 of its content and the absolute path of the file it has been
+    stored in. This allows us to find out whether a message that is
+    about to be downloaded already exists in another local folder, by
+    only looking at data an IMAP server can give us cheaply (see
+    :meth:`offlineimap.folder.Base.BaseFolder.getcontentkeys`).
+
+    The index is kept in memory and persisted as an append-only text
+    file with one tab-separated 'size, header digest, md5, path,
+    Message-ID' line per entry. Later lines win. Entries may go stale
+    when messages are renamed or deleted, so users of :meth:`get` need
+    to verify the file."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.entries = None
+
+    def _load(self):
+        """Read the index file (needs to be called with self.lock held)"""
+        self.entries = {}
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'rt') as file:
+            for line in file:
+                try:
+                    size, headermd5, md5, path, messageid = \
+                        line.rstrip('\n').split('\t', 4)
+                    self.entries[(messageid, long(size), headermd5)] = \
+                        (md5, path)
+                except ValueError:
+                    continue # Skip corrupt (e.g. truncated) lines
+
+    def get(self, key):
+        """Return (md5, path) of a stored message or `None`
+
+        :param key: (Message-ID, size, header digest) of the message"""
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            return self.entries.get(key)
+
+    def add(self, key, md5, path):
+        """Record that a message has been stored in file 'path'"""
+        messageid, size, headermd5 = key
+        if messageid is None or '\n' in messageid:
+            return
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            if self.entries.get(key) == (md5, path):
+                return
+            self.entries[key] = (md5, path)
+            with open(self.filename, 'at') as file:
+                file.write("%d\t%s\t%s\t%s\t%s\n" % (size, headermd5, md5,
+                                                     path, messageid))
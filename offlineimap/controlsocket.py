@@ -0,0 +1,232 @@
+# Control socket to trigger and query syncs of a running offlineimap
+# Copyright (C) 2012 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""UNIX domain socket to control a running offlineimap
+
+Clients send one command per line and get zero or more data lines
+starting with '* ', followed by a line starting with 'OK' or 'NO'.
+The commands are:
+
+  sync-account ACCOUNT          end the account's sleep and sync it
+  sync-folder ACCOUNT FOLDER    sync just one (remote) folder now
+  pause [ACCOUNT]               pause syncing, of all accounts by default
+  resume [ACCOUNT]              continue paused syncs
+  status [ACCOUNT]              one line of progress for each account
+
+Folder names may be quoted with double quotes."""
+
+import errno
+import inspect
+import os
+import shlex
+import socket
+import SocketServer
+import time
+from collections import deque
+from threading import Lock, Thread
+from offlineimap.error import OfflineImapError
+from offlineimap.ui import getglobalui
+
+accounts = {}
+"""The accounts of this process by name, registered by syncrunner()"""
+
+
+class SyncProgress(object):
+    """Live progress of an account, as reported by the status command"""
+
+    WINDOW = 10
+    """Transfer rates are averaged over that many seconds"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.state = 'starting'
+        self.nextsync = None
+        """time of the next sync while sleeping"""
+        self.foldersqueued = 0
+        self.inflight = 0
+        self.transfers = deque()
+        """(time, bytes) of the messages copied in the last WINDOW secs"""
+
+    def setstate(self, state, nextsync=None):
+        with self.lock:
+            self.state = state
+            self.nextsync = nextsync
+
+    def queuefolders(self, num):
+        with self.lock:
+            self.foldersqueued += num
+
+    def folderdone(self):
+        with self.lock:
+            # IDLE triggered syncs were never queued
+            self.foldersqueued = max(self.foldersqueued - 1, 0)
+
+    def startmessage(self):
+        with self.lock:
+            self.inflight += 1
+
+    def endmessage(self, size):
+        now = time.time()
+        with self.lock:
+            self.inflight -= 1
+            if size:
+                self.transfers.append((now, size))
+            self._expire(now)
+
+    def _expire(self, now):
+        while self.transfers and self.transfers[0][0] < now - self.WINDOW:
+            self.transfers.popleft()
+
+    def rate(self):
+        """Return the bytes per second copied in the last WINDOW secs"""
+        with self.lock:
+            self._expire(time.time())
+            return sum(size for when, size in self.transfers) / self.WINDOW
+
+    def __str__(self):
+        nextsync = '-'
+        if self.nextsync is not None:
+            nextsync = '%d' % max(self.nextsync - time.time(), 0)
+        return "state=%s folders-queued=%d messages-in-flight=%d " \
+            "bytes-per-sec=%d next-sync=%s" % (self.state,
+            self.foldersqueued, self.inflight, self.rate(), nextsync)
+
+
+class ControlHandler(SocketServer.StreamRequestHandler):
+    """Answers the commands of one client connection"""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            try:
+                args = shlex.split(line)
+            except ValueError as e:
+                self.reply('NO %s' % e)
+                continue
+            if not args:
+                continue
+            command = args[0].lower()
+            handler = self.server.commands.get(command)
+            if handler is None:
+                self.reply('NO unknown command %s' % command)
+                continue
+            params, varargs, keywords, defaults = inspect.getargspec(handler)
+            maxargs = len(params) - 1 # self
+            if not maxargs - len(defaults or ()) <= len(args) - 1 <= maxargs:
+                self.reply('NO wrong number of arguments to %s' % command)
+                continue
+            try:
+                self.reply(handler(self, *args[1:]))
+            except KeyError as e:
+                self.reply('NO unknown account %s' % e)
+
+    def reply(self, line):
+        self.wfile.write(line + '\n')
+        self.wfile.flush()
+
+    def getaccounts(self, name=None):
+        if name is None:
+            return [accounts[name] for name in sorted(accounts)]
+        return [accounts[name]]
+
+    def do_syncaccount(self, name):
+        accounts[name].wake()
+        return 'OK sync of %s requested' % name
+
+    def do_syncfolder(self, name, foldername):
+        accounts[name].requestfolder(foldername)
+        return 'OK sync of %s in %s requested' % (foldername, name)
+
+    def do_pause(self, name=None):
+        for account in self.getaccounts(name):
+            account.pause()
+        return 'OK paused'
+
+    def do_resume(self, name=None):
+        for account in self.getaccounts(name):
+            account.resume()
+        return 'OK resumed'
+
+    def do_status(self, name=None):
+        for account in self.getaccounts(name):
+            paused = ' paused' if account.paused else ''
+            self.reply('* %s %s%s' % (account.name, account.progress, paused))
+        return 'OK status done'
+
+
+class ControlServer(SocketServer.ThreadingMixIn,
+                    SocketServer.UnixStreamServer):
+    """Serves the control socket at `path` in a background thread"""
+
+    daemon_threads = True
+    commands = {'sync-account': ControlHandler.do_syncaccount,
+                'sync-folder': ControlHandler.do_syncfolder,
+                'pause': ControlHandler.do_pause,
+                'resume': ControlHandler.do_resume,
+                'status': ControlHandler.do_status}
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            self.removestale()
+        SocketServer.UnixStreamServer.__init__(self, path, ControlHandler,
+                                               bind_and_activate=False)
+        try:
+            self.server_bind()
+            # only we may connect, nobody can before we listen
+            os.chmod(path, 0o600)
+            self.server_activate()
+        except:
+            self.server_close()
+            raise
+        self.thread = Thread(target = self.serve_forever,
+                             name = "Control socket")
+        self.thread.setDaemon(True)
+
+    def removestale(self):
+        """Remove the socket at self.path if nobody listens on it
+
+        It can be left behind by a crashed instance. Raises an
+        OfflineImapError if another instance is using it."""
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except socket.error as e:
+            if e.errno != errno.ECONNREFUSED:
+                raise
+        else:
+            raise OfflineImapError("Control socket %s is in use by another "
+                                   "instance" % self.path,
+                                   OfflineImapError.ERROR.CRITICAL)
+        finally:
+            sock.close()
+        os.unlink(self.path)
+
+    def start(self):
+        getglobalui().debug('', "Listening on control socket %s" % self.path)
+        self.thread.start()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,326 @@
+# Event loop handling the responses of all IMAP connections in one thread
+# Copyright (C) 2012 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""One thread to read and handle the responses of all IMAP connections
+
+imaplib2 runs a reader, a writer and a handler thread for every
+connection, which pass each response line on to the next through
+queues. Connections using an :class:`EventLoop` instead (see
+:attr:`imaplibutil.UsefulIMAPMixIn.eventloop`) have no threads of their
+own: one thread per process polls the sockets of all of them and feeds
+the lines to the response parser of their connection right away, and
+commands are sent by the thread issuing them. The commands of the
+connections work just the same.
+
+While a response is read, the loop thread blocks on that connection,
+e.g. until a TLS record is complete, up to the socket timeout."""
+
+import errno
+import fcntl
+import os
+import select
+import sys
+import time
+from threading import Event, Lock, Thread, currentThread
+from offlineimap.imaplib2 import IDLE_TIMEOUT_RESPONSE, ReadBuffer
+
+
+class OutputQueue(object):
+    """Stands in for the queue to the writer thread of a connection,
+    sending the commands put into it right away"""
+
+    def __init__(self, imapobj, loop):
+        self.imapobj = imapobj
+        self.loop = loop
+        self.lock = Lock()
+        self.lastsent = time.time()
+
+    def put(self, rqb):
+        if rqb is None:
+            return # there is no writer to stop
+        imapobj = self.imapobj
+        with self.lock:
+            try:
+                imapobj.send(rqb.data)
+                if __debug__: imapobj._log(4, '> %s' % rqb.data)
+                self.lastsent = time.time()
+                return
+            except:
+                reason = 'socket error: %s - %s' % sys.exc_info()[:2]
+        # not with self.lock held, the loop thread may wait for it
+        rqb.abort(imapobj.abort, reason)
+        self.loop.terminate(imapobj, imapobj.abort, reason)
+
+    def empty(self):
+        return True
+
+
+class Reader(object):
+    """The state of reading the responses of one connection"""
+
+    def __init__(self, imapobj, greeting):
+        self.imapobj = imapobj
+        self.fd = imapobj.read_fd
+        self.readbuf = ReadBuffer(imapobj)
+        self.greeted = not greeting
+        """whether the greeting of the server may be handled"""
+        self.rxzero = 0
+        self.lastread = time.time()
+        self.stopped = Event()
+
+
+class EventLoop(object):
+    """Reads the responses of the connections registered with it
+
+    The loop thread is started with the first connection. Every `TICK`
+    seconds, it looks for connections whose IDLE or command response
+    timed out. The greeting of a new connection is held back until the
+    connection waits for it, checking every `GREETTICK` seconds."""
+
+    TICK = 1
+    GREETTICK = 0.01
+
+    def __init__(self):
+        self.lock = Lock()
+        self.handling = Lock()
+        """held by the loop thread while it handles responses"""
+        self.readers = {}
+        """dict of file descriptor -> :class:`Reader`"""
+        self.changed = False
+        self.wakeupfds = os.pipe()
+        fcntl.fcntl(self.wakeupfds[1], fcntl.F_SETFL, os.O_NONBLOCK)
+        self.thread = None
+
+    def register(self, imapobj, greeting=False):
+        """Start reading the responses of a connection
+
+        :param greeting: whether the server greeting is still to come,
+            i.e. unless TLS was just started"""
+        reader = Reader(imapobj, greeting)
+        with self.lock:
+            self.readers[reader.fd] = reader
+            self.changed = True
+            if self.thread is None:
+                self.thread = Thread(target = self.run, name = 'IMAP event loop')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        self.wake()
+
+    def unregister(self, imapobj):
+        """Stop reading the responses of a connection
+
+        When called by another thread, it returns once the loop thread
+        does not handle responses of the connection any more."""
+        with self.lock:
+            reader = self.readers.get(imapobj.read_fd)
+            if reader is None or reader.imapobj is not imapobj:
+                return
+            del self.readers[reader.fd]
+            self.changed = True
+        reader.stopped.set()
+        self.wake()
+        if currentThread() is not self.thread:
+            with self.handling:
+                pass
+
+    def join(self, imapobj):
+        """Wait until the reading of a connection stopped
+
+        Used while starting TLS, where the loop stops reading after the
+        response to STARTTLS as the connection is `TerminateReader`."""
+        with self.lock:
+            reader = self.readers.get(imapobj.read_fd)
+        if reader is not None and reader.imapobj is imapobj:
+            reader.stopped.wait()
+            if currentThread() is not self.thread:
+                with self.handling:
+                    pass
+
+    def terminate(self, imapobj, typ, val):
+        """Stop reading and fail all commands waiting for a response"""
+        if __debug__: imapobj._log(1, 'terminating: %s' % `val`)
+        self.unregister(imapobj)
+        imapobj.Terminate = True
+        imapobj._abort_commands(typ, val)
+
+    def close(self, imapobj):
+        """Close a connection, as its _close_threads() does"""
+        self.unregister(imapobj)
+        imapobj.shutdown()
+        self.terminate(imapobj, imapobj.abort, 'connection terminated')
+
+    def wake(self):
+        """Interrupt the poll of the loop thread to notice changes"""
+        try:
+            os.write(self.wakeupfds[1], 'x')
+        except OSError:
+            pass
+
+    def poller(self, fds):
+        """Return a function polling `fds` for up to `timeout` seconds
+
+        It returns a (fd, readable, error) tuple for each ready fd,
+        error being a message or ''."""
+        if not hasattr(select, 'poll'):
+            def wait(timeout):
+                r, w, e = select.select(fds, [], [], timeout)
+                return [(fd, True, '') for fd in r]
+            return wait
+        errors = {select.POLLERR: 'Error',
+                  select.POLLHUP: 'Hang up',
+                  select.POLLNVAL: 'Invalid request: descriptor not open'}
+        poll = select.poll()
+        for fd in fds:
+            poll.register(fd, select.POLLIN)
+        def wait(timeout):
+            return [(fd, bool(state & select.POLLIN),
+                     ' '.join(msg for bit, msg in errors.items()
+                              if state & bit))
+                    for fd, state in poll.poll(timeout * 1000)]
+        return wait
+
+    def run(self):
+        wait = None
+        while True:
+            with self.lock:
+                if wait is None or self.changed:
+                    wait = self.poller([self.wakeupfds[0]] +
+                                       self.readers.keys())
+                    self.changed = False
+                greeting = [reader for reader in self.readers.values()
+                            if not reader.greeted]
+            try:
+                ready = wait(self.GREETTICK if greeting else self.TICK)
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            with self.handling:
+                for fd, readable, error in ready:
+                    if fd == self.wakeupfds[0]:
+                        os.read(fd, 4096)
+                        continue
+                    with self.lock:
+                        reader = self.readers.get(fd)
+                    if reader is not None:
+                        self.read(reader, readable, error)
+                for reader in greeting:
+                    if not reader.stopped.isSet():
+                        self.handle(reader)
+                now = time.time()
+                with self.lock:
+                    readers = self.readers.values()
+                for reader in readers:
+                    self.checktimeouts(reader, now)
+
+    def read(self, reader, readable, error):
+        """Read what a connection sent and handle the complete responses"""
+        imapobj = reader.imapobj
+        try:
+            dlen = 0
+            if readable:
+                dlen = reader.readbuf.read(imapobj.read_size)
+                if imapobj.read_size > 1:
+                    dlen += self.drain(reader)
+                if __debug__: imapobj._log(5, 'rcvd %s' % dlen)
+                if not dlen:
+                    reader.rxzero += 1
+                    if reader.rxzero > 5:
+                        raise IOError("Too many read 0")
+                else:
+                    reader.rxzero = 0
+                    reader.lastread = time.time()
+            if dlen:
+                self.handle(reader)
+            if error:
+                raise IOError(error)
+        except:
+            reason = 'socket error: %s - %s' % sys.exc_info()[:2]
+            self.terminate(imapobj, imapobj.abort, reason)
+
+    def drain(self, reader):
+        """Read what has been received but is not signaled by poll any
+        more: the rest of a TLS record or of a compressed block"""
+        imapobj = reader.imapobj
+        dlen = 0
+        sock = getattr(imapobj, 'sock', None)
+        while (imapobj.decompressor is not None and
+               imapobj.decompressor.unconsumed_tail) or \
+                (hasattr(sock, 'pending') and sock.pending()):
+            more = reader.readbuf.read(imapobj.read_size)
+            if not more:
+                break
+            dlen += more
+        return dlen
+
+    def handle(self, reader):
+        """Feed the complete lines and literals read to the response
+        parser"""
+        imapobj = reader.imapobj
+        if not reader.greeted:
+            # Like the handler thread sleeping before it starts, as the
+            # greeting is only expected once IMAP4.__init__ asks for it
+            if 'continuation' not in imapobj.tagged_commands:
+                return
+            reader.greeted = True
+        for line in reader.readbuf.responses():
+            # set before sending STARTTLS, maybe while handling this line
+            terminate = imapobj.TerminateReader
+            self.put_response(reader, line)
+            if imapobj.Terminate:
+                return
+            if terminate:
+                self.unregister(imapobj)
+                return
+
+    def put_response(self, reader, line):
+        imapobj = reader.imapobj
+        if __debug__: imapobj._log(4, '< %s' % line)
+        try:
+            imapobj._put_response(line)
+        except:
+            self.terminate(imapobj, imapobj.error,
+                           'program error: %s - %s' % sys.exc_info()[:2])
+
+    def checktimeouts(self, reader, now):
+        imapobj = reader.imapobj
+        if imapobj.idle_rqb is not None:
+            if imapobj.idle_timeout is not None and \
+                    imapobj.idle_timeout <= now:
+                if __debug__: imapobj._log(2, 'server IDLE timedout')
+                self.put_response(reader, IDLE_TIMEOUT_RESPONSE)
+        elif imapobj.resp_timeout is not None and imapobj.tagged_commands \
+                and now - max(reader.lastread, imapobj.ouq.lastsent) > \
+                imapobj.resp_timeout:
+            if __debug__: imapobj._log(1, 'response timeout')
+            self.terminate(imapobj, imapobj.abort, 'no response after %s secs'
+                           % imapobj.resp_timeout)
+
+
+_loop = None
+_looppid = None
+_looplock = Lock()
+
+def getloop():
+    """Return the :class:`EventLoop` of this process"""
+    global _loop, _looppid
+    with _looplock:
+        # a forked child process needs one of its own
+        if _loop is None or _looppid != os.getpid():
+            _loop = EventLoop()
+            _looppid = os.getpid()
+        return _loop
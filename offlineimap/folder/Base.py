@@ -21,10 +21,31 @@ from offlineimap.error import OfflineImapError
 import offlineimap.accounts
 import os.path
 import re
+import time
 from sys import exc_info
 import traceback
 
 
+def invert_idsizes(idsizes):
+    """Invert a UID -> (Message-ID, size) dict, dropping ambiguous keys
+
+    Messages without Message-ID and keys that occur more than once
+    cannot be matched reliably and are left out.
+
+    :param idsizes: as returned by :meth:`BaseFolder.getmessageidsizes`
+    :returns: dict mapping (Message-ID, size) -> UID"""
+    retval, duplicates = {}, set()
+    for uid, key in idsizes.items():
+        if key[0] is None:
+            continue
+        if key in retval:
+            duplicates.add(key)
+        retval[key] = uid
+    for key in duplicates:
+        del retval[key]
+    return retval
+
+
 class BaseFolder(object):
     def __init__(self, name, repository):
         """
@@ -34,6 +55,7 @@ class BaseFolder(object):
         self.ui = getglobalui()
         """Should this folder be included in syncing?"""
         self._sync_this = repository.should_sync_folder(name)
+        self._priority = repository.is_priority_folder(name)
         if not self._sync_this:
             self.ui.debug('', "Filtering out '%s'[%s] due to folderfilter" \
                           % (name, repository))
@@ -47,6 +69,13 @@ class BaseFolder(object):
         if self.visiblename == self.getsep():
             self.visiblename = ''
         self.config = repository.getconfig()
+        self.contentkeys = {}
+        """dict mapping UIDs of messages to be copied to their content
+        key, if the destination can reuse identical local copies"""
+        self.copywindow = None
+        """If set, pass 1 only copies that many messages, newest first"""
+        self.copypostponed = 0
+        """Number of messages pass 1 left for a later (backfill) pass"""
 
     def getname(self):
         """Returns name"""
@@ -65,6 +94,11 @@ class BaseFolder(object):
         """Should this folder be synced or is it e.g. filtered out?"""
         return self._sync_this
 
+    @property
+    def priority(self):
+        """Should this folder be synced ahead of bulk transfers?"""
+        return self._priority
+
     def suggeststhreads(self):
         """Returns true if this folder suggests using threads for actions;
         false otherwise.  Probably only IMAP will return true."""
@@ -186,6 +220,16 @@ class BaseFolder(object):
         """Returns True if uid exists"""
         return uid in self.getmessagelist()
 
+    def getexcludeduids(self, uidlist):
+        """Return the UIDs of uidlist that exist outside the message list
+
+        Options like maxage or maxsize restrict the cached message list
+        to part of the folder. Messages that are left out must not be
+        mistaken for deleted ones.
+
+        :returns: set of UIDs"""
+        return set()
+
     def getmessageuidlist(self):
         """Gets a list of UIDs.
         You may have to call cachemessagelist() before calling this function!"""
@@ -199,6 +243,46 @@ class BaseFolder(object):
         """Returns the content of the specified message."""
         raise NotImplementedException
 
+    def getmessageidsizes(self, uidlist=None):
+        """Return Message-ID and size of messages in the folder
+
+        This is used to identify messages independently of their UID,
+        e.g. when a server has reset its UIDVALIDITY.  Sizes are in
+        bytes, counting line endings as CRLF like IMAP's RFC822.SIZE.
+        This needs to be implemented by each backend that supports it.
+
+        :param uidlist: UIDs to look at, all messages if `None`.
+        :returns: dict mapping UID -> (Message-ID, size)"""
+        raise NotImplementedError
+
+    def getcontentkeys(self, uidlist):
+        """Return the content keys of messages in the folder
+
+        A content key is (Message-ID, size, header digest), with the
+        size as in :meth:`getmessageidsizes` and the digest as returned
+        by :func:`offlineimap.headerscan.headerdigest`. It identifies a
+        message without looking at its body. This needs to be
+        implemented by each backend that supports it.
+
+        :returns: dict mapping UID -> content key"""
+        raise NotImplementedError
+
+    def linkmessage(self, uid, key, flags, rtime):
+        """Store a message by reusing an identical, locally stored copy
+
+        Backends that can find an identical message without being
+        handed its content (see :class:`offlineimap.contentindex.ContentIndex`)
+        save it under `uid` without transferring the body.
+
+        Note that linkmessage() does not check against dryrun settings.
+
+        :param key: the content key of the message, see
+            :meth:`getcontentkeys`
+
+        :returns: True if the message has been stored, False if no
+            identical copy was available."""
+        return False
+
     def savemessagefast(self, uid, content, flags, rtime):
         """Writes a new message with the specified uid, but
         if possible to do so safely, does not wait to make sure that the
@@ -210,6 +294,20 @@ class BaseFolder(object):
         a lot faster, though try to batch it first!)
         """
         return self.savemessage(uid, content, flags, rtime)
+
+    def deferfsync(self, defer = True):
+        """Stop (or resume) making each saved message durable right away
+
+        Used for bulk imports. All messages saved while deferring are
+        only guaranteed to be on disk after the next :meth:`fsyncbarrier`
+        call. Resuming implies a final barrier. Backends that do not
+        fsync anyway don't need to implement this."""
+        pass
+
+    def fsyncbarrier(self):
+        """Make all messages saved since :meth:`deferfsync` durable"""
+        pass
+
     def savemessage(self, uid, content, flags, rtime):
         """Writes a new message, with the specified uid.
 
@@ -316,7 +414,8 @@ class BaseFolder(object):
     def remotecopymessage(self, uid, remote_newfolder, local_newfolder, status_newfolder):
         raise NotImplementedException
 
-    def copymessageto(self, uid, dstfolder, statusfolder, always_sync_deletes, register = 1):
+    def copymessageto(self, uid, dstfolder, statusfolder, always_sync_deletes,
+                      register = 1, bulk = False):
         """Copies a message from self to dst if needed, updating the status
 
         Note that this function does not check against dryrun settings,
@@ -327,7 +426,11 @@ class BaseFolder(object):
         :param dstfolder: A BaseFolder-derived instance
         :param statusfolder: A LocalStatusFolder instance
         :param register: whether we should register a new thread."
-        :returns: Nothing on success, or raises an Exception."""
+        :param bulk: whether we are importing into an empty dstfolder
+            and can skip checking whether it has the message already.
+        :returns: Nothing on success, or raises an Exception. The status
+            is only recorded via savemessagefast(), it's up to the caller
+            to save() the statusfolder."""
         # Sometimes, it could be the case that if a sync takes awhile,
         # a message might be deleted from the maildir before it can be
         # synced to the status cache.  This is only a problem with
@@ -336,8 +439,10 @@ class BaseFolder(object):
         if register: # output that we start a new thread
             self.ui.registerthread(self.repository.account)
 
+        progress = self.repository.account.progress
+        progress.startmessage()
+        message = None
         try:
-            message = None
             flags = self.getmessageflags(uid)
             rtime = self.getmessagetime(uid)
 
@@ -346,20 +451,23 @@ class BaseFolder(object):
                 # deleted files if delete synchronization is turned on;
                 # they'll just be deleted immediately.  This doesn't
                 # sync flags, which will be handled in the later step.
-                # We also optimize handling large runs of deleted files
-                # by not saving statusfolder until we find another
-                # message which needs to take the slow path.
                 statusfolder.savemessagefast(uid, None, flags, rtime)
                 return
 
-            if uid > 0 and dstfolder.uidexists(uid):
+            if not bulk and uid > 0 and dstfolder.uidexists(uid):
                 # dst has message with that UID already, only update status
-                statusfolder.savemessage(uid, None, flags, rtime)
+                statusfolder.savemessagefast(uid, None, flags, rtime)
                 return
 
             # If any of the destinations actually stores the message body,
             # load it up.
             if dstfolder.storesmessages():
+                if uid in self.contentkeys and \
+                        dstfolder.linkmessage(uid, self.contentkeys[uid],
+                                              flags, rtime):
+                    # An identical message was stored locally already
+                    statusfolder.savemessagefast(uid, None, flags, rtime)
+                    return
                 message = self.getmessage(uid)
             #Succeeded? -> IMAP actually assigned a UID. If newid
             #remained negative, no server was willing to assign us an
@@ -373,7 +481,7 @@ class BaseFolder(object):
                     statusfolder.deletemessage(uid)
                     # Got new UID, change the local uid.
                 # Save uploaded status in the statusfolder
-                statusfolder.savemessage(new_uid, message, flags, rtime)
+                statusfolder.savemessagefast(new_uid, message, flags, rtime)
             elif new_uid == 0:
                 # Message was stored to dstfolder, but we can't find it's UID
                 # This means we can't link current message to the one created
@@ -398,6 +506,8 @@ class BaseFolder(object):
                               (uid, self.accountname,
                                exc_info()[2]))
             raise    #raise on unknown errors, so we can fix those
+        finally:
+            progress.endmessage(len(message) if message else 0)
 
     def syncmessagesto_copy(self, dstfolder, statusfolder, always_sync_deletes):
         """Pass1: Copy locally existing messages not on the other side
@@ -410,40 +520,106 @@ class BaseFolder(object):
            - If dstfolder doesn't have it yet, add them to dstfolder.
            - Update statusfolder
 
+        The statusfolder is saved at checkpoints, every
+        'checkpoint-messages' messages or 'checkpoint-interval' seconds,
+        and when the pass ends or gets aborted. A crashed sync thus
+        continues about where it stopped.
+
+        In bulk import mode (only used if dstfolder and statusfolder are
+        still empty), messages are not made durable one by one. At each
+        checkpoint we wait for the copy threads and make the messages
+        durable with dstfolder.fsyncbarrier() before saving the
+        statusfolder, so that it never records messages that could get
+        lost.
+
         This function checks and protects us from action in ryrun mode.
         """
         threads = []
+        bulk = self.repository.account.bulkimport and \
+            not dstfolder.getmessagecount() and \
+            not statusfolder.getmessagecount()
+        account = "Account " + self.accountname
+        checkpointmsgs = self.config.getdefaultint(account,
+                                                   "checkpoint-messages", 1000)
+        checkpointsecs = self.config.getdefaultint(account,
+                                                   "checkpoint-interval", 60)
+        lastnum, lasttime = 0, time.time()
 
         copylist = filter(lambda uid: not \
                               statusfolder.uidexists(uid) and \
                               ("Archive" not in self.getfullname() or uid > 0) and \
                               'T' not in self.getmessageflags(uid),
                             self.getmessageuidlist())
+        self.copypostponed = 0
+        if self.copywindow is not None and len(copylist) > self.copywindow:
+            # UIDs ascend in order of arrival, copy the newest ones now
+            copylist.sort(reverse = True)
+            self.copypostponed = len(copylist) - self.copywindow
+            copylist = copylist[:self.copywindow]
+            self.ui.postponingmessages(self.copypostponed, self, dstfolder)
         num_to_copy = len(copylist)
         if num_to_copy and self.repository.account.dryrun:
             self.ui.info("[DRYRUN] Copy {0} messages from {1}[{2}] to {3}".format(
                     num_to_copy, self, self.repository, dstfolder.repository))
             return
-        for num, uid in enumerate(copylist):
-            # bail out on CTRL-C or SIGTERM
-            if offlineimap.accounts.Account.abort_NOW_signal.is_set():
-                break
-            self.ui.copyingmessage(uid, num+1, num_to_copy, self, dstfolder)
-            # exceptions are caught in copymessageto()
-            if self.suggeststhreads():
-                self.waitforthread()
-                thread = threadutil.InstanceLimitedThread(\
-                    self.getcopyinstancelimit(),
-                    target = self.copymessageto,
-                    name = "Copy message from %s:%s" % (self.repository, self),
-                    args = (uid, dstfolder, statusfolder, always_sync_deletes))
-                thread.start()
-                threads.append(thread)
-            else:
-                self.copymessageto(uid, dstfolder, statusfolder, always_sync_deletes,
-                                   register = 0)
-        for thread in threads:
-            thread.join()
+        if num_to_copy and dstfolder.repository.getcontentindex() is not None:
+            # Look up which messages could be copied from local folders
+            try:
+                self.contentkeys = self.getcontentkeys(
+                    [uid for uid in copylist if uid > 0])
+            except NotImplementedError:
+                pass
+        # see offlineimap.folderlease
+        leases = self.repository.account.leases
+        if num_to_copy and bulk:
+            self.ui.info("Bulk importing {0} messages from {1}[{2}] to "
+                         "{3}".format(num_to_copy, self, self.repository,
+                                      dstfolder.repository))
+            dstfolder.deferfsync()
+        try:
+            for num, uid in enumerate(copylist):
+                # bail out on CTRL-C or SIGTERM
+                if offlineimap.accounts.Account.abort_NOW_signal.is_set():
+                    break
+                # let priority folders have our connections and slots
+                self.repository.account.prioritylane.wait()
+                self.repository.account.waitwhilepaused()
+                if num > lastnum and (num - lastnum >= checkpointmsgs or
+                                      time.time() - lasttime >= checkpointsecs):
+                    if bulk:
+                        for thread in threads:
+                            thread.join()
+                        threads = []
+                        dstfolder.fsyncbarrier()
+                    if leases is not None:
+                        leases.check(statusfolder.getname())
+                    statusfolder.save()
+                    lastnum, lasttime = num, time.time()
+                self.ui.copyingmessage(uid, num+1, num_to_copy, self, dstfolder)
+                # exceptions are caught in copymessageto()
+                if self.suggeststhreads():
+                    self.waitforthread()
+                    thread = threadutil.InstanceLimitedThread(\
+                        self.getcopyinstancelimit(),
+                        target = self.copymessageto,
+                        name = "Copy message from %s:%s" % (self.repository, self),
+                        args = (uid, dstfolder, statusfolder, always_sync_deletes,
+                                1, bulk))
+                    thread.start()
+                    threads.append(thread)
+                else:
+                    self.copymessageto(uid, dstfolder, statusfolder, always_sync_deletes,
+                                       register = 0, bulk = bulk)
+        finally:
+            for thread in threads:
+                thread.join()
+            # Final checkpoint, also keeps what we got if we are aborted
+            if num_to_copy:
+                if bulk:
+                    dstfolder.deferfsync(False)
+                if leases is None or leases.holds(statusfolder.getname()):
+                    statusfolder.save()
+        self.contentkeys = {}
 
     def syncmessagesto_delete(self, dstfolder, statusfolder, always_sync_deletes):
         """Pass 2: Remove locally deleted messages on dst
@@ -465,6 +641,9 @@ class BaseFolder(object):
         deletelist = filter(lambda uid: uid>=0 \
                                 and not self.uidexists(uid) and (sync_deletes or not dstfolder.uidexists(uid)),
                             statusfolder.getmessageuidlist())
+        if len(deletelist):
+            excluded = self.getexcludeduids(deletelist)
+            deletelist = [uid for uid in deletelist if not uid in excluded]
         if len(deletelist):
             self.ui.deletingmessages(deletelist, [dstfolder])
             if self.repository.account.dryrun:
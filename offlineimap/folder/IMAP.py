@@ -15,14 +15,15 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-import email
+import email.utils
 import random
 import binascii
 import re
 import time
 from sys import exc_info
 from .Base import BaseFolder
-from offlineimap import imaputil, imaplibutil, OfflineImapError
+from offlineimap import imaputil, imaplibutil, msgtransform, headerscan, \
+    OfflineImapError
 from offlineimap.imaplib2 import MonthNames
 
 
@@ -35,6 +36,8 @@ class IMAPFolder(BaseFolder):
         self.root = None # imapserver.root
         self.imapserver = imapserver
         self.messagelist = None
+        self.messagelistpartial = False
+        self.existinguids = None
         self.randomgenerator = random.Random()
         #self.ui is set in BaseFolder
 
@@ -69,7 +72,8 @@ class IMAPFolder(BaseFolder):
         if hasattr(self, '_uidvalidity'):
             # use cached value if existing
             return self._uidvalidity
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname())
         try:
             # SELECT (if not already done) and get current UIDVALIDITY
             self.selectro(imapobj)
@@ -88,7 +92,8 @@ class IMAPFolder(BaseFolder):
         retry = True # Should we attempt another round or exit?
         while retry:
             retry = False
-            imapobj = self.imapserver.acquireconnection()
+            imapobj = self.imapserver.acquireconnection(
+                folder = self.getfullname(), readonly = True)
             try:
                 # Select folder and get number of messages
                 restype, imapdata = imapobj.select(self.getfullname(), True,
@@ -124,8 +129,11 @@ class IMAPFolder(BaseFolder):
         maxsize = self.config.getdefaultint("Account %s" % self.accountname,
                                             "maxsize", -1)
         self.messagelist = {}
+        self.messagelistpartial = (maxage != -1) or (maxsize != -1)
+        self.existinguids = {}
 
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname(), readonly = True)
         try:
             res_type, imapdata = imapobj.select(self.getfullname(), True, True)
             if imapdata == [None] or imapdata[0] == '0':
@@ -181,7 +189,48 @@ class IMAPFolder(BaseFolder):
                         OfflineImapError.ERROR.FOLDER)
         finally:
             self.imapserver.releaseconnection(imapobj)
+        self._parsemessagelist(response)
 
+    def cachenewmessages(self, minuid):
+        """Cache the messages with UIDs from minuid on
+
+        Unlike cachemessagelist(), this leaves out all older messages,
+        so it needs a single UID FETCH of the new ones however large the
+        folder is. getexcludeduids() asks the server about the others.
+
+        :returns: the number of messages in the folder"""
+        self.messagelist = {}
+        self.messagelistpartial = True
+        self.existinguids = {}
+
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname(), readonly = True)
+        try:
+            res_type, imapdata = imapobj.select(self.getfullname(), True, True)
+            # See quickchanged() for missing and multiple EXISTS replies
+            if imapdata == [None]:
+                return 0
+            exists = max(long(msgid) for msgid in imapdata)
+            if not exists:
+                return 0
+            res_type, response = imapobj.uid('fetch', "'%d:*'" % minuid,
+                                             '(FLAGS UID)')
+            if res_type != 'OK':
+                raise OfflineImapError("FETCHING new UIDs in folder [%s]%s "
+                                       "failed. Server responded '[%s] %s'" % (
+                            self.getrepository(), self,
+                            res_type, response),
+                        OfflineImapError.ERROR.FOLDER)
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        self._parsemessagelist(response)
+        # 'n:*' always includes the last message, even below UID n
+        for uid in [uid for uid in self.messagelist if uid < minuid]:
+            del self.messagelist[uid]
+        return exists
+
+    def _parsemessagelist(self, response):
+        """Add the messages of a FETCH (FLAGS UID) response to the list"""
         for messagestr in response:
             # looks like: '1 (FLAGS (\\Seen Old) UID 4807)' or None if no msg
             # Discard initial message number.
@@ -199,9 +248,135 @@ class IMAPFolder(BaseFolder):
                 rtime = imaplibutil.Internaldate2epoch(messagestr)
                 self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
 
+    def getexcludeduids(self, uidlist):
+        """Return the UIDs of uidlist that exist outside the message list
+
+        Asks the server which of them still exist, if maxage or maxsize
+        restricted the cached message list. The answers are kept until
+        the message list is loaded again."""
+        uidlist = [uid for uid in uidlist if uid > 0]
+        if not self.messagelistpartial or not uidlist:
+            return set()
+        unknown = [uid for uid in uidlist if not uid in self.existinguids]
+        if unknown:
+            imapobj = self.imapserver.acquireconnection(
+                folder = self.getfullname(), readonly = True)
+            try:
+                imapobj.select(self.getfullname(), True)
+                existing = set()
+                for sequence in imaputil.uid_sequence_chunks(unknown):
+                    res_type, res_data = imapobj.uid('search', 'UID',
+                                                     sequence)
+                    if res_type != 'OK':
+                        raise OfflineImapError("UID SEARCH in folder [%s]%s "
+                            "failed. Server responded '[%s] %s'" % (
+                                self.getrepository(), self, res_type,
+                                res_data), OfflineImapError.ERROR.FOLDER)
+                    existing.update(long(uid) for uid in
+                                    (res_data[0] or '').split())
+            finally:
+                self.imapserver.releaseconnection(imapobj)
+            for uid in unknown:
+                self.existinguids[uid] = uid in existing
+        return set(uid for uid in uidlist if self.existinguids[uid])
+
     def getmessagelist(self):
         return self.messagelist
 
+    def _fetchheaders(self, uidlist, section):
+        """Fetch RFC822.SIZE and a header section of messages
+
+        UIDs are requested in chunks of the server's batch size, so that
+        the command lines stay short for sparse UID lists.
+
+        :param uidlist: UIDs to look at, all messages if `None`.
+        :param section: e.g. 'HEADER' or 'HEADER.FIELDS (MESSAGE-ID)'
+        :returns: list of (UID, size, headers) tuples"""
+        retval = []
+        query = '(UID RFC822.SIZE BODY.PEEK[%s])' % section
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname(), readonly = True)
+        try:
+            res_type, imapdata = imapobj.select(self.getfullname(), True, True)
+            if imapdata == [None] or imapdata[0] == '0':
+                return retval
+            if uidlist is None:
+                chunks = [None]
+            else:
+                chunks = self._batches(sorted(uidlist))
+            for chunk in chunks:
+                if chunk is None:
+                    res_type, response = imapobj.fetch("'1:*'", query)
+                else:
+                    res_type, response = imapobj.uid('fetch',
+                        imaputil.uid_sequence(chunk), query)
+                if res_type != 'OK':
+                    raise OfflineImapError("FETCHING headers in folder [%s]%s "
+                                           "failed. Server responded '[%s] %s'"
+                                           % (self.getrepository(), self,
+                                              res_type, response),
+                                           OfflineImapError.ERROR.FOLDER)
+                retval.extend(self._parseheaderfetch(response))
+        finally:
+            self.imapserver.releaseconnection(imapobj)
+        return retval
+
+    def _batches(self, uidlist):
+        """Yield slices of `uidlist` of the server's current batch size"""
+        while uidlist:
+            batchsize = self.imapserver.getbatchsize()
+            yield uidlist[:batchsize]
+            uidlist = uidlist[batchsize:]
+
+    def _parseheaderfetch(self, response):
+        """Yield (UID, size, headers) of a _fetchheaders() response"""
+        # The response looks like [('1 (UID 4 RFC822.SIZE 2313 BODY[HEA
+        # DER.FIELDS (MESSAGE-ID DATE)] {64}', 'Message-ID: ...'), ')']
+        # but servers are free to send UID and RFC822.SIZE after the
+        # literal, ie. in the trailing string.
+        meta, headers = None, None
+        for item in response + [None]:
+            if meta is not None and (item is None or isinstance(item, tuple)):
+                uid = re.search('UID\s+(\d+)', meta, flags=re.IGNORECASE)
+                size = re.search('RFC822\.SIZE\s+(\d+)', meta,
+                                 flags=re.IGNORECASE)
+                if uid and size:
+                    yield long(uid.group(1)), long(size.group(1)), headers
+                meta, headers = None, None
+            if isinstance(item, tuple):
+                meta, headers = item[0], item[1]
+            elif item is not None and meta is not None:
+                meta += item
+
+    def getmessageidsizes(self, uidlist=None):
+        """Return Message-ID and size of messages in the folder
+
+        Only the Message-ID and Date header fields are fetched, message
+        bodies are not touched. The size is the RFC822.SIZE as reported
+        by the server, ie. including CRLF line endings.
+
+        :param uidlist: UIDs to look at, all messages if `None`.
+        :returns: dict mapping UID -> (Message-ID, size). Message-ID is
+            `None` if the message has no such header."""
+        retval = {}
+        for uid, size, headers in self._fetchheaders(uidlist,
+                'HEADER.FIELDS (MESSAGE-ID DATE)'):
+            retval[uid] = (imaputil.getmessageid(headers), size)
+        return retval
+
+    def getcontentkeys(self, uidlist):
+        """Return the content keys of messages in the folder
+
+        Fetches the header blocks and RFC822.SIZE of the messages, see
+        folder/Base for details."""
+        retval = {}
+        if not uidlist:
+            return retval
+        for uid, size, headers in self._fetchheaders(uidlist, 'HEADER'):
+            retval[uid] = (imaputil.getmessageid(headers), size,
+                           headerscan.headerdigest(headers))
+        return retval
+
     def getmessage(self, uid):
         """Retrieve message with UID from the IMAP server (incl body)
 
@@ -209,7 +384,8 @@ class IMAPFolder(BaseFolder):
                   (probably severity MESSAGE) if e.g. no message with
                   this UID could be found.
         """
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname(), readonly = True)
         try:
             fails_left = 2 # retry on dropped connection
             while fails_left:
@@ -221,7 +397,8 @@ class IMAPFolder(BaseFolder):
                 except imapobj.abort as e:
                     # Release dropped connection, and get a new one
                     self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
+                    imapobj = self.imapserver.acquireconnection(
+                        folder = self.getfullname(), readonly = True)
                     self.ui.error(e, exc_info()[2])
                     fails_left -= 1
                     if not fails_left:
@@ -237,20 +414,20 @@ class IMAPFolder(BaseFolder):
                     reason = "IMAP server '%s' does not have a message "\
                              "with UID '%s'" % (self.getrepository(), uid)
                 raise OfflineImapError(reason, severity)
-            # data looks now e.g. [('320 (UID 17061 BODY[]
-            # {2565}','msgbody....')]  we only asked for one message,
-            # and that msg is in data[0]. msbody is in [0][1]
-            data = data[0][1].replace("\r\n", "\n")
-
-            if len(data)>200:
-                dbg_output = "%s...%s" % (str(data)[:150],
-                                          str(data)[-50:])
-            else:
-                dbg_output = data
-            self.ui.debug('imap', "Returned object from fetching %d: '%s'" %
-                          (uid, dbg_output))
         finally:
             self.imapserver.releaseconnection(imapobj)
+        # data looks now e.g. [('320 (UID 17061 BODY[]
+        # {2565}','msgbody....')]  we only asked for one message,
+        # and that msg is in data[0]. msbody is in [0][1]
+        data = msgtransform.fromcrlf(data[0][1])
+
+        if len(data)>200:
+            dbg_output = "%s...%s" % (str(data)[:150],
+                                      str(data)[-50:])
+        else:
+            dbg_output = data
+        self.ui.debug('imap', "Returned object from fetching %d: '%s'" %
+                      (uid, dbg_output))
         return data
 
     def getmessagetime(self, uid):
@@ -290,20 +467,7 @@ class IMAPFolder(BaseFolder):
         self.ui.debug('imap',
                  'savemessage_addheader: called to add %s: %s' % (headername,
                                                                   headervalue))
-        insertionpoint = content.find("\r\n\r\n")
-        self.ui.debug('imap', 'savemessage_addheader: insertionpoint = %d' % insertionpoint)
-        leader = content[0:insertionpoint]
-        self.ui.debug('imap', 'savemessage_addheader: leader = %s' % repr(leader))
-        if insertionpoint == 0 or insertionpoint == -1:
-            newline = ''
-            insertionpoint = 0
-        else:
-            newline = "\r\n"
-        newline += "%s: %s" % (headername, headervalue)
-        self.ui.debug('imap', 'savemessage_addheader: newline = ' + repr(newline))
-        trailer = content[insertionpoint:]
-        self.ui.debug('imap', 'savemessage_addheader: trailer = ' + repr(trailer))
-        return leader + newline + trailer
+        return msgtransform.addheader(content, headername, headervalue)
 
 
     def savemessage_searchforheader(self, imapobj, headername, headervalue):
@@ -386,8 +550,8 @@ class IMAPFolder(BaseFolder):
         for item in result:
             if found == 0 and type(item) == type( () ):
                 # Walk just tuples
-                if re.search("(?:^|\\r|\\n)%s:\s*%s(?:\\r|\\n)" % (headername, headervalue),
-                        item[1], flags=re.IGNORECASE):
+                if headervalue in headerscan.getheaderall(item[1],
+                                                       headername):
                     found = 1
             elif found == 1:
                 if type(item) == type (""):
@@ -431,12 +595,12 @@ class IMAPFolder(BaseFolder):
                   (including double quotes) or `None` in case of failure
                   (which is fine as value for append)."""
         if rtime is None:
-            message = email.message_from_string(content)
             # parsedate returns a 9-tuple that can be passed directly to
             # time.mktime(); Will be None if missing or not in a valid
             # format.  Note that indexes 6, 7, and 8 of the result tuple are
             # not usable.
-            datetuple = email.utils.parsedate(message.get('Date'))
+            datetuple = email.utils.parsedate(
+                headerscan.getheader(content, 'Date'))
             if datetuple is None:
                 #could not determine the date, use the local time.
                 return None
@@ -507,16 +671,19 @@ class IMAPFolder(BaseFolder):
             self.savemessageflags(uid, flags)
             return uid
 
+        # get the date of the message, so we can pass it to the server.
+        date = self.getmessageinternaldate(content, rtime)
+        # Convert the message before we occupy a connection
+        crlfcontent = msgtransform.run(msgtransform.tocrlf, content)
+
         retry_left = 2 # succeeded in APPENDING?
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname())
         try:
             while retry_left:
                 # UIDPLUS extension provides us with an APPENDUID response.
                 use_uidplus = 'UIDPLUS' in imapobj.capabilities
-
-                # get the date of the message, so we can pass it to the server.
-                date = self.getmessageinternaldate(content, rtime)
-                content = re.sub("(?<!\r)\n", "\r\n", content)
+                content = crlfcontent
 
                 if not use_uidplus:
                     # insert a random unique header that we can fetch later
@@ -552,7 +719,8 @@ class IMAPFolder(BaseFolder):
                     # connection has been reset, release connection and retry.
                     retry_left -= 1
                     self.imapserver.releaseconnection(imapobj, True)
-                    imapobj = self.imapserver.acquireconnection()
+                    imapobj = self.imapserver.acquireconnection(
+                        folder = self.getfullname())
                     if not retry_left:
                         raise OfflineImapError("Saving msg in folder '%s', "
                               "repository '%s' failed (abort). Server responded: %s\n"
@@ -621,7 +789,8 @@ class IMAPFolder(BaseFolder):
         Note that this function does not check against dryrun settings,
         so you need to ensure that it is never called in a
         dryrun mode."""
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -644,7 +813,8 @@ class IMAPFolder(BaseFolder):
         assert isinstance(remote_newfolder, IMAPFolder)
         assert self.imapserver == remote_newfolder.imapserver # relies on object identity
         # XXX optimization: batch operation
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname())
         # imapobj doesn't clear untagged responses automatically, so we
         # have to clear responses we use to avoid bogus data (by setting
         # leave=False)
@@ -725,13 +895,15 @@ class IMAPFolder(BaseFolder):
         self.processmessagesflags('-', uidlist, flags)
 
     def processmessagesflags(self, operation, uidlist, flags):
-        if len(uidlist) > 101:
+        batchsize = self.imapserver.getbatchsize()
+        if len(uidlist) > batchsize + 1:
             # Hack for those IMAP ervers with a limited line length
-            self.processmessagesflags(operation, uidlist[:100], flags)
-            self.processmessagesflags(operation, uidlist[100:], flags)
+            self.processmessagesflags(operation, uidlist[:batchsize], flags)
+            self.processmessagesflags(operation, uidlist[batchsize:], flags)
             return
 
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -793,7 +965,8 @@ class IMAPFolder(BaseFolder):
             return
 
         self.addmessagesflags_noconvert(uidlist, set('T'))
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname())
         try:
             try:
                 imapobj.select(self.getfullname())
@@ -810,7 +983,8 @@ class IMAPFolder(BaseFolder):
     def doexpunge(self):
         """Manually trigger an expunge, in case we are skipping expunges
         for performance reasons."""
-        imapobj = self.imapserver.acquireconnection()
+        imapobj = self.imapserver.acquireconnection(
+            folder = self.getfullname())
         try:
             imapobj.select(self.getfullname())
             r = imapobj.expunge()[0]
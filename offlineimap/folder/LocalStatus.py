@@ -24,11 +24,9 @@ magicline = "OFFLINEIMAP LocalStatus CACHE DATA - DO NOT MODIFY - FORMAT 1"
 # This implementation is pretty bone-headed:
 #   1. It loads up the entire repository into memory, and has to write
 #      the entire thing back again, even if only one line changed.
-#   2. If maxage is set, all of the entries past maxage get nuked.
-#      If you remove the maxage entry, all of localstatus needs to
-#      be reinitialized (which means we need to cross-check localstatus
-#      and remotestatus).  God help you if the sources desynced while
-#      maxage was on; then you might end up uploading A LOT of mail.
+#   2. If maxage is set, entries past maxage are kept, as the folders
+#      report such messages via getexcludeduids() instead of having them
+#      look deleted.
 class LocalStatusFolder(BaseFolder):
     def __init__(self, name, repository):
         self.sep = '.' #needs to be set before super.__init__()
@@ -140,6 +138,27 @@ class LocalStatusFolder(BaseFolder):
         self.save()
         return uid
 
+    def addmessages(self, messages):
+        """Add many messages to the status cache in one go
+
+        Existing entries get their flags replaced.
+
+        :param messages: dict mapping UID -> set() of flags"""
+        if not len(messages):
+            return
+        for uid, flags in messages.items():
+            self.messagelist[uid] = {'uid': uid, 'flags': flags}
+        self.save()
+
+    def replacemessagelist(self, messages):
+        """Replace the complete status cache with new content
+
+        :param messages: dict mapping UID -> set() of flags"""
+        self.messagelist = {}
+        for uid, flags in messages.items():
+            self.messagelist[uid] = {'uid': uid, 'flags': flags}
+        self.save()
+
     def getmessageflags(self, uid):
         return self.messagelist[uid]['flags']
 
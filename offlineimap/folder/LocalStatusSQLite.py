@@ -46,6 +46,8 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         super(LocalStatusSQLiteFolder, self).__init__(name, repository)       
         # dblock protects against concurrent writes in same connection
         self._dblock = Lock()
+        # entries saved by savemessagefast(), written by save()
+        self._pending = {}
         #Try to establish connection, no need for threadsafety in __init__
         try:
             self.connection = sqlite.connect(self.filename, check_same_thread = False)
@@ -78,20 +80,31 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         :param executemany: bool indicating whether we want to
             perform conn.executemany() or conn.execute().
         :returns: the Cursor() or raises an Exception"""
+        return self.sql_transaction([(sql, vars, executemany)])
+
+    def sql_transaction(self, statements):
+        """Execute several statements in one transaction, retrying if
+        the db was locked.
+
+        :param statements: list of (sql, vars, executemany) tuples, see
+            :meth:`sql_write`
+        :returns: the Cursor() of the last statement or raises an
+            Exception"""
         success = False
         while not success:
             self._dblock.acquire()
             try:
-                if vars is None:
-                    if executemany:
-                        cursor = self.connection.executemany(sql)
+                for sql, vars, executemany in statements:
+                    if vars is None:
+                        if executemany:
+                            cursor = self.connection.executemany(sql)
+                        else:
+                            cursor = self.connection.execute(sql)
                     else:
-                        cursor = self.connection.execute(sql)
-                else:
-                    if executemany:
-                        cursor = self.connection.executemany(sql, vars)
-                    else:
-                        cursor = self.connection.execute(sql, vars)
+                        if executemany:
+                            cursor = self.connection.executemany(sql, vars)
+                        else:
+                            cursor = self.connection.execute(sql, vars)
                 success = True
                 self.connection.commit()
             except sqlite.OperationalError as e:
@@ -99,9 +112,16 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
                     pass
                 elif e.args[0] == 'database is locked':
                     self.ui.debug('', "Locked sqlite database, retrying.")
+                    self.connection.rollback()
                     success = False
                 else:
+                    # don't leave the statements executed so far to
+                    # the next commit
+                    self.connection.rollback()
                     raise
+            except sqlite.Error:
+                self.connection.rollback()
+                raise
             finally:
                 self._dblock.release()
         return cursor
@@ -166,6 +186,8 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
 
     def deletemessagelist(self):
         """delete all messages in the db"""
+        with self.savelock:
+            self._pending = {}
         self.sql_write('DELETE FROM status')
 
     def cachemessagelist(self):
@@ -176,8 +198,27 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
                 self.messagelist[row[0]] = {'uid': row[0], 'flags': flags}
 
     def save(self):
-        #Noop in this backend
-        pass
+        """Write the entries cached by savemessagefast()
+
+        All other changes are written immediately in this backend."""
+        with self.savelock:
+            pending, self._pending = self._pending, {}
+        if not len(pending):
+            return
+        data = [(uid, ''.join(sorted(flags))) for uid, flags in pending.items()]
+        self.sql_write('INSERT OR REPLACE INTO status (id,flags) VALUES (?,?)',
+                       data, True)
+
+    def savemessagefast(self, uid, content, flags, rtime):
+        """Cache a message's status, it gets written by the next save()
+
+        This allows to write many entries in one executemany() call."""
+        if uid < 0:
+            return uid
+        self.messagelist[uid] = {'uid': uid, 'flags': flags, 'time': rtime}
+        with self.savelock:
+            self._pending[uid] = flags
+        return uid
 
     # Following some pure SQLite functions, where we chose to use
     # BaseFolder() methods instead. Doing those on the in-memory list is
@@ -225,6 +266,7 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
             # We cannot assign a uid.
             return uid
 
+        self.save() # write pending entries first, they may be outdated
         if self.uidexists(uid):     # already have it
             self.savemessageflags(uid, flags)
             return uid
@@ -235,7 +277,41 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
                          (uid,flags))
         return uid
 
+    def addmessages(self, messages):
+        """Add many messages to the status cache in one go
+
+        Uses executemany() to write all entries in one transaction.
+
+        :param messages: dict mapping UID -> set() of flags"""
+        if not len(messages):
+            return
+        self.save()
+        data = []
+        for uid, flags in messages.items():
+            self.messagelist[uid] = {'uid': uid, 'flags': flags}
+            data.append((uid, ''.join(sorted(flags))))
+        self.sql_write('INSERT OR REPLACE INTO status (id,flags) VALUES (?,?)',
+                       data, True)
+
+    def replacemessagelist(self, messages):
+        """Replace the complete status cache with new content
+
+        Deletes the old and inserts all new entries in one transaction.
+
+        :param messages: dict mapping UID -> set() of flags"""
+        with self.savelock:
+            self._pending = {}
+        self.messagelist = {}
+        data = []
+        for uid, flags in messages.items():
+            self.messagelist[uid] = {'uid': uid, 'flags': flags}
+            data.append((uid, ''.join(sorted(flags))))
+        self.sql_transaction([
+                ('DELETE FROM status', None, False),
+                ('INSERT INTO status (id,flags) VALUES (?,?)', data, True)])
+
     def savemessageflags(self, uid, flags):
+        self.save()
         self.messagelist[uid] = {'uid': uid, 'flags': flags}
         flags = ''.join(sorted(flags))
         self.sql_write('UPDATE status SET flags=? WHERE id=?',(flags,uid))
@@ -243,6 +319,7 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
     def deletemessage(self, uid):
         if not uid in self.messagelist:
             return
+        self.save()
         self.sql_write('DELETE FROM status WHERE id=?', (uid, ))
         del(self.messagelist[uid])
 
@@ -256,6 +333,7 @@ class LocalStatusSQLiteFolder(LocalStatusFolder):
         uidlist = [uid for uid in uidlist if uid in self.messagelist]
         if not len(uidlist):
             return
+        self.save()
         # arg2 needs to be an iterable of 1-tuples [(1,),(2,),...]
         self.sql_write('DELETE FROM status WHERE id=?', zip(uidlist, ), True)
         for uid in uidlist:
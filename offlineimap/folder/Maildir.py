@@ -19,6 +19,7 @@ import socket
 import time
 import re
 import os
+import shutil
 from .Base import BaseFolder
 from threading import Lock
 
@@ -32,7 +33,7 @@ try: # python 2.6 has set() built in
 except NameError:
     from sets import Set as set
 
-from offlineimap import OfflineImapError
+from offlineimap import imaputil, headerscan, OfflineImapError
 
 # Find the UID in a message filename
 re_uidmatch = re.compile(',U=(\d+)')
@@ -65,6 +66,13 @@ class MaildirFolder(BaseFolder):
         self.dofsync = self.config.getdefaultboolean("general", "fsync", True)
         self.root = root
         self.messagelist = None
+        self._newonly = False
+        """Whether the messagelist only holds messages added since
+        cachenewmessages(), so that cachemessagelist() has to scan"""
+        self.excludeduids = set()
+        """UIDs of messages left out of the messagelist by maxage/maxsize"""
+        self._unsynced = None
+        """UIDs of messages not fsync'ed yet, None unless deferring"""
         # check if we should use a different infosep to support Win file systems
         self.wincompatible = self.config.getdefaultboolean(
             "Account "+self.accountname, "maildir-windows-compatible", False)
@@ -163,15 +171,18 @@ class MaildirFolder(BaseFolder):
             files.extend((dirannex, filename) for
                          filename in os.listdir(fulldirname))
         blacklist = set()
+        excluded = set()
 
         for dirannex, filename in files:
             # We store just dirannex and filename, ie 'cur/123...'
             filepath = os.path.join(dirannex, filename)
             # check maxage/maxsize if this message should be considered
-            if maxage and not self._iswithinmaxage(filename, maxage):
-                continue
-            if maxsize and (os.path.getsize(os.path.join(
-                        self.getfullname(), filepath)) > maxsize):
+            if (maxage and not self._iswithinmaxage(filename, maxage)) or \
+                    (maxsize and (os.path.getsize(os.path.join(
+                        self.getfullname(), filepath)) > maxsize)):
+                uidmatch = re_uidmatch.search(filename)
+                if uidmatch:
+                    excluded.add(long(uidmatch.group(1)))
                 continue
 
             (prefix, uid, fmd5, flags) = self._parse_filename(filename)
@@ -203,6 +214,7 @@ class MaildirFolder(BaseFolder):
                 nouidcounter -= 1
             else:
                 retval[uid] = {'flags': flags, 'filename': filepath}
+        self.excludeduids = excluded
         return retval
 
     def quickchanged(self, statusfolder):
@@ -219,12 +231,27 @@ class MaildirFolder(BaseFolder):
         return False  #Nope, nothing changed
 
     def cachemessagelist(self):
-        if self.messagelist is None:
+        if self.messagelist is None or self._newonly:
             self.messagelist = self._scanfolder()
+            self._newonly = False
+
+    def cachenewmessages(self, minuid):
+        """Prepare to save the messages with UIDs from minuid on
+
+        Finding the UIDs in a Maildir means listing all of its files.
+        The caller knows from the status folder that no message with a
+        UID from minuid on is stored yet, so we start from an empty
+        message list if none has been loaded."""
+        if self.messagelist is None:
+            self.messagelist = {}
+            self._newonly = True
 
     def getmessagelist(self):
         return self.messagelist
 
+    def getexcludeduids(self, uidlist):
+        return self.excludeduids.intersection(uidlist)
+
     def getmessage(self, uid):
         """Return the content of the message"""
         filename = self.messagelist[uid]['filename']
@@ -236,6 +263,37 @@ class MaildirFolder(BaseFolder):
         #      read it as text?
         return retval.replace("\r\n", "\n")
 
+    def getmessageidsizes(self, uidlist=None):
+        """Return Message-ID and size of messages in the folder
+
+        The size is the one the message would have on an IMAP server,
+        ie. with CRLF line endings, so it can be compared to
+        RFC822.SIZE. See folder/Base for details."""
+        retval = {}
+        if uidlist is None:
+            uidlist = self.getmessageuidlist()
+        for uid in uidlist:
+            retval[uid] = self._getidsize(self.getmessage(uid))
+        return retval
+
+    def _getidsize(self, content):
+        """Return (Message-ID, IMAP size) of a message's content"""
+        return (imaputil.getmessageid(content),
+                len(content) + content.count("\n"))
+
+    def getcontentkeys(self, uidlist):
+        """Return the content keys of messages in the folder
+
+        See folder/Base for details."""
+        retval = {}
+        for uid in uidlist:
+            retval[uid] = self._getcontentkey(self.getmessage(uid))
+        return retval
+
+    def _getcontentkey(self, content):
+        """Return the content key of a message's content"""
+        return self._getidsize(content) + (headerscan.headerdigest(content),)
+
     def getmessagetime(self, uid):
         filename = self.messagelist[uid]['filename']
         filepath = os.path.join(self.getfullname(), filename)
@@ -291,7 +349,7 @@ class MaildirFolder(BaseFolder):
         file.write(content)
         # Make sure the data hits the disk
         file.flush()
-        if self.dofsync:
+        if self.dofsync and self._unsynced is None:
             os.fsync(fd)
         file.close()
 
@@ -300,11 +358,127 @@ class MaildirFolder(BaseFolder):
 
         self.messagelist[uid] = {'flags': flags,
                                  'filename': os.path.join('tmp', messagename)}
-        # savemessageflags moves msg to 'cur' or 'new' as appropriate
-        self.savemessageflags(uid, flags)
+        if self._unsynced is not None:
+            # fsyncbarrier() moves it into place once it is on disk
+            self._unsynced[uid] = flags
+        else:
+            # savemessageflags moves msg to 'cur' or 'new' as appropriate
+            self.savemessageflags(uid, flags)
+        contentindex = self.repository.getcontentindex()
+        if contentindex is not None:
+            contentindex.add(self._getcontentkey(content),
+                md5(content).hexdigest(),
+                os.path.join(self.getfullname(),
+                             self.messagelist[uid]['filename']))
         self.ui.debug('maildir', 'savemessage: returning uid %d' % uid)
         return uid
 
+    def deferfsync(self, defer = True):
+        """Stop (or resume) fsync'ing each saved message right away
+
+        See folder/Base for details. Only has an effect if the fsync
+        option is enabled."""
+        if defer and self.dofsync:
+            if self._unsynced is None:
+                self._unsynced = {}
+        elif not defer:
+            self.fsyncbarrier()
+            self._unsynced = None
+
+    def _fsync(self, path):
+        fd = os.open(os.path.join(self.getfullname(), path), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def fsyncbarrier(self):
+        """fsync all messages saved since deferfsync() and new|cur
+
+        Until then, these messages are left in tmp/, so that a crash
+        cannot leave truncated files in cur/ or new/ (which would be
+        taken for complete messages by the next sync). Each one is
+        moved into place after its fsync."""
+        if not self._unsynced:
+            return
+        unsynced, self._unsynced = self._unsynced, {}
+        for uid, nameflags in unsynced.items():
+            if not uid in self.messagelist:
+                continue # deleted in the meantime
+            self._fsync(self.messagelist[uid]['filename'])
+            # The file name still carries the flags it was saved with
+            flags = self.messagelist[uid]['flags']
+            self.messagelist[uid]['flags'] = nameflags
+            self.savemessageflags(uid, flags)
+        for path in ['new', 'cur']:
+            self._fsync(path)
+
+    def _findindexedfile(self, path):
+        """Return the current path of a file recorded in the content index
+
+        The file might have been moved between new/ and cur/ or got
+        different flags since it was indexed, so look for its unique
+        part (everything up to the info separator) if needed. The
+        repository caches the directory listings for that.
+
+        :returns: path or `None` if the file is gone."""
+        if os.path.exists(path):
+            return path
+        folderpath = os.path.dirname(os.path.dirname(path))
+        prefix = os.path.basename(path).split(self.infosep, 1)[0]
+        for dirannex in ['cur', 'new']:
+            filenames = self.repository.getfilenames(
+                os.path.join(folderpath, dirannex), self.infosep)
+            if prefix in filenames:
+                return os.path.join(folderpath, dirannex, filenames[prefix])
+        return None
+
+    def linkmessage(self, uid, key, flags, rtime):
+        """Store a message as hardlink to an identical local copy
+
+        Looks up the content key in the account's content index and, if
+        the indexed file still exists with the recorded MD5, links it
+        into our tmp/ and moves it into place like savemessage(). Hard
+        links share their modification time, so if the copy needs a
+        different one (`rtime`), the file is copied instead. See
+        folder/Base for details."""
+        contentindex = self.repository.getcontentindex()
+        if contentindex is None or key[0] is None or uid < 0 or \
+                uid in self.messagelist:
+            return False
+        entry = contentindex.get(key)
+        if entry is None:
+            return False
+        srcpath = self._findindexedfile(entry[1])
+        if srcpath is None:
+            return False
+        with open(srcpath, 'rt') as file:
+            if md5(file.read()).hexdigest() != entry[0]:
+                return False # modified since it was indexed
+        if srcpath != entry[1]:
+            contentindex.add(key, entry[0], srcpath)
+        messagename = self.new_message_filename(uid, flags)
+        tmpname = os.path.join('tmp', messagename)
+        tmppath = os.path.join(self.getfullname(), tmpname)
+        try:
+            if rtime is None or int(os.path.getmtime(srcpath)) == int(rtime):
+                os.link(srcpath, tmppath)
+            else:
+                shutil.copyfile(srcpath, tmppath)
+                os.utime(tmppath, (rtime, rtime))
+        except (OSError, IOError) as e:
+            # e.g. cross-device links, fall back to downloading
+            self.ui.debug('maildir', "linkmessage: could not link '%s': %s" %
+                          (srcpath, e))
+            if os.path.exists(tmppath):
+                os.unlink(tmppath)
+            return False
+        self.ui.debug('maildir', "linkmessage: uid %d linked to '%s'" %
+                      (uid, srcpath))
+        self.messagelist[uid] = {'flags': flags, 'filename': tmpname}
+        self.savemessageflags(uid, flags)
+        return True
+
     def getmessageflags(self, uid):
         return self.messagelist[uid]['flags']
 
@@ -338,6 +512,10 @@ class MaildirFolder(BaseFolder):
         Note that this function does not check against dryrun settings,
         so you need to ensure that it is never called in a
         dryrun mode."""
+        if self._unsynced and uid in self._unsynced:
+            # Still in tmp/, fsyncbarrier() will apply the flags
+            self.messagelist[uid]['flags'] = flags
+            return
         oldfilename = self.messagelist[uid]['filename']
         dir_prefix, filename = os.path.split(oldfilename)
         # If a message has been seen, it goes into 'cur'
@@ -384,8 +562,55 @@ class MaildirFolder(BaseFolder):
         os.rename(os.path.join(self.getfullname(), oldfilename),
                   os.path.join(self.getfullname(), dir_prefix, filename))
         self.messagelist[new_uid] = self.messagelist[uid]
+        self.messagelist[new_uid]['filename'] = os.path.join(dir_prefix,
+                                                             filename)
         del self.messagelist[uid]
         
+    def movemessageto(self, uid, dstfolder, new_uid):
+        """Move a message file into another Maildir folder
+
+        The message keeps its flags and gets `new_uid` in `dstfolder`.
+        This does not update any statusfolder.
+
+        :returns: True on success, False if the file could not be
+            renamed (e.g. as the folders are on different devices)."""
+        oldfilename = self.messagelist[uid]['filename']
+        flags = self.getmessageflags(uid)
+        dir_prefix = 'cur' if 'S' in flags else 'new'
+        newfilename = os.path.join(dir_prefix,
+                                   dstfolder.new_message_filename(new_uid, flags))
+        try:
+            os.rename(os.path.join(self.getfullname(), oldfilename),
+                      os.path.join(dstfolder.getfullname(), newfilename))
+        except OSError as e:
+            self.ui.debug('maildir', "movemessageto: can't move '%s' to "
+                          "'%s': %s" % (oldfilename, dstfolder, e))
+            return False
+        del self.messagelist[uid]
+        dstfolder.messagelist[new_uid] = {'flags': flags,
+                                          'filename': newfilename}
+        return True
+
+    def change_message_uids(self, uidmap):
+        """Change the UIDs of many messages at once
+
+        Unlike repeated :meth:`change_message_uid` calls, this works
+        even if a new UID is identical to the old UID of another message
+        in `uidmap`. It does not update the statusfolder either.
+
+        :param uidmap: dict mapping old UID -> new UID. New UIDs must be
+            unique."""
+        pending = {}
+        for uid in uidmap:
+            pending[uid] = self.messagelist.pop(uid)
+        for uid, new_uid in uidmap.items():
+            # An already renamed message might occupy 'uid' by now.
+            displaced = self.messagelist.pop(uid, None)
+            self.messagelist[uid] = pending[uid]
+            self.change_message_uid(uid, new_uid)
+            if displaced is not None:
+                self.messagelist[uid] = displaced
+
     def deletemessage(self, uid):
         """Unlinks a message file from the Maildir.
 
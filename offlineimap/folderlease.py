@@ -0,0 +1,209 @@
+# Folder leases shared between several offlineimap processes
+# Copyright (C) 2012 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import errno
+import os
+import socket
+import time
+import urllib
+from threading import Event, Lock, Thread, currentThread
+from offlineimap.error import OfflineImapError
+
+
+class FolderLeases(object):
+    """Leases on the folders of one account
+
+    Several processes (possibly on different hosts sharing the metadata
+    directory) can sync the same account if each folder is only synced
+    by the process holding its lease. A lease is a file in `directory`
+    that is created with O_EXCL and contains the owner's host name and
+    PID. It is valid for `duration` seconds after its last
+    modification; while we hold leases, a background thread renews them
+    by touching the files. Expired leases (e.g. of crashed processes)
+    can be taken over by other processes, so holders need to
+    :meth:`check` that they still own a lease before they write.
+
+    The lease named :attr:`ACCOUNT` is not a folder, but allows one
+    process to carry out account wide work."""
+
+    ACCOUNT = None
+    """Name of the account wide lease"""
+
+    RETRIES = (0.01, 0.02, 0.05, 0.1, 0.2)
+    """Delays between looking again for a lease file that is missing"""
+
+    def __init__(self, directory, duration):
+        self.directory = directory
+        self.duration = duration
+        self.owner = "%s %d" % (socket.gethostname(), os.getpid())
+        self.held = {}
+        self.lock = Lock()
+        self._stop = None
+        self._renewer = None
+        if not os.path.exists(directory):
+            try:
+                os.mkdir(directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, foldername):
+        if foldername is self.ACCOUNT:
+            # ':' is quoted in folder lease names, so this is unique
+            return os.path.join(self.directory, ':account.lease')
+        return os.path.join(self.directory,
+                            urllib.quote(foldername, safe='') + '.lease')
+
+    def _expired(self, path):
+        try:
+            return os.stat(path).st_mtime + self.duration < time.time()
+        except OSError:
+            return True
+
+    def _retry(self, func, path):
+        """Return func(path), retrying while the file is missing
+
+        A process breaking a stale lease renames the file away for a
+        moment, and puts it back if it turns out to have been renewed."""
+        for delay in self.RETRIES + (None,):
+            try:
+                return func(path)
+            except (IOError, OSError) as e:
+                if e.errno != errno.ENOENT or delay is None:
+                    raise
+            time.sleep(delay)
+
+    def _owns(self, path):
+        def read(path):
+            with open(path, 'rt') as file:
+                return file.read().strip()
+        try:
+            return self._retry(read, path) == self.owner
+        except (IOError, OSError):
+            return False
+
+    def _create(self, path):
+        """Create the lease file, return False if it exists already"""
+        try:
+            fd = os.open(path, os.O_CREAT|os.O_EXCL|os.O_WRONLY, 0o600)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        os.write(fd, self.owner + '\n')
+        os.close(fd)
+        return True
+
+    def acquire(self, foldername):
+        """Try to get the lease on a folder
+
+        :returns: True if we hold the lease now, False if another
+            process holds it."""
+        with self.lock:
+            if foldername in self.held:
+                return True
+            path = self._path(foldername)
+            if not self._create(path):
+                if not self._expired(path):
+                    return False
+                # Only one of the processes breaking a stale lease can
+                # win the rename. Check again, in case it was renewed.
+                stale = "%s.%s.stale" % (path, self.owner.replace(' ', '.'))
+                try:
+                    os.rename(path, stale)
+                except OSError:
+                    return False
+                try:
+                    if not self._expired(stale):
+                        try:
+                            os.link(stale, path) # put it back
+                        except OSError:
+                            pass
+                        return False
+                finally:
+                    os.unlink(stale)
+                if not self._create(path):
+                    return False
+            self.held[foldername] = path
+            if self._renewer is None:
+                # every renewer has its own flag, so that one which is
+                # still stopping can't miss it
+                self._stop = Event()
+                self._renewer = Thread(target = self._renewloop,
+                                       args = (self._stop,),
+                                       name = "Folder lease renewal")
+                self._renewer.setDaemon(True)
+                self._renewer.start()
+            return True
+
+    def _renewloop(self, stop):
+        while True:
+            # Event.wait() only returns the flag from Python 2.7 on
+            stop.wait(self.duration / 3.0)
+            if stop.isSet():
+                break
+            self.renew()
+
+    def renew(self):
+        """Extend all leases we hold, dropping those we lost"""
+        with self.lock:
+            for foldername, path in self.held.items():
+                if self._owns(path):
+                    try:
+                        self._retry(lambda path: os.utime(path, None), path)
+                        continue
+                    except OSError:
+                        pass
+                del self.held[foldername]
+
+    def holds(self, foldername):
+        """Return whether we still own the lease on a folder
+
+        A lease we did not renew in time may have been taken over by
+        another process."""
+        with self.lock:
+            if not foldername in self.held:
+                return False
+            if self._owns(self.held[foldername]):
+                return True
+            del self.held[foldername]
+            return False
+
+    def check(self, foldername):
+        """Raise an :exc:`OfflineImapError` if we lost a folder's lease"""
+        if not self.holds(foldername):
+            raise OfflineImapError("Lost the lease on folder '%s' to "
+                                   "another process" % foldername,
+                                   OfflineImapError.ERROR.FOLDER)
+
+    def releaseall(self):
+        """Give up all leases we hold"""
+        with self.lock:
+            for path in self.held.values():
+                if not self._owns(path):
+                    continue # taken over after it expired
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            self.held = {}
+            renewer, self._renewer = self._renewer, None
+            if renewer is not None:
+                self._stop.set()
+        # Wait for the renewer outside the lock it may be waiting for
+        if renewer is not None and renewer is not currentThread():
+            renewer.join()
@@ -0,0 +1,124 @@
+# Per-folder change statistics and sync scheduling
+# Copyright (C) 2012 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+import math
+import os
+import time
+import urllib
+from threading import Lock
+
+
+class FolderStats(object):
+    """Change statistics of the folders of one account
+
+    For each folder we keep when it was last synced, when a sync last
+    changed anything, how long the last sync took, and its change rate.
+    The rate is the number of syncs that found changes per second of
+    observed time, with older observations decaying with a half-life of
+    `HALFLIFE` seconds. From it, :meth:`likelihood` estimates how
+    likely a folder has changed since its last sync, assuming changes
+    arrive as a Poisson process.
+
+    The statistics are kept in the file `path` in the metadata
+    directory, one line per folder."""
+
+    HALFLIFE = 7 * 24 * 3600
+    """Observations lose half of their weight after a week"""
+
+    def __init__(self, path, refresh=None):
+        """
+        :param refresh: function returning the refresh interval of a
+            folder name in minutes, or None to sync it every time"""
+        self.path = path
+        self.refresh = refresh
+        self.lock = Lock()
+        self.folders = {}
+        """dict of folder name -> [lastsync, lastchange, changes,
+        observed, duration]"""
+        try:
+            with open(path, 'rt') as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) != 6:
+                        continue
+                    self.folders[urllib.unquote(fields[0])] = \
+                        [float(value) for value in fields[1:]]
+        except (IOError, ValueError):
+            self.folders = {}
+
+    def record(self, foldername, start, changed):
+        """Record a sync of folder `foldername`
+
+        :param start: time the sync started
+        :param changed: whether the sync found any changes"""
+        now = time.time()
+        with self.lock:
+            stats = self.folders.get(foldername)
+            if stats is None:
+                stats = self.folders[foldername] = [start, 0.0, 0.0, 0.0, 0.0]
+            else:
+                interval = max(start - stats[0], 0.0)
+                decay = 0.5 ** (interval / self.HALFLIFE)
+                stats[2] = stats[2] * decay + (1 if changed else 0)
+                stats[3] = stats[3] * decay + interval
+                stats[0] = start
+            if changed:
+                stats[1] = start
+            stats[4] = now - start
+
+    def likelihood(self, foldername, now=None):
+        """Return the probability that a folder changed since its last
+        sync, 1 for folders we know nothing about"""
+        stats = self.folders.get(foldername)
+        if stats is None or not stats[3]:
+            return 1.0
+        rate = stats[2] / stats[3]
+        since = max((now or time.time()) - stats[0], 0.0)
+        return 1.0 - math.exp(-rate * since)
+
+    def isdue(self, foldername, now=None):
+        """Return whether a folder's refresh interval has passed"""
+        stats = self.folders.get(foldername)
+        if self.refresh is None or stats is None:
+            return True
+        interval = self.refresh(foldername)
+        if interval is None:
+            return True
+        return (now or time.time()) - stats[0] >= interval * 60
+
+    def schedule(self, folders):
+        """Return the due ones of `folders`, most likely changed first
+
+        Folders with the same likelihood, e.g. new ones, are ordered by
+        the duration of their last sync, quick ones first. The folders
+        are matched by their visible name."""
+        now = time.time()
+        due = [folder for folder in folders
+               if self.isdue(folder.getvisiblename(), now)]
+        def key(folder):
+            name = folder.getvisiblename()
+            duration = self.folders.get(name, [0.0] * 5)[4]
+            return (-self.likelihood(name, now), duration)
+        return sorted(due, key = key)
+
+    def save(self):
+        with self.lock:
+            with open(self.path + '.tmp', 'wt') as file:
+                for name, stats in sorted(self.folders.items()):
+                    file.write("%s %s\n" % (urllib.quote(name, safe=''),
+                        ' '.join("%.3f" % value for value in stats)))
+            os.rename(self.path + '.tmp', self.path)
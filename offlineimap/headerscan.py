@@ -0,0 +1,97 @@
+# Fast scanning of message header blocks
+# Copyright (C) 2012 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Extraction of header fields from raw messages
+
+We only ever need a few header fields (Date, Message-ID, X-OfflineIMAP)
+of a message. The email package parses the whole message including all
+MIME parts for that, these functions only look at the header block and
+never at the body. Messages may use LF or CRLF line endings."""
+
+import re
+from hashlib import md5
+
+_blankline = re.compile(r'\n\r?\n')
+
+
+def headerend(content):
+    """Return the offset of the empty line that ends the header block
+
+    content[:offset] are the header lines, including their line breaks.
+    If there is no empty line, the whole content is the header block."""
+    if content.startswith('\n') or content.startswith('\r\n'):
+        return 0
+    match = _blankline.search(content)
+    if match is None:
+        return len(content)
+    return match.start() + 1
+
+
+def _fields(content):
+    """Yield (lower case name, unfolded value) of all header fields"""
+    name = None
+    for line in content[:headerend(content)].splitlines():
+        if line[:1] in (' ', '\t'):
+            if name is not None:
+                value += line
+            continue
+        if name is not None:
+            yield name, value.strip()
+        name, sep, value = line.partition(':')
+        name = name.rstrip().lower() if sep else None
+    if name is not None:
+        yield name, value.strip()
+
+
+def getheaders(content, names):
+    """Return the values of the header fields `names` of a message
+
+    Continuation lines are unfolded, and values are stripped of
+    surrounding white space. If a field occurs several times, the first
+    one counts.
+
+    :param content: a message or its header block
+    :param names: the (case insensitive) field names to look for
+    :returns: dict mapping the found ones of `names` to their values"""
+    wanted = dict((name.lower(), name) for name in names)
+    values = {}
+    for name, value in _fields(content):
+        name = wanted.get(name)
+        if name is not None and name not in values:
+            values[name] = value
+    return values
+
+
+def getheader(content, name):
+    """Return the value of header field `name` of a message or `None`"""
+    return getheaders(content, (name,)).get(name)
+
+
+def headerdigest(content):
+    """Return the MD5 hex digest of the header block of a message
+
+    Line endings are normalised, so a message stored with LF line
+    endings has the same digest as its CRLF copy on an IMAP server (as
+    returned for BODY[HEADER])."""
+    headers = content[:headerend(content)].replace('\r\n', '\n')
+    return md5(headers.rstrip('\n')).hexdigest()
+
+
+def getheaderall(content, name):
+    """Return the values of all occurrences of header field `name`"""
+    name = name.lower()
+    return [value for field, value in _fields(content) if field == name]
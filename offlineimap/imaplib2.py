@@ -90,7 +90,7 @@ Commands = {
         'GETQUOTA':     ((AUTH, SELECTED),            True),
         'GETQUOTAROOT': ((AUTH, SELECTED),            True),
         'ID':           ((NONAUTH, AUTH, LOGOUT, SELECTED),   True),
-        'IDLE':         ((SELECTED,),                 False),
+        'IDLE':         ((AUTH, SELECTED),            False),
         'LIST':         ((AUTH, SELECTED),            True),
         'LOGIN':        ((NONAUTH,),                  False),
         'LOGOUT':       ((NONAUTH, AUTH, LOGOUT, SELECTED),   False),
@@ -348,18 +348,7 @@ class IMAP4(object):
         self.commands_lock = threading.Lock()
         self.idle_lock = threading.Lock()
 
-        self.ouq = Queue.Queue(10)
-        self.inq = Queue.Queue()
-
-        self.wrth = threading.Thread(target=self._writer)
-        self.wrth.setDaemon(True)
-        self.wrth.start()
-        self.rdth = threading.Thread(target=self._reader)
-        self.rdth.setDaemon(True)
-        self.rdth.start()
-        self.inth = threading.Thread(target=self._handler)
-        self.inth.setDaemon(True)
-        self.inth.start()
+        self._start_threads()
 
         # Get server welcome message,
         # request and store CAPABILITY response.
@@ -375,9 +364,12 @@ class IMAP4(object):
             else:
                 raise self.error('unrecognised server welcome message: %s' % `self.welcome`)
 
-            typ, dat = self.capability()
-            if dat == [None]:
-                raise self.error('no CAPABILITY response from server')
+            # Many servers announce their capabilities in the greeting
+            dat = self._get_untagged_response('CAPABILITY')
+            if not dat:
+                typ, dat = self.capability()
+                if dat == [None]:
+                    raise self.error('no CAPABILITY response from server')
             self.capabilities = tuple(dat[-1].upper().split())
             if __debug__: self._log(1, 'CAPABILITY: %r' % (self.capabilities,))
 
@@ -498,6 +490,18 @@ class IMAP4(object):
         return self.decompressor.decompress(data, size)
 
 
+    def read_into(self, buf):
+        """n = read_into(buf)
+        Read at most len(buf) bytes from remote into the writable buffer 'buf'."""
+
+        if self.decompressor is None:
+            return self.sock.recv_into(buf)
+
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
     def send(self, data):
         """send(data)
         Send 'data' to remote."""
@@ -610,8 +614,8 @@ class IMAP4(object):
             self._release_state_change()
 
 
-    def authenticate(self, mechanism, authobject, **kw):
-        """(typ, [data]) = authenticate(mechanism, authobject)
+    def authenticate(self, mechanism, authobject, initial_response=None, **kw):
+        """(typ, [data]) = authenticate(mechanism, authobject, initial_response=None)
         Authenticate command - requires response processing.
 
         'mechanism' specifies which authentication mechanism is to
@@ -625,11 +629,18 @@ class IMAP4(object):
         It will be called to process server continuation responses.
         It should return data that will be encoded and sent to server.
         It should return None if the client abort response '*' should
-        be sent instead."""
+        be sent instead.
+
+        'initial_response', if not None, is sent along with the command
+        (RFC 4959, the server must have the SASL-IR capability), saving
+        the round trip for the server's first (empty) challenge."""
 
-        self.literal = _Authenticator(authobject).process
+        authenticator = _Authenticator(authobject)
+        if initial_response is not None:
+            initial_response = authenticator.encode(initial_response) or '='
+        self.literal = authenticator.process
         try:
-            typ, dat = self._simple_command('AUTHENTICATE', mechanism.upper())
+            typ, dat = self._simple_command('AUTHENTICATE', mechanism.upper(), initial_response)
             if typ != 'OK':
                 self._deliver_exc(self.error, dat[-1], kw)
             self.state = AUTH
@@ -1061,15 +1072,13 @@ class IMAP4(object):
             typ, dat = self._simple_command(name)
         finally:
             self._release_state_change()
-            self.rdth.join()
+            self._join_reader()
             self.TerminateReader = False
             self.read_size = READ_SIZE
 
         if typ != 'OK':
             # Restart reader thread and error
-            self.rdth = threading.Thread(target=self._reader)
-            self.rdth.setDaemon(True)
-            self.rdth.start()
+            self._start_reader()
             raise self.error("Couldn't establish TLS session: %s" % dat)
 
         self.keyfile = keyfile
@@ -1081,9 +1090,7 @@ class IMAP4(object):
             self.ssl_wrap_socket()
         finally:
             # Restart reader thread
-            self.rdth = threading.Thread(target=self._reader)
-            self.rdth.setDaemon(True)
-            self.rdth.start()
+            self._start_reader()
 
         typ, dat = self.capability()
         if dat == [None]:
@@ -1615,6 +1622,45 @@ class IMAP4(object):
     #       Threads
 
 
+    def _start_threads(self):
+
+        self.ouq = Queue.Queue(10)
+        self.inq = Queue.Queue()
+
+        self.wrth = threading.Thread(target=self._writer)
+        self.wrth.setDaemon(True)
+        self.wrth.start()
+        self._start_reader()
+        self.inth = threading.Thread(target=self._handler)
+        self.inth.setDaemon(True)
+        self.inth.start()
+
+
+    def _start_reader(self):
+
+        self.rdth = threading.Thread(target=self._reader)
+        self.rdth.setDaemon(True)
+        self.rdth.start()
+
+
+    def _join_reader(self):
+
+        self.rdth.join()
+
+
+    def _abort_commands(self, typ, val):
+
+        # Fail all commands awaiting a response
+
+        self.commands_lock.acquire()
+        for name in self.tagged_commands.keys():
+            rqb = self.tagged_commands.pop(name)
+            rqb.abort(typ, val)
+        self.state_change_free.set()
+        self.commands_lock.release()
+        if __debug__: self._log(3, 'state_change_free.set')
+
+
     def _close_threads(self):
 
         if __debug__: self._log(1, '_close_threads')
@@ -1691,13 +1737,7 @@ class IMAP4(object):
                 break
         self.ouq.put(None)
 
-        self.commands_lock.acquire()
-        for name in self.tagged_commands.keys():
-            rqb = self.tagged_commands.pop(name)
-            rqb.abort(typ, val)
-        self.state_change_free.set()
-        self.commands_lock.release()
-        if __debug__: self._log(3, 'state_change_free.set')
+        self._abort_commands(typ, val)
 
         if __debug__: self._log(1, 'finished')
 
@@ -1718,7 +1758,7 @@ class IMAP4(object):
             }
             return ' '.join([PollErrors[s] for s in PollErrors.keys() if (s & state)])
 
-        line_part = ''
+        readbuf = ReadBuffer(self)
 
         poll = select.poll()
 
@@ -1742,9 +1782,7 @@ class IMAP4(object):
                 fd,state = r[0]
 
                 if state & select.POLLIN:
-                    data = self.read(self.read_size)            # Drain ssl buffer if present
-                    start = 0
-                    dlen = len(data)
+                    dlen = readbuf.read(self.read_size)         # Drain ssl buffer if present
                     if __debug__: self._log(5, 'rcvd %s' % dlen)
                     if dlen == 0:
                         rxzero += 1
@@ -1754,14 +1792,7 @@ class IMAP4(object):
                         continue                                # Try again
                     rxzero = 0
 
-                    while True:
-                        stop = data.find('\n', start)
-                        if stop < 0:
-                            line_part += data[start:]
-                            break
-                        stop += 1
-                        line_part, start, line = \
-                            '', stop, line_part + data[start:stop]
+                    for line in readbuf.responses():
                         if __debug__: self._log(4, '< %s' % line)
                         self.inq.put(line)
                         if self.TerminateReader:
@@ -1793,7 +1824,7 @@ class IMAP4(object):
 
         if __debug__: self._log(1, 'starting using select')
 
-        line_part = ''
+        readbuf = ReadBuffer(self)
 
         rxzero = 0
         terminate = False
@@ -1809,9 +1840,7 @@ class IMAP4(object):
                 if not r:                                       # Timeout
                     continue
 
-                data = self.read(self.read_size)                # Drain ssl buffer if present
-                start = 0
-                dlen = len(data)
+                dlen = readbuf.read(self.read_size)             # Drain ssl buffer if present
                 if __debug__: self._log(5, 'rcvd %s' % dlen)
                 if dlen == 0:
                     rxzero += 1
@@ -1821,14 +1850,7 @@ class IMAP4(object):
                     continue                                    # Try again
                 rxzero = 0
 
-                while True:
-                    stop = data.find('\n', start)
-                    if stop < 0:
-                        line_part += data[start:]
-                        break
-                    stop += 1
-                    line_part, start, line = \
-                        '', stop, line_part + data[start:stop]
+                for line in readbuf.responses():
                     if __debug__: self._log(4, '< %s' % line)
                     self.inq.put(line)
                     if self.TerminateReader:
@@ -2109,6 +2131,14 @@ class IMAP4_stream(IMAP4):
         return self.decompressor.decompress(data, size)
 
 
+    def read_into(self, buf):
+        """Read at most len(buf) bytes from remote into 'buf'."""
+
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+
     def send(self, data):
         """Send data to remote."""
 
@@ -2171,6 +2201,88 @@ class _Authenticator(object):
 
 
 
+class ReadBuffer(object):
+
+    """Private class splitting what a reader reads into responses.
+
+    Data is read into one buffer that is reused for all reads. Complete
+    lines are returned one by one, except that the literal announced by
+    an untagged response line ending in {n} is read into a buffer of its
+    own and returned as one string of n bytes."""
+
+    literal_cre = re.compile(r'\* .*{(?P<size>\d+)}\r\n$')
+    cont_literal_cre = re.compile(r'.*{(?P<size>\d+)}\r\n$')
+
+    def __init__(self, parent, size=2*READ_SIZE):
+        self.parent = parent
+        self.buf = bytearray(size)
+        self.start = self.end = 0       # Unprocessed data is buf[start:end]
+        self.literal = None             # Buffer of the literal being read
+        self.filled = 0                 # Bytes of it read so far
+        self.continued = False          # Next line is the tail of a literal
+
+
+    def read(self, size):
+        """n = read(size)
+        Read at most 'size' bytes from remote, return how many were read."""
+
+        if self.literal is not None and self.start == self.end \
+                and len(self.literal) - self.filled >= size:
+            # Straight into the literal, no more than it still lacks
+            # so that nothing stays unread in an SSL buffer
+            n = self.parent.read_into(memoryview(self.literal)[self.filled:self.filled + size])
+            self.filled += n
+            return n
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buf) - self.end < size:
+            # Make room for all of 'size', for the same reason
+            if self.start:
+                self.buf[:self.end - self.start] = self.buf[self.start:self.end]
+                self.start, self.end = 0, self.end - self.start
+            if len(self.buf) - self.end < size:
+                self.buf.extend(bytearray(size - len(self.buf) + self.end))
+        n = self.parent.read_into(memoryview(self.buf)[self.end:self.end + size])
+        self.end += n
+        return n
+
+
+    def responses(self):
+        """Yield the complete lines and literals read."""
+
+        while True:
+            if self.literal is not None:
+                n = min(len(self.literal) - self.filled, self.end - self.start)
+                if n:
+                    self.literal[self.filled:self.filled + n] = \
+                        memoryview(self.buf)[self.start:self.start + n]
+                    self.filled += n
+                    self.start += n
+                if self.filled < len(self.literal):
+                    return
+                literal, self.literal = str(self.literal), None
+                yield literal
+                continue
+
+            stop = self.buf.find('\n', self.start, self.end)
+            if stop < 0:
+                return
+            stop += 1
+            line = memoryview(self.buf)[self.start:stop].tobytes()
+            self.start = stop
+
+            cre = self.continued and self.cont_literal_cre or self.literal_cre
+            mo = cre.match(line)
+            self.continued = mo is not None
+            if mo is not None and int(mo.group('size')):
+                self.literal = bytearray(int(mo.group('size')))
+                self.filled = 0
+            yield line
+
+
+
+
 class _IdleCont(object):
 
     """When process is called, server is in IDLE state
@@ -27,10 +27,59 @@ from hashlib import sha1
 
 from offlineimap.ui import getglobalui
 from offlineimap import OfflineImapError
-from offlineimap.imaplib2 import IMAP4, IMAP4_SSL, zlib, IMAP4_PORT, InternalDate, Mon2num
+from offlineimap.eventloop import OutputQueue
+from offlineimap.imaplib2 import IMAP4, IMAP4_SSL, zlib, IMAP4_PORT, InternalDate, Mon2num, \
+    Commands, CMD_VAL_ASYNC
+
+
+class TLSContexts(object):
+    """SSL contexts shared by the connections to a server
+
+    Wrapping a socket with ssl.wrap_socket() creates a new context for
+    it, loading the CA certificates file every time. We create one
+    context per set of certificate files instead."""
+
+    supported = hasattr(ssl, 'SSLContext')
+    """Whether the ssl module has contexts (Python 2.7.9 and later)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contexts = {}
+
+    def wrap_socket(self, sock, host, keyfile, certfile, ca_certs):
+        """Return `sock` wrapped like ssl.wrap_socket() would do it"""
+        key = (keyfile, certfile, ca_certs)
+        with self.lock:
+            if key not in self.contexts:
+                context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+                if certfile:
+                    context.load_cert_chain(certfile, keyfile)
+                if ca_certs:
+                    context.load_verify_locations(ca_certs)
+                    context.verify_mode = ssl.CERT_REQUIRED
+                self.contexts[key] = context
+            context = self.contexts[key]
+        kwargs = {}
+        if ssl.HAS_SNI:
+            kwargs['server_hostname'] = host
+        return context.wrap_socket(sock, **kwargs)
 
 
 class UsefulIMAPMixIn(object):
+    tlscontexts = None
+    """:class:`TLSContexts` to use for TLS, if not None"""
+    commandmonitor = None
+    """If not None, its sample(latency, size) method is called after
+    every command and failure() when the server dropped the connection
+    or throttled the command"""
+    backoff = None
+    """If not None, the :class:`imapserver.Backoff` of the server, it
+    is told about throttled commands, which are retried after its pause"""
+    throttleretries = 5
+    eventloop = None
+    """If not None, the :class:`eventloop.EventLoop` that reads and
+    handles the responses, rather than threads of the connection"""
+
     def getselectedfolder(self):
         if self.state == 'SELECTED':
             return self.mailbox
@@ -66,6 +115,84 @@ class UsefulIMAPMixIn(object):
             raise OfflineImapError(errstr, severity)
         return result
 
+    def _simple_command(self, name, *args, **kw):
+        monitor = self.commandmonitor
+        if name in ('IDLE', 'LOGOUT') or 'callback' in kw or \
+                (monitor is None and self.backoff is None):
+            return super(UsefulIMAPMixIn, self)._simple_command(name, *args,
+                                                                **kw)
+        literal = self.literal # gets reset by sending the command
+        retries = self.throttleretries
+        while True:
+            self.literal = literal
+            start = time.time()
+            try:
+                typ, dat = super(UsefulIMAPMixIn, self)._simple_command(
+                    name, *args, **kw)
+            except self.abort as e:
+                if monitor is not None:
+                    monitor.failure()
+                bye = self._get_untagged_response('BYE', leave=True)
+                if bye and self.backoff is not None:
+                    # kicked out, e.g. for sending too many commands
+                    self.backoff.throttled(throttlecode(bye[-1]) or 'BYE')
+                raise
+            code = throttlecode(dat) if typ == 'NO' else None
+            if code is None:
+                break
+            if monitor is not None:
+                monitor.failure()
+            if self.backoff is None or not retries:
+                break
+            retries -= 1
+            if not Commands[name][CMD_VAL_ASYNC]:
+                # sending it again takes the state change lock again
+                self._release_state_change()
+            self.backoff.throttled(code)
+            self.backoff.wait()
+        if code is None:
+            if monitor is not None:
+                monitor.sample(time.time() - start, responsesize(dat))
+            if self.backoff is not None:
+                self.backoff.succeeded()
+        return typ, dat
+
+    def _start_threads(self):
+        if self.eventloop is None:
+            return super(UsefulIMAPMixIn, self)._start_threads()
+        self.ouq = OutputQueue(self, self.eventloop)
+        self.eventloop.register(self, greeting=True)
+
+    def _start_reader(self):
+        if self.eventloop is None:
+            return super(UsefulIMAPMixIn, self)._start_reader()
+        self.eventloop.register(self)
+
+    def _join_reader(self):
+        if self.eventloop is None:
+            return super(UsefulIMAPMixIn, self)._join_reader()
+        self.eventloop.join(self)
+
+    def _close_threads(self):
+        if self.eventloop is None:
+            return super(UsefulIMAPMixIn, self)._close_threads()
+        self.eventloop.close(self)
+
+    def ssl_wrap_socket(self):
+        """Start TLS on self.sock (on connect or STARTTLS)"""
+        if self.tlscontexts is None:
+            return super(UsefulIMAPMixIn, self).ssl_wrap_socket()
+        # Allow sending of keep-alive messages, as imaplib2 does
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.sock = self.tlscontexts.wrap_socket(self.sock, self.host,
+                                                 self.keyfile, self.certfile,
+                                                 self.ca_certs)
+        self.read_fd = self.sock.fileno()
+        if self.cert_verify_cb is not None:
+            cert_err = self.cert_verify_cb(self.sock.getpeercert(), self.host)
+            if cert_err:
+                raise ssl.SSLError(cert_err)
+
     def _mesg(self, s, tn=None, secs=None):
         new_mesg(self, s, tn, secs)
 
@@ -78,6 +205,7 @@ class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
     The result will be in PREAUTH stage."""
 
     def __init__(self, tunnelcmd, **kwargs):
+        self.eventloop = kwargs.pop('eventloop', None)
         IMAP4.__init__(self, tunnelcmd, **kwargs)
 
     def open(self, host, port):
@@ -113,6 +241,14 @@ class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
 
         return self.decompressor.decompress(data, size)
 
+    def read_into(self, buf):
+        """n = read_into(buf)
+        Read at most len(buf) bytes from remote into 'buf'."""
+
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
     def send(self, data):
         if self.compressor is not None:
             data = self.compressor.compress(data)
@@ -127,6 +263,31 @@ class IMAP4_Tunnel(UsefulIMAPMixIn, IMAP4):
         self.process.wait()
 
 
+throttle_cre = re.compile(r'\[(THROTTLED|UNAVAILABLE|LIMIT)\]', re.IGNORECASE)
+
+def throttlecode(data):
+    """Return the response code by which the server said it throttles
+    us (THROTTLED, UNAVAILABLE or LIMIT) or None
+
+    :param data: response text or data of a command response"""
+    if not isinstance(data, basestring):
+        data = ' '.join(item for item in data or () if
+                        isinstance(item, basestring))
+    match = throttle_cre.search(data)
+    if match is None:
+        return None
+    return match.group(1).upper()
+
+def responsesize(data):
+    """Return the number of bytes in the data of a command response"""
+    size = 0
+    for item in data or ():
+        if isinstance(item, tuple):
+            size += sum(len(part) for part in item if part)
+        elif item:
+            size += len(item)
+    return size
+
 def new_mesg(self, s, tn=None, secs=None):
             if secs is None:
                 secs = time.time()
@@ -142,6 +303,8 @@ class WrappedIMAP4_SSL(UsefulIMAPMixIn, IMAP4_SSL):
         self._fingerprint = kwargs.get('fingerprint', None)
         if 'fingerprint' in kwargs:
             del kwargs['fingerprint']
+        self.tlscontexts = kwargs.pop('tlscontexts', None)
+        self.eventloop = kwargs.pop('eventloop', None)
         super(WrappedIMAP4_SSL, self).__init__(*args, **kwargs)
 
     def open(self, host=None, port=None):
@@ -159,7 +322,11 @@ class WrappedIMAP4_SSL(UsefulIMAPMixIn, IMAP4_SSL):
 
 class WrappedIMAP4(UsefulIMAPMixIn, IMAP4):
     """Improved version of imaplib.IMAP4 overriding select()"""
-    pass
+    def __init__(self, *args, **kwargs):
+        # used by STARTTLS
+        self.tlscontexts = kwargs.pop('tlscontexts', None)
+        self.eventloop = kwargs.pop('eventloop', None)
+        super(WrappedIMAP4, self).__init__(*args, **kwargs)
 
 
 def Internaldate2epoch(resp):
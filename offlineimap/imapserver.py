@@ -15,13 +15,18 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from offlineimap import imaplibutil, imaputil, threadutil, OfflineImapError
+from offlineimap import imaplibutil, imaputil, threadutil, eventloop, \
+    OfflineImapError
 from offlineimap.ui import getglobalui
-from threading import Lock, BoundedSemaphore, Thread, Event, currentThread
+from threading import Lock, BoundedSemaphore, Thread, Event, Condition, \
+    currentThread
 import offlineimap.accounts
 import hmac
 import socket
 import base64
+import os
+import random
+import re
 import time
 import errno
 from sys import exc_info
@@ -37,6 +42,292 @@ try:
 except ImportError:
     pass
 
+capability_cre = re.compile(r'\[CAPABILITY ([^\]]*)\]', re.IGNORECASE)
+
+
+class HostLimit(object):
+    """Limit on the number of connections to a host, over all its pools
+
+    Before a connection is opened, acquire() waits until it is below
+    the limit, closing idle connections of other pools to get there.
+    Every connection needs to be given back with release() once it is
+    logged out. A limit of 0 means no limit."""
+
+    def __init__(self):
+        self.limit = 0
+        self.count = 0
+        self.pools = []
+        self.cond = Condition()
+
+    def setlimit(self, limit):
+        """Lower the limit to `limit`, the lowest configured one counts"""
+        with self.cond:
+            if limit > 0 and (not self.limit or limit < self.limit):
+                self.limit = limit
+
+    def acquire(self, pool, wait=True):
+        """Count a new connection of `pool`
+
+        :param wait: whether to wait (and close idle connections of
+           other pools) while at the limit
+        :returns: whether the connection may be opened"""
+        while True:
+            with self.cond:
+                if not self.limit or self.count < self.limit:
+                    self.count += 1
+                    return True
+            if not wait:
+                return False
+            # Not with self.cond held, takeidle() takes the pool lock
+            for other in self.pools:
+                if other is not pool:
+                    imapobj = other.takeidle()
+                    if imapobj is not None:
+                        other.logout(imapobj)
+                        break
+            else:
+                with self.cond:
+                    if self.limit and self.count >= self.limit:
+                        self.cond.wait(10)
+
+    def release(self):
+        """Uncount a connection that has been logged out"""
+        with self.cond:
+            self.count -= 1
+            self.cond.notify()
+
+    def idle(self):
+        """Wake up a waiter in acquire() to close a newly idle connection"""
+        with self.cond:
+            self.cond.notify()
+
+
+class Backoff(object):
+    """Pauses the work on a server that throttles us
+
+    Each time the server throttles a command (see
+    :func:`imaplibutil.throttlecode`), the pause is doubled, starting
+    from `BASE` up to `MAX` seconds, and shortened by a random jitter of
+    up to a half, so that the waiting connections do not resume in
+    lockstep. Throttled responses during a pause, e.g. from the other
+    connections, do not extend it. A command that succeeds after the
+    pause resets it."""
+
+    BASE = 5
+    MAX = 300
+
+    def __init__(self, name):
+        self.ui = getglobalui()
+        self.name = name
+        self.lock = Lock()
+        self.failures = 0
+        self.until = 0
+
+    def throttled(self, code):
+        """Start a pause after a response with the throttling `code`"""
+        with self.lock:
+            now = time.time()
+            if now < self.until:
+                return
+            delay = min(self.BASE * 2 ** self.failures, self.MAX)
+            delay *= random.uniform(0.5, 1)
+            self.failures += 1
+            self.until = now + delay
+        self.ui.info("Server '%s' throttles us (%s), pausing for %d seconds"
+                     % (self.name, code, delay))
+
+    def succeeded(self):
+        if self.failures and time.time() >= self.until:
+            with self.lock:
+                self.failures = 0
+
+    def wait(self):
+        """Sleep until the current pause is over"""
+        while True:
+            delay = self.until - time.time()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+
+class ConnectionPool(object):
+    """Connections to an IMAP server as one user
+
+    The IMAPServers of all repositories with the same server and
+    credentials share a pool (see :func:`getconnectionpool`), so that
+    their accounts use each other's idle connections. The
+    `maxconnections` of each repository still limits the connections
+    it uses at the same time.
+
+    self.lock protects self.available, self.lastowner and
+    self.idlesince (the time each available connection was last
+    released)."""
+
+    def __init__(self, hostlimit):
+        self.lock = Lock()
+        self.available = []
+        self.lastowner = {}
+        self.idlesince = {}
+        self.hostlimit = hostlimit
+        self.backoff = None
+        self.tlscontexts = None
+        if imaplibutil.TLSContexts.supported:
+            self.tlscontexts = imaplibutil.TLSContexts()
+
+    def takeidle(self):
+        """Remove the longest unused available connection and return it
+
+        :returns: the connection or None if none is available"""
+        with self.lock:
+            if not self.available:
+                return None
+            imapobj = self.available.pop(0)
+            self.lastowner.pop(imapobj, None)
+            return imapobj
+
+    def logout(self, imapobj):
+        """Log out a connection that has been removed from the pool"""
+        self.idlesince.pop(imapobj, None)
+        try:
+            imapobj.logout()
+        finally:
+            self.hostlimit.release()
+
+
+_pools = {}
+_hostlimits = {}
+_poolslock = Lock()
+
+def getconnectionpool(key, host, maxhostconnections):
+    """Return the process-wide :class:`ConnectionPool` for `key`
+
+    :param key: identifies the server and credentials
+    :param host: the host name, connection limits apply per host
+    :param maxhostconnections: the configured connection limit of the
+       host, 0 or None for no limit"""
+    with _poolslock:
+        hostlimit = _hostlimits.get(host)
+        if hostlimit is None:
+            hostlimit = _hostlimits[host] = HostLimit()
+        hostlimit.setlimit(maxhostconnections)
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(hostlimit)
+            pool.backoff = Backoff(host)
+            hostlimit.pools.append(pool)
+        return pool
+
+
+class Autotuner(object):
+    """Adapts the connections and batch size of a server to its speed
+
+    The latency and response size of every command is sampled (see
+    :attr:`imaplibutil.UsefulIMAPMixIn.commandmonitor`). After each
+    `WINDOW` samples, both limits are adjusted AIMD style: they grow by
+    one step if the commands were not slower than `SLOWDOWN` times the
+    best window so far and the throughput held up, and they are halved
+    if the commands got that much slower or a connection was dropped by
+    the server. They stay within the configured bounds. The connection
+    limit only grows while callers had to wait for a connection."""
+
+    WINDOW = 16
+    SLOWDOWN = 2.0
+
+    def __init__(self, name, connections, batchsize):
+        """
+        :param connections: (min, max) number of connections in use
+        :param batchsize: (min, max) number of messages per command"""
+        self.ui = getglobalui()
+        self.name = name
+        self.minconnections, self.maxconnections = connections
+        self.minbatch, self.maxbatch = batchsize
+        self.connections = self.minconnections
+        self.batchsize = self.minbatch
+        self.cond = Condition()
+        self.active = 0
+        self.waited = False
+        self.samples = []
+        self.bytes = 0
+        self.failed = False
+        self.windowstart = time.time()
+        self.bestlatency = None
+        self.throughput = None
+
+    def acquire(self):
+        """Wait until less than the current limit of connections are
+        in use and count one more"""
+        with self.cond:
+            while self.active >= self.connections:
+                self.waited = True
+                self.cond.wait()
+            self.active += 1
+
+    def release(self):
+        with self.cond:
+            self.active -= 1
+            self.cond.notify()
+
+    def sample(self, latency, size):
+        """Record a command that took `latency` seconds and returned
+        `size` bytes"""
+        with self.cond:
+            self.samples.append(latency)
+            self.bytes += size
+            if len(self.samples) >= self.WINDOW:
+                self.adjust()
+
+    def failure(self):
+        """Record a command that failed as the connection was lost"""
+        with self.cond:
+            self.failed = True
+            self.adjust()
+
+    def adjust(self):
+        """Decide on the limits at the end of a window, with self.cond
+        held"""
+        now = time.time()
+        latency = sum(self.samples) / max(len(self.samples), 1)
+        throughput = self.bytes / max(now - self.windowstart, 0.001)
+        if self.failed:
+            reason = 'connection lost'
+            grow = False
+        elif self.bestlatency is not None and \
+                latency > self.SLOWDOWN * self.bestlatency:
+            reason = 'latency %.3fs, best %.3fs' % (latency, self.bestlatency)
+            grow = False
+        elif self.throughput is not None and throughput < 0.9 * self.throughput:
+            reason = None # less to do, or the server got slower
+            grow = None
+        else:
+            reason = 'latency %.3fs, %d bytes/s' % (latency, throughput)
+            grow = True
+        if grow:
+            if self.waited:
+                self.connections = min(self.connections + 1,
+                                       self.maxconnections)
+                self.cond.notify()
+            self.batchsize = min(self.batchsize + self.minbatch,
+                                 self.maxbatch)
+        elif grow is False:
+            self.connections = max(self.connections // 2, self.minconnections)
+            self.batchsize = max(self.batchsize // 2, self.minbatch)
+        if reason is not None:
+            self.ui.debug('imap', "autotune %s: %s, now %d connections and "
+                          "batches of %d" % (self.name, reason,
+                                             self.connections, self.batchsize))
+        if self.failed:
+            self.throughput = None
+        else:
+            if self.bestlatency is None or latency < self.bestlatency:
+                self.bestlatency = latency
+            self.throughput = throughput
+        self.samples = []
+        self.bytes = 0
+        self.failed = False
+        self.waited = False
+        self.windowstart = now
+
+
 class IMAPServer:
     """Initializes all variables from an IMAPRepository() instance
 
@@ -70,16 +361,50 @@ class IMAPServer:
         self.delim = None
         self.root = None
         self.maxconnections = repos.getmaxconnections()
-        self.availableconnections = []
+        self.connectionttl = repos.getconnectionttl()
+        # Only share connections that were set up and verified the same
+        self.pool = getconnectionpool((self.tunnel, self.hostname, self.port,
+                                       self.username, self.usessl,
+                                       self.sslclientcert, self.sslclientkey,
+                                       self.sslcacertfile,
+                                       repos.get_ssl_fingerprint(),
+                                       self.verifycert is not None),
+                                      self.tunnel or self.hostname,
+                                      repos.getmaxhostconnections())
+        # Idle connections are shared with the other users of the pool,
+        # assigned ones are ours
+        self.availableconnections = self.pool.available
         self.assignedconnections = []
-        self.lastowner = {}
+        self.lastowner = self.pool.lastowner
+        # how often a connection with the requested folder SELECTed
+        # could be handed out by acquireconnection(folder=...)
+        self.selectrequests = 0
+        self.selecthits = 0
         self.semaphore = BoundedSemaphore(self.maxconnections)
-        self.connectionlock = Lock()
+        self.connectionlock = self.pool.lock
         self.reference = repos.getreference()
         self.idlefolders = repos.getidlefolders()
+        self.idlesubscribed = repos.getidlesubscribed()
+        self.batchsize = repos.getbatchsize()
+        self.useeventloop = repos.geteventloop()
+        self.autotuner = None
+        if repos.getautotune():
+            # leave a connection for syncing besides the IDLE ones
+            minconnections = max(repos.getminconnections(),
+                len(self.idlefolders) + int(self.idlesubscribed) + 1)
+            self.autotuner = Autotuner(repos.getname(),
+                (min(minconnections, self.maxconnections),
+                 self.maxconnections),
+                (min(repos.getminbatchsize(), self.batchsize),
+                 self.batchsize))
         self.gss_step = self.GSS_STATE_STEP
         self.gss_vc = None
         self.gssapi = False
+        self.gsslock = Lock() # protects the gss_* state
+        self.serverinfo = None
+        self.serverinfolock = Lock()
+        self.serverinfofile = repos.getserverinfofile()
+        self.tlscontexts = self.pool.tlscontexts
 
     def getpassword(self):
         """Returns the server password or None"""
@@ -112,11 +437,17 @@ class IMAPServer:
         self.assignedconnections.remove(connection)
         # Don't reuse broken connections
         if connection.Terminate or drop_conn:
-            connection.logout()
+            self.pool.logout(connection)
+            connection = None
         else:
             self.availableconnections.append(connection)
+            self.pool.idlesince[connection] = time.time()
         self.connectionlock.release()
         self.semaphore.release()
+        if self.autotuner:
+            self.autotuner.release()
+        if connection is not None:
+            self.pool.hostlimit.idle()
 
     def md5handler(self, response):
         challenge = response.strip()
@@ -128,8 +459,13 @@ class IMAPServer:
         return retval
 
     def plainauth(self, imapobj):
+        if self.cansaslir(imapobj, 'PLAIN'):
+            self.ui.debug('imap', 'Attempting PLAIN authentication')
+            response = '\0%s\0%s' % (self.username, self.getpassword())
+            return imapobj.authenticate('PLAIN', lambda challenge: response,
+                                        initial_response = response)
         self.ui.debug('imap', 'Attempting plain authentication')
-        imapobj.login(self.username, self.getpassword())
+        return imapobj.login(self.username, self.getpassword())
 
     def gssauth(self, response):
         data = base64.b64encode(response)
@@ -158,156 +494,83 @@ class IMAPServer:
             response = ''
         return base64.b64decode(response)
 
-    def acquireconnection(self):
+    def acquireconnection(self, folder=None, readonly=False):
         """Fetches a connection from the pool, making sure to create a new one
         if needed, to obey the maximum connection limits, etc.
         Opens a connection to the server and returns an appropriate
-        object."""
+        object.
+
+        :param folder: Full name of the folder the caller is going to
+           SELECT. A pooled connection that has it SELECTed already (in
+           the same `readonly` mode) is preferred, saving a SELECT."""
 
+        self.pool.backoff.wait()
         self.semaphore.acquire()
+        if self.autotuner:
+            self.autotuner.acquire()
         self.connectionlock.acquire()
         curThread = currentThread()
         imapobj = None
+        if folder is not None:
+            self.selectrequests += 1
 
         if len(self.availableconnections): # One is available.
-            # Try to find one that previously belonged to this thread
-            # as an optimization.  Start from the back since that's where
-            # they're popped on.
             imapobj = None
-            for i in range(len(self.availableconnections) - 1, -1, -1):
-                tryobj = self.availableconnections[i]
-                if self.lastowner[tryobj] == curThread.ident:
-                    imapobj = tryobj
-                    del(self.availableconnections[i])
-                    break
+            if folder is not None:
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if tryobj.getselectedfolder() == folder and \
+                            tryobj.is_readonly == readonly:
+                        imapobj = tryobj
+                        del(self.availableconnections[i])
+                        self.selecthits += 1
+                        break
+            if not imapobj:
+                # Try to find one that previously belonged to this thread
+                # as an optimization.  Start from the back since that's
+                # where they're popped on.
+                for i in range(len(self.availableconnections) - 1, -1, -1):
+                    tryobj = self.availableconnections[i]
+                    if self.lastowner.get(tryobj) == curThread.ident:
+                        imapobj = tryobj
+                        del(self.availableconnections[i])
+                        break
             if not imapobj:
                 imapobj = self.availableconnections[0]
                 del(self.availableconnections[0])
             self.assignedconnections.append(imapobj)
             self.lastowner[imapobj] = curThread.ident
             self.connectionlock.release()
+            imapobj.commandmonitor = self.autotuner
+            if self.delim is None:
+                # opened by another user of the pool
+                try:
+                    self.getdelimiter(imapobj)
+                except:
+                    self.releaseconnection(imapobj)
+                    raise
             return imapobj
-        
+
         self.connectionlock.release()   # Release until need to modify data
 
         """ Must be careful here that if we fail we should bail out gracefully
         and release locks / threads so that the next attempt can try...
         """
-        success = 0
         try:
-            while not success:
-                # Generate a new connection.
-                if self.tunnel:
-                    self.ui.connecting('tunnel', self.tunnel)
-                    imapobj = imaplibutil.IMAP4_Tunnel(self.tunnel,
-                                                       timeout=socket.getdefaulttimeout())
-                    success = 1
-                elif self.usessl:
-                    self.ui.connecting(self.hostname, self.port)
-                    fingerprint = self.repos.get_ssl_fingerprint()
-                    imapobj = imaplibutil.WrappedIMAP4_SSL(self.hostname,
-                                                           self.port,
-                                                           self.sslclientkey,
-                                                           self.sslclientcert,
-                                                           self.sslcacertfile,
-                                                           self.verifycert,
-                                                           timeout=socket.getdefaulttimeout(),
-                                                           fingerprint=fingerprint
-                                                           )
-                else:
-                    self.ui.connecting(self.hostname, self.port)
-                    imapobj = imaplibutil.WrappedIMAP4(self.hostname, self.port,
-                                                       timeout=socket.getdefaulttimeout())
-
-                if not self.tunnel:
-                    try:
-                        # Try GSSAPI and continue if it fails
-                        if 'AUTH=GSSAPI' in imapobj.capabilities and have_gss:
-                            self.connectionlock.acquire()
-                            self.ui.debug('imap',
-                                'Attempting GSSAPI authentication')
-                            try:
-                                imapobj.authenticate('GSSAPI', self.gssauth)
-                            except imapobj.error as val:
-                                self.gssapi = False
-                                self.ui.debug('imap',
-                                    'GSSAPI Authentication failed')
-                            else:
-                                self.gssapi = True
-                                kerberos.authGSSClientClean(self.gss_vc)
-                                self.gss_vc = None
-                                self.gss_step = self.GSS_STATE_STEP
-                                #if we do self.password = None then the next attempt cannot try...
-                                #self.password = None
-                            self.connectionlock.release()
-
-                        if not self.gssapi:
-                            if 'STARTTLS' in imapobj.capabilities and not\
-                                    self.usessl:
-                                self.ui.debug('imap',
-                                              'Using STARTTLS connection')
-                                imapobj.starttls()
-
-                            if 'AUTH=CRAM-MD5' in imapobj.capabilities:
-                                self.ui.debug('imap',
-                                           'Attempting CRAM-MD5 authentication')
-                                try:
-                                    imapobj.authenticate('CRAM-MD5',
-                                                         self.md5handler)
-                                except imapobj.error as val:
-                                    self.plainauth(imapobj)
-                            else:
-                                # Use plaintext login, unless
-                                # LOGINDISABLED (RFC2595)
-                                if 'LOGINDISABLED' in imapobj.capabilities:
-                                    raise OfflineImapError("Plaintext login "
-                                       "disabled by server. Need to use SSL?",
-                                        OfflineImapError.ERROR.REPO)
-                                self.plainauth(imapobj)
-                        # Would bail by here if there was a failure.
-                        success = 1
-                        self.goodpassword = self.password
-                    except imapobj.error as val:
-                        self.passworderror = str(val)
-                        raise
-
-            # update capabilities after login, e.g. gmail serves different ones
-            typ, dat = imapobj.capability()
-            if dat != [None]:
-                imapobj.capabilities = tuple(dat[-1].upper().split())
-
-            if self.delim == None:
-                listres = imapobj.list(self.reference, '""')[1]
-                if listres == [None] or listres == None:
-                    # Some buggy IMAP servers do not respond well to LIST "" ""
-                    # Work around them.
-                    listres = imapobj.list(self.reference, '"*"')[1]
-                if listres == [None] or listres == None:
-                    # No Folders were returned. This occurs, e.g. if the
-                    # 'reference' prefix does not exist on the mail
-                    # server. Raise exception.
-                    err = "Server '%s' returned no folders in '%s'" % \
-                        (self.repos.getname(), self.reference)
-                    self.ui.warn(err)
-                    raise Exception(err)
-                self.delim, self.root = \
-                            imaputil.imapsplit(listres[0])[1:]
-                self.delim = imaputil.dequote(self.delim)
-                self.root = imaputil.dequote(self.root)
-
+            imapobj = self.newconnection()
             self.connectionlock.acquire()
             self.assignedconnections.append(imapobj)
             self.lastowner[imapobj] = curThread.ident
             self.connectionlock.release()
+            imapobj.commandmonitor = self.autotuner
             return imapobj
         except Exception as e:
             """If we are here then we did not succeed in getting a
             connection - we should clean up and then re-raise the
             error..."""
             self.semaphore.release()
-
-            if(self.connectionlock.locked()):
-                self.connectionlock.release()
+            if self.autotuner:
+                self.autotuner.release()
 
             severity = OfflineImapError.ERROR.REPO
             if type(e) == gaierror:
@@ -351,6 +614,289 @@ class IMAPServer:
                 # re-raise all other errors
                 raise
 
+    def newconnection(self, wait=True):
+        """Open and authenticate a new connection to the server
+
+        The caller needs to hold a slot of self.semaphore for it. Also
+        determines the folder delimiter if that is not known yet.
+
+        :param wait: whether to wait for the host connection limit, else
+           None is returned if the host is at the limit"""
+        if not self.pool.hostlimit.acquire(self.pool, wait):
+            return None
+        try:
+            retries = imaplibutil.UsefulIMAPMixIn.throttleretries
+            while True:
+                self.pool.backoff.wait()
+                try:
+                    return self.openconnection()
+                except Exception as e:
+                    # e.g. turned away with BYE [UNAVAILABLE] on connect
+                    code = imaplibutil.throttlecode(str(e))
+                    if code is None or not retries:
+                        raise
+                    retries -= 1
+                    self.pool.backoff.throttled(code)
+        except:
+            self.pool.hostlimit.release()
+            raise
+
+    def openconnection(self):
+        """Open a new connection, see :meth:`newconnection`"""
+        # Generate a new connection.
+        loop = eventloop.getloop() if self.useeventloop else None
+        if self.tunnel:
+            self.ui.connecting('tunnel', self.tunnel)
+            imapobj = imaplibutil.IMAP4_Tunnel(self.tunnel,
+                                               timeout=socket.getdefaulttimeout(),
+                                               eventloop=loop)
+        elif self.usessl:
+            self.ui.connecting(self.hostname, self.port)
+            fingerprint = self.repos.get_ssl_fingerprint()
+            imapobj = imaplibutil.WrappedIMAP4_SSL(self.hostname,
+                                                   self.port,
+                                                   self.sslclientkey,
+                                                   self.sslclientcert,
+                                                   self.sslcacertfile,
+                                                   self.verifycert,
+                                                   timeout=socket.getdefaulttimeout(),
+                                                   fingerprint=fingerprint,
+                                                   tlscontexts=self.tlscontexts,
+                                                   eventloop=loop
+                                                   )
+        else:
+            self.ui.connecting(self.hostname, self.port)
+            imapobj = imaplibutil.WrappedIMAP4(self.hostname, self.port,
+                                               timeout=socket.getdefaulttimeout(),
+                                               tlscontexts=self.tlscontexts,
+                                               eventloop=loop)
+
+        imapobj.backoff = self.pool.backoff
+        authdat = None
+        if not self.tunnel:
+            try:
+                # Try GSSAPI and continue if it fails
+                if 'AUTH=GSSAPI' in imapobj.capabilities and have_gss:
+                    with self.gsslock:
+                        self.ui.debug('imap',
+                            'Attempting GSSAPI authentication')
+                        initial = None
+                        if 'SASL-IR' in imapobj.capabilities:
+                            initial = self.gssauth('')
+                        try:
+                            typ, authdat = imapobj.authenticate('GSSAPI',
+                                self.gssauth, initial_response=initial)
+                        except imapobj.error as val:
+                            self.gssapi = False
+                            self.ui.debug('imap',
+                                'GSSAPI Authentication failed')
+                        else:
+                            self.gssapi = True
+                            kerberos.authGSSClientClean(self.gss_vc)
+                            self.gss_vc = None
+                            self.gss_step = self.GSS_STATE_STEP
+                            #if we do self.password = None then the next attempt cannot try...
+                            #self.password = None
+
+                if not self.gssapi:
+                    if 'STARTTLS' in imapobj.capabilities and not\
+                            self.usessl:
+                        self.ui.debug('imap',
+                                      'Using STARTTLS connection')
+                        imapobj.starttls()
+
+                    if 'AUTH=CRAM-MD5' in imapobj.capabilities:
+                        self.ui.debug('imap',
+                                   'Attempting CRAM-MD5 authentication')
+                        try:
+                            typ, authdat = imapobj.authenticate('CRAM-MD5',
+                                                 self.md5handler)
+                        except imapobj.error as val:
+                            typ, authdat = self.plainauth(imapobj)
+                    else:
+                        # Use plaintext login, unless
+                        # LOGINDISABLED (RFC2595)
+                        if 'LOGINDISABLED' in imapobj.capabilities and \
+                                not self.cansaslir(imapobj, 'PLAIN'):
+                            raise OfflineImapError("Plaintext login "
+                               "disabled by server. Need to use SSL?",
+                                OfflineImapError.ERROR.REPO)
+                        typ, authdat = self.plainauth(imapobj)
+                # Would bail by here if there was a failure.
+                self.goodpassword = self.password
+            except imapobj.error as val:
+                if imaplibutil.throttlecode(str(val)) is None:
+                    self.passworderror = str(val)
+                raise
+
+        preauth = ' '.join(imapobj.capabilities)
+        self.setcapabilities(imapobj, preauth, authdat)
+
+        if self.delim == None:
+            info = self.getserverinfo(preauth)
+            if 'delim' in info:
+                self.delim, self.root = info['delim'], info['root']
+            else:
+                self.getdelimiter(imapobj)
+                self.updateserverinfo(preauth, delim = self.delim,
+                                      root = self.root)
+        return imapobj
+
+    def getdelimiter(self, imapobj):
+        """Learn the folder delimiter and root by a LIST command"""
+        listres = imapobj.list(self.reference, '""')[1]
+        if listres == [None] or listres == None:
+            # Some buggy IMAP servers do not respond well to LIST "" ""
+            # Work around them.
+            listres = imapobj.list(self.reference, '"*"')[1]
+        if listres == [None] or listres == None:
+            # No Folders were returned. This occurs, e.g. if the
+            # 'reference' prefix does not exist on the mail
+            # server. Raise exception.
+            err = "Server '%s' returned no folders in '%s'" % \
+                (self.repos.getname(), self.reference)
+            self.ui.warn(err)
+            raise Exception(err)
+        self.delim, self.root = \
+                    imaputil.imapsplit(listres[0])[1:]
+        self.delim = imaputil.dequote(self.delim)
+        self.root = imaputil.dequote(self.root)
+
+    def setcapabilities(self, imapobj, preauth, authdat):
+        """Update the capabilities of a connection after login
+
+        Servers may offer more (e.g. Gmail) or other ones once we are
+        logged in. Most say so in the response to the login, else we
+        use the ones from the server info cache, and only ask the
+        server if we have none.
+
+        :param preauth: the capabilities before login, as a string
+        :param authdat: data of the (tagged) login response"""
+        capabilities = None
+        if authdat:
+            match = capability_cre.search(authdat[-1] or '')
+            if match:
+                capabilities = match.group(1)
+        if capabilities is None:
+            capabilities = self.getserverinfo(preauth).get('capabilities')
+        if capabilities is None:
+            typ, dat = imapobj.capability()
+            if dat != [None]:
+                capabilities = dat[-1]
+        if capabilities:
+            imapobj.capabilities = tuple(capabilities.upper().split())
+            self.updateserverinfo(preauth,
+                capabilities = ' '.join(imapobj.capabilities))
+
+    def cansaslir(self, imapobj, mechanism):
+        """Whether we can authenticate with `mechanism` and SASL-IR"""
+        return 'SASL-IR' in imapobj.capabilities and \
+            'AUTH=' + mechanism in imapobj.capabilities
+
+    def getserverinfo(self, preauth):
+        """Return the cached information on the server, if still valid
+
+        With 'cacheserverinfo' enabled, the capabilities of a server (as
+        of after the login), its folder delimiter and root are kept in
+        the metadata directory and reused as long as the server offers
+        the same capabilities before login.
+
+        :param preauth: the capabilities before login, as a string
+        :returns: dict with the keys 'capabilities', 'delim' and 'root'
+                  or those of them that are known"""
+        if not self.serverinfofile:
+            return {}
+        with self.serverinfolock:
+            if self.serverinfo is None:
+                self.serverinfo = {}
+                if os.path.exists(self.serverinfofile):
+                    with open(self.serverinfofile, 'rt') as file:
+                        for line in file:
+                            name, sep, value = line.rstrip('\n').partition('\t')
+                            if sep:
+                                self.serverinfo[name] = value
+            info = self.serverinfo
+            if info.get('server') != self.getserverkey() or \
+                    info.get('preauth') != preauth:
+                return {}
+            return dict(info)
+
+    def updateserverinfo(self, preauth, **values):
+        """Update the server info cache, if that is enabled
+
+        If the capabilities before login changed, the other cached
+        values are invalidated."""
+        if not self.serverinfofile:
+            return
+        self.getserverinfo(preauth) # make sure it is loaded
+        with self.serverinfolock:
+            info = self.serverinfo
+            if info.get('server') != self.getserverkey() or \
+                    info.get('preauth') != preauth:
+                info.clear()
+                info['server'] = self.getserverkey()
+            values['preauth'] = preauth
+            if all(info.get(name) == value for name, value in values.items()):
+                return
+            info.update(values)
+            tmpname = self.serverinfofile + '.tmp'
+            with open(tmpname, 'wt') as file:
+                for name, value in sorted(info.items()):
+                    file.write('%s\t%s\n' % (name, value))
+            os.rename(tmpname, self.serverinfofile)
+
+    def getserverkey(self):
+        """Identify the server and account the server info is about"""
+        if self.tunnel:
+            return '%s %s' % (self.tunnel, self.reference)
+        return '%s@%s:%s %s' % (self.username, self.hostname, self.port,
+                                self.reference)
+
+    def prewarm(self):
+        """Open all connections up front, in parallel
+
+        The first connection is opened before returning, as it may need
+        to ask for the password. The others are opened by background
+        threads and put into the pool of available connections, callers
+        of acquireconnection() wait for them rather than opening more."""
+        imapobj = self.acquireconnection()
+        self.releaseconnection(imapobj)
+        with self.connectionlock:
+            missing = self.getconnectionlimit() - \
+                len(self.availableconnections) - len(self.assignedconnections)
+        for i in range(missing):
+            thread = Thread(target = self.prewarmconnection,
+                            name = 'Prewarm connection %d [%s]' % \
+                                (i + 1, self.repos))
+            thread.setDaemon(1)
+            thread.start()
+
+    def prewarmconnection(self):
+        """Open one connection and add it to the available ones"""
+        if not self.semaphore.acquire(False):
+            return # all connections are in use or being opened
+        try:
+            imapobj = self.newconnection(wait=False)
+        except Exception as e:
+            self.ui.debug('imap', "Could not prewarm a connection to '%s': %s" %
+                          (self.repos, e))
+        else:
+            if imapobj is None:
+                return # the host is at its connection limit
+            with self.connectionlock:
+                self.availableconnections.append(imapobj)
+                self.lastowner[imapobj] = None
+                self.pool.idlesince[imapobj] = time.time()
+        finally:
+            self.semaphore.release()
+
+    def getselecthitrate(self):
+        """Return the share of acquireconnection(folder=...) calls that
+        got a connection with the folder already SELECTed, or `None`"""
+        if not self.selectrequests:
+            return None
+        return float(self.selecthits) / self.selectrequests
+
     def connectionwait(self):
         """Waits until there is a connection available.  Note that between
         the time that a connection becomes available and the time it is
@@ -361,6 +907,21 @@ class IMAPServer:
         this will help us do."""
         self.semaphore.acquire()
         self.semaphore.release()
+        if self.autotuner:
+            self.autotuner.acquire()
+            self.autotuner.release()
+
+    def getconnectionlimit(self):
+        """Return how many connections may be used at the same time"""
+        if self.autotuner:
+            return self.autotuner.connections
+        return self.maxconnections
+
+    def getbatchsize(self):
+        """Return how many messages to handle with one command"""
+        if self.autotuner:
+            return self.autotuner.batchsize
+        return self.batchsize
 
     def close(self):
         # Make sure I own all the semaphores.  Let the threads finish
@@ -372,51 +933,133 @@ class IMAPServer:
             # deadlock! Audit & check!
             threadutil.semaphorereset(self.semaphore, self.maxconnections)
             for imapobj in self.assignedconnections + self.availableconnections:
-                imapobj.logout()
-            self.assignedconnections = []
-            self.availableconnections = []
-            self.lastowner = {}
+                self.pool.logout(imapobj)
+                self.lastowner.pop(imapobj, None)
+            del self.assignedconnections[:]
+            del self.availableconnections[:]
+            if self.selectrequests:
+                self.ui.debug('imap', "Folder already SELECTed on %d of %d "
+                              "acquired connections (%.0f%%)" %
+                              (self.selecthits, self.selectrequests,
+                               100 * self.getselecthitrate()))
             # reset kerberos state
-            self.gss_step = self.GSS_STATE_STEP
-            self.gss_vc = None
-            self.gssapi = False
+            with self.gsslock:
+                self.gss_step = self.GSS_STATE_STEP
+                self.gss_vc = None
+                self.gssapi = False
 
     def keepalive(self, timeout, event):
-        """Sends a NOOP to each connection recorded.   It will wait a maximum
-        of timeout seconds between doing this, and will continue to do so
-        until the Event object as passed is true.  This method is expected
-        to be invoked in a separate thread, which should be join()'d after
-        the event is set."""
-        self.ui.debug('imap', 'keepalive thread started')
-        while not event.isSet():
-            self.connectionlock.acquire()
-            numconnections = len(self.assignedconnections) + \
-                             len(self.availableconnections)
-            self.connectionlock.release()
+        """Keep the connections alive until the Event `event` is set
 
-            threads = []
-            for i in range(numconnections):
-                self.ui.debug('imap', 'keepalive: processing connection %d of %d' % (i, numconnections))
-                if len(self.idlefolders) > i:
-                    # IDLE thread
-                    idler = IdleThread(self, self.idlefolders[i])
-                else:
-                    # NOOP thread
-                    idler = IdleThread(self)
-                idler.start()
-                threads.append(idler)
+        Connections for the idlefolders wait in IDLE (each in an
+        IdleThread) all the time. Every `timeout` seconds, the other
+        ones are looked after by maintainconnections(). This method is
+        expected to be invoked in a separate thread, which should be
+        join()'d after the event is set."""
+        self.ui.debug('imap', 'keepalive thread started')
+        with self.connectionlock:
+            # keep as many connections as the sync left us
+            target = len(self.availableconnections) + \
+                len(self.assignedconnections)
+        idlers = self.getidlers(timeout)
+        for idler in idlers:
+            idler.start()
 
+        while not event.isSet():
             self.ui.debug('imap', 'keepalive: waiting for timeout')
             event.wait(timeout)
-            self.ui.debug('imap', 'keepalive: after wait')
+            if not event.isSet():
+                target = self.maintainconnections(target)
 
-            for idler in threads:
-                # Make sure all the commands have completed.
-                idler.stop()
-                idler.join()
-            self.ui.debug('imap', 'keepalive: all threads joined')
+        for idler in idlers:
+            # Make sure all the commands have completed.
+            idler.stop()
+            idler.join()
         self.ui.debug('imap', 'keepalive: event is set; exiting')
-        return
+
+    def getidlers(self, timeout):
+        """Return the (unstarted) threads watching the idlefolders
+
+        One NotifyThread watches all of them, and the subscribed folders
+        with 'idlesubscribed', if the server supports that. Otherwise
+        there is an IdleThread for each of the idlefolders."""
+        if not self.idlefolders and not self.idlesubscribed:
+            return []
+        if self.hasnotify():
+            return [NotifyThread(self, self.idlefolders,
+                                 self.idlesubscribed, timeout)]
+        if self.idlesubscribed:
+            self.ui.warn("Server '%s' does not support NOTIFY and IDLE, "
+                         "cannot watch all subscribed folders." % self.repos)
+        return [IdleThread(self, folder, timeout)
+                for folder in self.idlefolders]
+
+    def hasnotify(self):
+        """Whether the server supports NOTIFY (RFC 5465) and IDLE, which
+        NotifyThread waits for the notifications in"""
+        try:
+            imapobj = self.acquireconnection()
+        except OfflineImapError as e:
+            self.ui.error(e, exc_info()[2])
+            return False
+        self.releaseconnection(imapobj)
+        return 'NOTIFY' in imapobj.capabilities and \
+            'IDLE' in imapobj.capabilities
+
+    def maintainconnections(self, target):
+        """Send a NOOP on every available connection
+
+        Connections that do not respond are dropped and replaced, so
+        that the next sync does not have to wait for them: new ones are
+        opened until there are `target` connections again. Ones that
+        have not been used for longer than 'connectionttl' are dropped
+        for good.
+
+        :returns: the target lowered by the connections that expired"""
+        now = time.time()
+        with self.connectionlock:
+            connections = list(self.availableconnections)
+        numnoops = numdropped = numexpired = 0
+        for imapobj in connections:
+            # hold a slot for the connection while it is not available
+            if not self.semaphore.acquire(False):
+                break
+            try:
+                with self.connectionlock:
+                    if imapobj not in self.availableconnections:
+                        continue # taken by someone else meanwhile
+                    self.availableconnections.remove(imapobj)
+                idlesince = self.pool.idlesince.get(imapobj, now)
+                if self.connectionttl and \
+                        now - idlesince > self.connectionttl:
+                    self.pool.logout(imapobj)
+                    numexpired += 1
+                    continue
+                try:
+                    imapobj.noop()
+                except Exception as e:
+                    self.ui.debug('imap', 'keepalive: dropping connection '
+                                  '%s: %s' % (imapobj.identifier, e))
+                    self.pool.logout(imapobj)
+                    numdropped += 1
+                    continue
+                numnoops += 1
+                with self.connectionlock:
+                    self.availableconnections.append(imapobj)
+                    self.pool.idlesince[imapobj] = idlesince
+            finally:
+                self.semaphore.release()
+
+        target -= numexpired
+        with self.connectionlock:
+            missing = target - len(self.availableconnections) - \
+                len(self.assignedconnections)
+        self.ui.debug('imap', 'keepalive: %d NOOPs, %d connections expired, '
+                      '%d dropped, %d to reopen' % (numnoops, numexpired,
+                      numdropped, max(missing, 0)))
+        for i in range(missing):
+            self.prewarmconnection()
+        return target
 
     def verifycert(self, cert, hostname):
         '''Verify that cert (in socket.getpeercert() format) matches hostname.
@@ -459,18 +1102,17 @@ class IMAPServer:
 
 
 class IdleThread(object):
-    def __init__(self, parent, folder=None):
-        """If invoked without 'folder', perform a NOOP and wait for
-        self.stop() to be called. If invoked with folder, switch to IDLE
-        mode and synchronize once we have a new message"""
+    def __init__(self, parent, folder, timeout):
+        """Switch to IDLE mode on `folder` and synchronize it once we
+        have a new message, until self.stop() is called. IDLE is renewed
+        every `timeout` seconds."""
         self.parent = parent
         self.folder = folder
+        self.timeout = timeout
         self.stop_sig = Event()
+        self.wakeup = Event()
         self.ui = getglobalui()
-        if folder is None:
-            self.thread = Thread(target=self.noop)
-        else:
-            self.thread = Thread(target=self.idle)
+        self.thread = Thread(target=self.idle)
         self.thread.setDaemon(1)
 
     def start(self):
@@ -478,38 +1120,28 @@ class IdleThread(object):
 
     def stop(self):
         self.stop_sig.set()
+        self.wakeup.set()
 
     def join(self):
         self.thread.join()
 
-    def noop(self):
-        #TODO: AFAIK this is not optimal, we will send a NOOP on one
-        #random connection (ie not enough to keep all connections
-        #open). In case we do the noop multiple times, we can well use
-        #the same connection every time, as we get a random one. This
-        #function should IMHO send a noop on ALL available connections
-        #to the server.
-        imapobj = self.parent.acquireconnection()
-        try:
-            imapobj.noop()
-        except imapobj.abort:
-            self.ui.warn('Attempting NOOP on dropped connection %s' % \
-                             imapobj.identifier)
-            self.parent.releaseconnection(imapobj, True)
-            imapobj = None
-        finally:
-            if imapobj:
-                self.parent.releaseconnection(imapobj)
-                self.stop_sig.wait() # wait until we are supposed to quit
+    def dosync(self, foldername=None):
+        """Sync the folder we watch, or folder `foldername`
 
-    def dosync(self):
+        Only the new and expunged messages are synced if possible, see
+        accounts.syncnewmessages()."""
         remoterepos = self.parent.repos
         account = remoterepos.account
         localrepos = account.localrepos
         remoterepos = account.remoterepos
         statusrepos = account.statusrepos
-        remotefolder = remoterepos.getfolder(self.folder)
-        offlineimap.accounts.syncfolder(account, remotefolder, quick=False)
+        remotefolder = remoterepos.getfolder(foldername or self.folder)
+        if not remotefolder.sync_this:
+            return
+        if not offlineimap.accounts.syncnewmessages(account, remotefolder):
+            offlineimap.accounts.syncfolder(account, remotefolder, quick=False)
+        if account.folderstats is not None:
+            account.folderstats.save()
         ui = getglobalui()
         ui.unregisterthread(currentThread()) #syncfolder registered the thread
 
@@ -523,13 +1155,16 @@ class IdleThread(object):
             connections, or c) the standard imaplib IDLE timeout of 29
             minutes kicks in."""
             result, cb_arg, exc_data = args
-            if exc_data is None and not self.stop_sig.isSet():
+            if exc_data is None and not self.stop_sig.isSet() and \
+                    not self.renewing:
                 # No Exception, and we are not supposed to stop:
                 self.needsync = True
-            self.stop_sig.set() # continue to sync
+            self.wakeup.set() # continue to sync
 
         while not self.stop_sig.isSet():
             self.needsync = False
+            self.renewing = False
+            self.wakeup.clear()
 
             success = False # successfully selected FOLDER?
             while not success:
@@ -551,7 +1186,9 @@ class IdleThread(object):
                 self.ui.warn("IMAP IDLE not supported on server '%s'."
                     "Sleep until next refresh cycle." % imapobj.identifier)
                 imapobj.noop()
-            self.stop_sig.wait() # self.stop() or IDLE callback are invoked
+            # self.stop() or IDLE callback are invoked, or time to renew
+            self.wakeup.wait(self.timeout)
+            self.renewing = True
             try:
                 # End IDLE mode with noop, imapobj can point to a dropped conn.
                 imapobj.noop()
@@ -565,5 +1202,108 @@ class IdleThread(object):
             if self.needsync:
                 # here not via self.stop, but because IDLE responded. Do
                 # another round and invoke actual syncing.
-                self.stop_sig.clear()
                 self.dosync()
+
+
+class NotifyThread(IdleThread):
+    """Watch several folders for changes on a single connection
+
+    With NOTIFY (RFC 5465), the server tells us about new, expunged and
+    changed messages in any of the folders we ask for, as STATUS
+    responses. We wait for them in IDLE (in authenticated state, no
+    folder is SELECTed) and sync the folders they name. The connection
+    is kept until self.stop() is called."""
+
+    events = ('MessageNew', 'MessageExpunge', 'FlagChange')
+
+    def __init__(self, parent, folders, subscribed, timeout):
+        """Watch `folders` and, if `subscribed`, all subscribed ones"""
+        IdleThread.__init__(self, parent, None, timeout)
+        self.folders = folders
+        self.subscribed = subscribed
+
+    def setnotify(self, imapobj):
+        """Ask the server for notifications, raises OfflineImapError"""
+        events = self.events
+        while True:
+            spec = '(%s)' % ' '.join(events)
+            groups = []
+            if self.subscribed:
+                groups.append('(subscribed %s)' % spec)
+            if self.folders:
+                names = ['"%s"' % name.replace('\\', '\\\\').replace('"', '\\"')
+                         for name in self.folders]
+                groups.append('(mailboxes (%s) %s)' % (' '.join(names), spec))
+            typ, dat = imapobj.xatom('NOTIFY', 'SET', *groups)
+            if typ == 'OK':
+                return
+            if 'FlagChange' in events and 'BADEVENT' in str(dat).upper():
+                # servers need not report flag changes of unselected folders
+                events = [event for event in events if event != 'FlagChange']
+                continue
+            raise OfflineImapError("NOTIFY on server '%s' failed: %s" %
+                                   (self.parent.repos, dat),
+                                   OfflineImapError.ERROR.REPO)
+
+    def getchanged(self, imapobj):
+        """Return the names of the folders we got notifications for"""
+        changed = []
+        if imapobj._get_untagged_response('NOTIFICATIONOVERFLOW') is not None:
+            # the server gave up telling us, sync what we know of
+            changed.extend(self.folders)
+        while True:
+            statuses = imapobj._get_untagged_response('STATUS')
+            if not statuses:
+                break
+            for status in statuses:
+                if not isinstance(status, basestring):
+                    continue # mailbox name as literal, not worth it
+                name = imaputil.dequote(imaputil.imapsplit(status)[0])
+                if name not in changed:
+                    changed.append(name)
+        return changed
+
+    def idle(self):
+        """Wait for notifications until self.stop() is invoked"""
+        def callback(args):
+            """IDLE callback function invoked by imaplib2, see
+            IdleThread.idle()"""
+            self.wakeup.set()
+
+        imapobj = None
+        while not self.stop_sig.isSet():
+            if imapobj is None:
+                imapobj = self.parent.acquireconnection()
+                try:
+                    self.setnotify(imapobj)
+                except Exception as e:
+                    self.ui.error(e, exc_info()[2])
+                    self.parent.releaseconnection(imapobj, True)
+                    imapobj = None
+                    self.stop_sig.wait(self.timeout)
+                    continue
+            self.wakeup.clear()
+            imapobj.idle(callback=callback)
+            # notification or self.stop() or time to renew
+            self.wakeup.wait(self.timeout)
+            try:
+                # End IDLE mode with noop, imapobj can point to a dropped conn.
+                imapobj.noop()
+            except imapobj.abort:
+                self.ui.warn('Attempting NOOP on dropped connection %s' % \
+                                 imapobj.identifier)
+                self.parent.releaseconnection(imapobj, True)
+                imapobj = None
+                continue
+            for foldername in self.getchanged(imapobj):
+                if self.stop_sig.isSet():
+                    break
+                self.dosync(foldername)
+
+        if imapobj is not None:
+            try:
+                imapobj.xatom('NOTIFY', 'NONE')
+            except imapobj.abort:
+                self.parent.releaseconnection(imapobj, True)
+            else:
+                self.parent.releaseconnection(imapobj)
@@ -18,6 +18,7 @@
 
 import re
 import string
+from offlineimap import headerscan
 from offlineimap.ui import getglobalui
 
 
@@ -218,3 +219,28 @@ def uid_sequence(uidlist):
 
     retval.append(getrange(start, end)) # Add final range/item
     return ",".join(retval)
+
+def uid_sequence_chunks(uidlist, maxlen=1000):
+    """Split a UID list into several uid_sequence() strings
+
+    Each string is at most maxlen characters long (unless a single
+    range is longer), to keep IMAP command lines short for sparse UID
+    lists.
+
+    :returns: list of sequence set strings"""
+    chunks, current = [], ''
+    for part in uid_sequence(uidlist).split(','):
+        if current and len(current) + 1 + len(part) > maxlen:
+            chunks.append(current)
+            current = ''
+        current = current + ',' + part if current else part
+    if current:
+        chunks.append(current)
+    return chunks
+
+def getmessageid(headers):
+    """Return the stripped Message-ID of a message header block
+
+    :param headers: The header part of a message (a body may follow).
+    :returns: The Message-ID as string or `None` if there is none."""
+    return headerscan.getheader(headers, 'Message-ID') or None
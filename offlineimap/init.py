@@ -24,7 +24,8 @@ import socket
 import logging
 from optparse import OptionParser
 import offlineimap
-from offlineimap import accounts, threadutil, syncmaster
+from offlineimap import accounts, threadutil, syncmaster, msgtransform, \
+    controlsocket
 from offlineimap.error import OfflineImapError
 from offlineimap.ui import UI_LIST, setglobalui, getglobalui
 from offlineimap.CustomConfig import CustomConfigParser
@@ -62,6 +63,14 @@ class OfflineImap:
               " outputs 'Would create folder X', but not how many and which m"
               "ails it would transfer.")
 
+        parser.add_option("--bulk-import",
+                  action="store_true", dest="bulkimport",
+                  default=False,
+                  help="Speed up the initial download into empty folders. "
+              "Messages are not fsync'ed one by one and status cache entries "
+              "are written in batches at checkpoints, after making sure the "
+              "messages written so far have hit the disk.")
+
         parser.add_option("--info",
                   action="store_true", dest="diagnostics",
                   default=False,
@@ -224,6 +233,17 @@ class OfflineImap:
         if options.dryrun:
             dryrun = config.set('general','dry-run', "True")
         config.set_if_not_exists('general','dry-run','False')
+        if options.bulkimport:
+            config.set('general', 'bulk-import', "True")
+
+        # The message transform workers must be forked before any thread
+        # starts, and the curses UI starts one right away. Accounts that
+        # may get spread over sync processes get workers in those.
+        self.transforminit = not options.diagnostics and \
+            (options.singlethreading or ui_type.lower() == 'blinkenlights' or
+             config.getdefaultint('general', 'maxsyncprocesses', 1) <= 1)
+        if self.transforminit:
+            msgtransform.init(config)
 
         try:
             # create the ui class
@@ -299,6 +319,8 @@ class OfflineImap:
                     threadutil.initInstanceLimit(instancename,
                         config.getdefaultint('Repository ' + reposname,
                                                   'maxconnections', 2))
+            # reserved for priority folders, see SyncableAccount.sync()
+            threadutil.initInstanceLimit("PRIORITY_" + reposname, 1)
         self.config = config
         return (options, args)
 
@@ -359,17 +381,43 @@ class OfflineImap:
             #various initializations that need to be performed:
             offlineimap.mbnames.init(self.config, syncaccounts)
 
-            if options.singlethreading:
-                #singlethreaded
-                self.sync_singlethreaded(syncaccounts)
-            else:
-                # multithreaded
-                t = threadutil.ExitNotifyThread(target=syncmaster.syncitall,
-                                 name='Sync Runner',
-                                 kwargs = {'accounts': syncaccounts,
-                                           'config': self.config})
-                t.start()
-                threadutil.exitnotifymonitorloop(threadutil.threadexited)
+            numprocesses = self.config.getdefaultint('general',
+                                                     'maxsyncprocesses', 1)
+            multiprocess = not options.singlethreading and \
+                numprocesses > 1 and len(syncaccounts) > 1 and \
+                not isinstance(self.ui, UI_LIST.get('blinkenlights', ()))
+            if not multiprocess and not self.transforminit:
+                # before the control server thread starts
+                msgtransform.init(self.config)
+            controlserver = None
+            controlpath = self.config.getdefault('general', 'controlsocket',
+                                                 None)
+            if controlpath and multiprocess:
+                self.ui.warn("The control socket is not available with "
+                             "several sync processes, ignoring it")
+            elif controlpath:
+                controlserver = controlsocket.ControlServer(
+                    os.path.expanduser(controlpath))
+                controlserver.start()
+            try:
+                if options.singlethreading:
+                    #singlethreaded
+                    self.sync_singlethreaded(syncaccounts)
+                elif multiprocess:
+                    # accounts spread over several processes
+                    self.ui.terminate(syncmaster.syncitall_processes(
+                            syncaccounts, self.config, numprocesses))
+                else:
+                    # multithreaded
+                    t = threadutil.ExitNotifyThread(
+                        target=syncmaster.syncitall, name='Sync Runner',
+                        kwargs = {'accounts': syncaccounts,
+                                  'config': self.config})
+                    t.start()
+                    threadutil.exitnotifymonitorloop(threadutil.threadexited)
+            finally:
+                if controlserver is not None:
+                    controlserver.close()
             self.ui.terminate()
         except (SystemExit):
             raise
@@ -24,6 +24,9 @@ boxes = {}
 config = None
 accounts = None
 mblock = Lock()
+forward = None
+"""If set, write() hands the boxes to this callable instead of writing
+the file itself (used by worker processes, see syncmaster)"""
 
 def init(conf, accts):
     global config, accounts
@@ -37,6 +40,9 @@ def add(accountname, foldername):
         boxes[accountname].append(foldername)
 
 def write():
+    if forward is not None:
+        forward(dict(boxes))
+        return
     # See if we're ready to write it out.
     for account in accounts:
         if account not in boxes:
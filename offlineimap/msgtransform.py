@@ -0,0 +1,113 @@
+# CPU bound message transformations, optionally in worker processes
+# Copyright (C) 2012 John Goerzen & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+
+"""Transformations of message bodies, e.g. line ending conversion
+
+Python threads only run one at a time, so converting large messages in
+the copy threads stalls all other threads (including those that only
+want to move bytes over the network). If 'transformprocesses' is set
+in the [general] section, :func:`run` hands large messages to a pool
+of worker processes instead. All transformations need to be module
+level functions, so that they can be passed to the workers.
+
+Messages are not pickled through the pool's pipes, unpickling the
+result in the pool's handler thread would hold the lock for as long as
+the conversion itself. They are passed in a temporary file (in
+/dev/shm where available), whose reads and writes release the lock."""
+
+import os
+import mmap
+import tempfile
+from offlineimap import headerscan
+
+MINSIZE = 65536
+"""Messages smaller than that are transformed in the calling thread,
+passing them to a worker would cost more than it saves"""
+
+_pool = None
+_tmpdir = None
+
+
+def init(config):
+    """Start the worker pool if 'transformprocesses' asks for one
+
+    Must be called before the process starts any threads, forking a
+    threaded process can leave locks held in the workers. A process
+    forked later (see syncmaster) must call it again for a pool of its
+    own."""
+    global _pool, _tmpdir
+    processes = config.getdefaultint('general', 'transformprocesses', 0)
+    _pool = None
+    if processes > 0:
+        import multiprocessing
+        _pool = multiprocessing.Pool(processes)
+        _tmpdir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def _runfile(func, path, args):
+    """Replace the content of file `path` with func(content, *args)"""
+    with open(path, 'r+b') as f:
+        buf = mmap.mmap(f.fileno(), 0)
+        try:
+            result = func(buf[:], *args)
+        finally:
+            buf.close()
+        f.seek(0)
+        f.write(result)
+        f.truncate()
+
+
+def run(func, content, *args):
+    """Return func(content, *args), computed by a worker if worthwhile"""
+    if _pool is None or len(content) < MINSIZE:
+        return func(content, *args)
+    fd, path = tempfile.mkstemp(prefix='offlineimap', dir=_tmpdir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        _pool.apply(_runfile, (func, path, args))
+        with open(path, 'rb') as f:
+            return f.read()
+    finally:
+        os.unlink(path)
+
+
+def tocrlf(content):
+    """Convert bare LF line endings to CRLF"""
+    return content.replace("\r\n", "\n").replace("\n", "\r\n")
+
+
+def fromcrlf(content):
+    """Convert CRLF line endings to LF"""
+    return content.replace("\r\n", "\n")
+
+
+def addheader(content, headername, headervalue):
+    """Insert a header line at the end of the headers of a message
+
+    The line ends like the first line of the message, CRLF if there is
+    none."""
+    insertionpoint = headerscan.headerend(content)
+    if insertionpoint == len(content) and not content.endswith("\n"):
+        insertionpoint = 0 # not even a header line, prepend ours
+    eol = "\r\n"
+    firstbreak = content.find("\n")
+    if firstbreak >= 0 and content[firstbreak - 1:firstbreak] != "\r":
+        eol = "\n"
+    return "%s%s: %s%s%s" % (content[:insertionpoint], headername,
+                              headervalue, eol, content[insertionpoint:])
+
@@ -47,6 +47,7 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         self.folderfilter = lambda foldername: 1
         self.folderincludes = []
         self.foldersort = None
+        self.priorityfilter = lambda foldername: False
         if self.config.has_option(self.getsection(), 'nametrans'):
             self.nametrans = self.localeval.eval(
                 self.getconf('nametrans'), {'re': re})
@@ -59,6 +60,9 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         if self.config.has_option(self.getsection(), 'foldersort'):
             self.foldersort = self.localeval.eval(
                 self.getconf('foldersort'), {'re': re})
+        if self.config.has_option(self.getsection(), 'priorityfilter'):
+            self.priorityfilter = self.localeval.eval(
+                self.getconf('priorityfilter'), {'re': re})
 
     def restore_atime(self):
         """Sets folders' atime back to their values after a sync
@@ -77,6 +81,11 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         this function."""
         pass
 
+    def prewarm(self):
+        """Open connections to the server ahead of their use, if the
+        repository type supports and is configured to do so"""
+        pass
+
     def holdordropconnections(self):
         pass
 
@@ -97,6 +106,13 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         """Account name as string"""
         return self._accountname
 
+    def getcontentindex(self):
+        """Return the account's :class:`offlineimap.contentindex.ContentIndex`
+
+        Only repositories that can reuse locally stored messages return
+        one, and only if the 'contentindex' account option is set."""
+        return None
+
     def getuiddir(self):
         return self.uiddir
 
@@ -133,6 +149,10 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         """Should this folder be synced?"""
         return fname in self.folderincludes or self.folderfilter(fname)
 
+    def is_priority_folder(self, fname):
+        """Should this folder be synced ahead of the others?"""
+        return bool(self.priorityfilter(fname))
+
     def get_create_folders(self):
         """Is folder creation enabled on this repository?
 
@@ -162,6 +182,21 @@ class BaseRepository(CustomConfig.ConfigHelperMixin, object):
         this."""
         pass
 
+    def syncremotemoves(self, remoterepos, statusrepos):
+        """Optimization pass for messages moved between remote folders
+
+        Messages that were moved between folders on the remote side show
+        up as deleted in one folder and as new in another one. Local
+        repositories that can move messages between their folders
+        cheaply may detect such moves and carry them out locally, rather
+        than deleting and downloading the message again. Classes are not
+        required to implement this.
+
+        :returns: the remote folders whose message lists, and those of
+            their local and status folders, have been loaded and can be
+            used by the following folder syncs"""
+        return []
+
     def sync_folder_structure(self, dst_repo, status_repo):
         """Syncs the folders in this repository to those in dest.
 
@@ -64,13 +64,13 @@ class IMAPRepository(BaseRepository):
         self.imapserver.close()
 
     def getholdconnectionopen(self):
-        if self.getidlefolders():
+        if self.getidlefolders() or self.getidlesubscribed():
             return 1
         return self.getconfboolean("holdconnectionopen", 0)
 
     def getkeepalive(self):
         num = self.getconfint("keepalive", 0)
-        if num == 0 and self.getidlefolders():
+        if num == 0 and (self.getidlefolders() or self.getidlesubscribed()):
             return 29*60
         else:
             return num
@@ -188,15 +188,46 @@ class IMAPRepository(BaseRepository):
     def getreference(self):
         return self.getconf('reference', '')
 
+    def getserverinfofile(self):
+        """Return the name of the server info cache file or None"""
+        if not self.getconfboolean('cacheserverinfo', False):
+            return None
+        return os.path.join(self.config.getmetadatadir(),
+                            'Repository-' + self.getname(), 'serverinfo')
+
     def getidlefolders(self):
         localeval = self.localeval
         return localeval.eval(self.getconf('idlefolders', '[]'))
 
+    def getidlesubscribed(self):
+        return self.getconfboolean('idlesubscribed', False)
+
     def getmaxconnections(self):
         num1 = len(self.getidlefolders())
         num2 = self.getconfint('maxconnections', 1)
         return max(num1, num2)
 
+    def getminconnections(self):
+        return self.getconfint('minconnections', 1)
+
+    def getautotune(self):
+        return self.getconfboolean('autotune', False)
+
+    def getbatchsize(self):
+        return max(self.getconfint('batchsize', 100), 1)
+
+    def getminbatchsize(self):
+        return max(self.getconfint('minbatchsize', 10), 1)
+
+    def geteventloop(self):
+        return self.getconfboolean('eventloop', False)
+
+    def getconnectionttl(self):
+        return self.getconfint('connectionttl', 0)
+
+    def getmaxhostconnections(self):
+        return self.getconfint('maxhostconnections', 0)
+
     def getexpunge(self):
         return self.getconfboolean('expunge', 1)
 
@@ -265,6 +296,10 @@ class IMAPRepository(BaseRepository):
         imapobj = self.imapserver.acquireconnection()
         self.imapserver.releaseconnection(imapobj)
 
+    def prewarm(self):
+        if self.getconfboolean('prewarmconnections', False):
+            self.imapserver.prewarm()
+
     def forgetfolders(self):
         self.folders = None
 
@@ -20,6 +20,8 @@ from offlineimap import folder
 from offlineimap.ui import getglobalui
 from offlineimap.error import OfflineImapError
 from offlineimap.repository.Base import BaseRepository
+from offlineimap.contentindex import ContentIndex
+from offlineimap.folder.Base import invert_idsizes
 import os
 from stat import *
 
@@ -35,6 +37,11 @@ class MaildirRepository(BaseRepository):
         self.debug("MaildirRepository initialized, sep is " + repr(self.getsep()))
         self.folder_atimes = []
         self.deletecounter = 0
+        self.contentindex = None
+        self.filenames = {}
+        if self.account.getconfboolean('contentindex', False):
+            self.contentindex = ContentIndex(os.path.join(
+                    self.account.getaccountmeta(), 'ContentIndex'))
 
         # Create the top-level folder if it doesn't exist
         if not os.path.isdir(self.root):
@@ -61,6 +68,29 @@ class MaildirRepository(BaseRepository):
             os.utime(new_dir, (new_atime, os.path.getmtime(new_dir)))
             os.utime(cur_dir, (cur_atime, os.path.getmtime(cur_dir)))
 
+    def getcontentindex(self):
+        return self.contentindex
+
+    def getfilenames(self, dirpath, infosep):
+        """Return a listing of the message files in dirpath
+
+        Used to find messages recorded in the content index after
+        they have been renamed. Listings are cached until the mtime of
+        the directory changes.
+
+        :returns: dict mapping the unique part of each file name (up to
+            `infosep`) to the file name"""
+        try:
+            mtime = os.stat(dirpath).st_mtime
+        except OSError:
+            return {}
+        if self.filenames.get(dirpath, (None,))[0] != mtime:
+            filenames = {}
+            for filename in os.listdir(dirpath):
+                filenames[filename.split(infosep, 1)[0]] = filename
+            self.filenames[dirpath] = (mtime, filenames)
+        return self.filenames[dirpath][1]
+
     def getlocalroot(self):
         return os.path.expanduser(self.getconf('localfolders'))
 
@@ -343,3 +373,81 @@ class MaildirRepository(BaseRepository):
         self.forgetfolders()
         remoterepos.forgetfolders()
         statusrepos.forgetfolders()
+
+    def syncremotemoves(self, remoterepos, statusrepos):
+        """Carry out messages moves between remote folders locally
+
+        A message that was moved on the server disappears from one
+        remote folder and shows up with a new UID in another one. The
+        regular sync would delete our copy and download it again. We
+        match the vanished and the new messages by Message-ID and size
+        and rename the local file instead, updating both status
+        folders, so that the following folder syncs have nothing left
+        to do for them. See repository/Base for details."""
+        folders = []
+        for remotefolder in remoterepos.getfolders():
+            if not remotefolder.sync_this:
+                continue
+            name = remotefolder.getvisiblename()
+            try:
+                localfolder = self.getfolder(
+                    name.replace(remoterepos.getsep(), self.getsep()))
+            except OfflineImapError:
+                continue # Not created locally yet, nothing to move
+            if not localfolder.sync_this:
+                continue
+            statusfolder = statusrepos.getfolder(
+                name.replace(remoterepos.getsep(), statusrepos.getsep()))
+            statusfolder.cachemessagelist()
+            if not localfolder.check_uidvalidity() or \
+                    not remotefolder.check_uidvalidity():
+                continue # syncfolder() will complain about these
+            localfolder.cachemessagelist()
+            remotefolder.cachemessagelist()
+            folders.append((remotefolder, localfolder, statusfolder))
+
+        # Key both sets by (folder index, UID), so that invert_idsizes()
+        # also drops keys that are ambiguous across folders.
+        gone, new = {}, {}
+        for index, (remote, local, status) in enumerate(folders):
+            uids = [uid for uid in status.getmessageuidlist() if uid > 0
+                    and not remote.uidexists(uid) and local.uidexists(uid)]
+            for uid, key in local.getmessageidsizes(uids).items():
+                gone[(index, uid)] = key
+        if gone:
+            for index, (remote, local, status) in enumerate(folders):
+                uids = [uid for uid in remote.getmessageuidlist()
+                        if not status.uidexists(uid)]
+                if not uids:
+                    continue
+                for uid, key in remote.getmessageidsizes(uids).items():
+                    new[(index, uid)] = key
+        gonekeys = invert_idsizes(gone)
+        newkeys = invert_idsizes(new)
+
+        deleted, added = {}, {}
+        moved = 0
+        for key, (dstindex, newuid) in newkeys.items():
+            if not key in gonekeys:
+                continue
+            srcindex, olduid = gonekeys[key]
+            srclocal = folders[srcindex][1]
+            dstlocal = folders[dstindex][1]
+            flags = srclocal.getmessageflags(olduid)
+            if srcindex == dstindex:
+                srclocal.change_message_uid(olduid, newuid)
+            elif not srclocal.movemessageto(olduid, dstlocal, newuid):
+                continue
+            deleted.setdefault(srcindex, []).append(olduid)
+            added.setdefault(dstindex, {})[newuid] = flags
+            moved += 1
+
+        for index, uids in deleted.items():
+            folders[index][2].deletemessages(uids)
+        for index, messages in added.items():
+            folders[index][2].addmessages(messages)
+        if moved:
+            self.ui.detectedmoves(self, moved)
+
+        # All changes went into the cached message lists as well
+        return [remotefolder for remotefolder, local, status in folders]
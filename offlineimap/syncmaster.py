@@ -16,9 +16,19 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
+from offlineimap import mbnames, msgtransform, threadutil
 from offlineimap.threadutil import threadlist, InstanceLimitedThread
 from offlineimap.accounts import SyncableAccount
+from offlineimap.ui import getglobalui
 from threading import currentThread
+try:
+    from Queue import Empty
+except ImportError: # python3
+    from queue import Empty
+import logging
+import multiprocessing
+import os
+import signal
 
 def syncaccount(threads, config, accountname):
     account = SyncableAccount(config, accountname)
@@ -37,3 +47,94 @@ def syncitall(accounts, config):
         syncaccount(threads, config, accountname)
     # Wait for the threads to finish.
     threads.reset()
+
+
+class QueueLogHandler(logging.Handler):
+    """Logging handler passing records of a worker process to the parent"""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            # Make the record picklable, args might not be
+            record.msg = record.getMessage()
+            record.args = None
+            record.exc_info = None
+            self.queue.put(('log', record))
+        except Exception:
+            self.handleError(record)
+
+
+def syncprocess(accounts, config, queue):
+    """Entry point of a worker process syncing a share of the accounts
+
+    Runs the accounts in threads like the single process mode does.
+    Log output and the mbnames data are forwarded to the parent through
+    `queue`, the exit status is that of the process."""
+    ui = getglobalui()
+    for handler in list(ui.logger.handlers):
+        ui.logger.removeHandler(handler)
+    ui.logger.addHandler(QueueLogHandler(queue))
+    mbnames.forward = lambda boxes: queue.put(('mbnames', boxes))
+    msgtransform.init(config)
+    t = threadutil.ExitNotifyThread(target = syncitall,
+                                    name = 'Sync Runner',
+                                    kwargs = {'accounts': accounts,
+                                              'config': config})
+    t.start()
+    threadutil.exitnotifymonitorloop(threadutil.threadexited)
+    ui.terminate()
+
+def syncitall_processes(accounts, config, numprocesses):
+    """Spread the accounts over `numprocesses` worker processes
+
+    Outputs the log records of the workers through our UI and writes
+    the mbnames file for all of them.
+
+    :returns: exit status, 0 if all workers succeeded"""
+    ui = getglobalui()
+    queue = multiprocessing.Queue()
+    workers = []
+    for num in range(min(numprocesses, len(accounts))):
+        share = accounts[num::numprocesses]
+        worker = multiprocessing.Process(target = syncprocess,
+                                         name = "Sync process %d" % num,
+                                         args = (share, config, queue))
+        worker.start()
+        workers.append(worker)
+
+    # Pass signals on, the workers inherited our handlers. SIGINT
+    # reaches them via the terminal process group already.
+    def forward_signal(sig, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, sig)
+    for sig in (signal.SIGHUP, signal.SIGUSR1, signal.SIGUSR2,
+                signal.SIGTERM):
+        signal.signal(sig, forward_signal)
+
+    while True:
+        try:
+            kind, data = queue.get(True, 1)
+        except Empty:
+            if not any(worker.is_alive() for worker in workers):
+                break
+            continue
+        except (IOError, OSError):
+            continue # interrupted by a signal
+        if kind == 'log':
+            ui.logger.handle(data)
+        elif kind == 'mbnames':
+            mbnames.boxes.update(data)
+            mbnames.write()
+
+    exitstatus = 0
+    for worker in workers:
+        worker.join()
+        if worker.exitcode:
+            ui.warn("%s exited with status %d" % (worker.name,
+                                                  worker.exitcode))
+            exitstatus = exitstatus or abs(worker.exitcode)
+    return exitstatus
@@ -15,7 +15,8 @@
 #    along with this program; if not, write to the Free Software
 #    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
 
-from threading import Lock, Thread, BoundedSemaphore, currentThread
+from threading import Lock, Thread, BoundedSemaphore, Condition, \
+    currentThread
 try:
     from Queue import Queue, Empty
 except ImportError: # python3
@@ -198,6 +199,45 @@ class ExitNotifyThread(Thread):
         cls.profiledir = directory
 
 
+######################################################################
+# Priority lanes
+######################################################################
+
+class PriorityLane(object):
+    """Let the syncs of priority folders run ahead of bulk transfers
+
+    Threads working on a priority folder enter() the lane and leave()
+    it when done. Bulk work calls wait() where it can pause, ie. between
+    messages, and blocks while priority work of other threads is
+    running, so that its connections and copy slots become free."""
+
+    def __init__(self):
+        self.threads = {}
+        """Threads in the lane, mapped to how often they entered it"""
+        self.cond = Condition()
+
+    def enter(self):
+        thread = currentThread()
+        with self.cond:
+            self.threads[thread] = self.threads.get(thread, 0) + 1
+
+    def leave(self):
+        thread = currentThread()
+        with self.cond:
+            self.threads[thread] -= 1
+            if not self.threads[thread]:
+                del self.threads[thread]
+                if not self.threads:
+                    self.cond.notifyAll()
+
+    def wait(self):
+        """Block while other threads do priority work"""
+        thread = currentThread()
+        with self.cond:
+            while self.threads and not thread in self.threads:
+                self.cond.wait()
+
+
 ######################################################################
 # Instance-limited threads
 ######################################################################
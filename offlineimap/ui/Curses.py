@@ -17,7 +17,6 @@
 
 from threading import RLock, currentThread, Lock, Event
 from collections import deque
-import time
 import sys
 import os
 import signal
@@ -156,13 +155,12 @@ class CursesAccountFrame:
         return tf
 
     def sleeping(self, sleepsecs, remainingsecs):
-        """show how long we are going to sleep and sleep
+        """show how long we are going to sleep
 
         :returns: Boolean, whether we want to abort the sleep"""
         self.drawleadstr(remainingsecs)
         self.ui.exec_locked(self.window.refresh)
-        time.sleep(sleepsecs)
-        return self.account.get_abort_event()
+        return False
 
     def syncnow(self):
         """Request that we stop sleeping asap and continue to sync"""
@@ -170,8 +168,7 @@ class CursesAccountFrame:
         # skipsleep pref
         if isinstance(self.account, offlineimap.accounts.Account):
             self.ui.info("Requested synchronization for acc: %s" % self.account)
-            self.account.config.set('Account %s' % self.account.name,
-                                        'skipsleep', '1')
+            self.account.wake()
 
 class CursesThreadFrame:
     """
@@ -18,7 +18,6 @@ try:
 except ImportError: # python3
     from urllib.parse import urlencode
 import sys
-import time
 import logging
 from threading import currentThread
 from offlineimap.ui.UIBase import UIBase
@@ -144,8 +143,6 @@ class MachineUI(UIBase):
 
     def sleeping(s, sleepsecs, remainingsecs):
         s._printData('sleeping', "%d\n%d" % (sleepsecs, remainingsecs))
-        if sleepsecs > 0:
-            time.sleep(sleepsecs)
         return 0
 
 
@@ -318,6 +318,23 @@ class UIBase(object):
                (folder, folder.getrepository(),
                 folder.get_saveduidvalidity(), folder.get_uidvalidity()))
 
+    def recoveringvalidity(self, folder):
+        self.logger.info("UID validity of folder %s (repo %s) changed (saved "
+                         "%d; got %d); matching local messages against the new"
+                         " UIDs" % (folder, folder.getrepository(),
+                         folder.get_saveduidvalidity(), folder.get_uidvalidity()))
+
+    def recoveredvalidity(self, folder, matched, removed, remaining):
+        self.logger.info("UID validity recovery for folder %s (repo %s): %d "
+                         "messages matched, %d removed locally, %d left to "
+                         "download" % (folder, folder.getrepository(), matched,
+                                       removed, remaining))
+
+    def detectedmoves(self, repos, count):
+        self.logger.info("Moved %d messages locally in %s that had been "
+                         "moved between remote folders" % (count,
+                                                    self.getnicename(repos)))
+
     def loadmessagelist(self, repos, folder):
         self.logger.debug("Loading message list for %s[%s]" % (
                 self.getnicename(repos),
@@ -340,6 +357,11 @@ class UIBase(object):
                 uid, num, num_to_copy, src.repository, src,
                 destfolder.repository))
 
+    def postponingmessages(self, count, src, destfolder):
+        """Output that older messages will be copied in a later pass"""
+        self.logger.info("Postponing %d older messages %s:%s -> %s" % (
+                count, src.repository, src, destfolder.repository))
+
     def deletingmessages(self, uidlist, destlist):
         ds = self.folderlist(destlist)
         prefix = "[DRYRUN] " if self.dryrun else ""
@@ -486,28 +508,30 @@ class UIBase(object):
                   request to cancel the timer.
         """
         abortsleep = False
+        end = time.time() + sleepsecs
         while sleepsecs > 0 and not abortsleep:
-            if account.get_abort_event():
-               abortsleep = True
-            else:
-                abortsleep = self.sleeping(10, sleepsecs)
-                sleepsecs -= 10
+            # The account wakes up as soon as it is told to, the steps
+            # only update the display
+            step = min(sleepsecs, 10)
+            abortsleep = self.sleeping(step, sleepsecs) or \
+                account.waitforwakeup(step)
+            sleepsecs = int(round(end - time.time()))
         self.sleeping(0, 0)  # Done sleeping.
         return abortsleep
 
     def sleeping(self, sleepsecs, remainingsecs):
-        """Sleep for sleepsecs, display remainingsecs to go.
+        """Display that we sleep sleepsecs, remainingsecs to go.
 
         Does nothing if sleepsecs <= 0.
         Display a message on the screen if we pass a full minute.
+        The actual sleeping is up to sleep().
 
         This implementation in UIBase does not support this, but some
-        implementations return 0 for successful sleep and 1 for an
+        implementations return 0 to continue sleeping and 1 for an
         'abort', ie a request to sync immediately.
         """
         if sleepsecs > 0:
             if remainingsecs//60 != (remainingsecs-sleepsecs)//60:
                 self.logger.debug("Next refresh in %.1f minutes" % (
                         remainingsecs/60.0))
-            time.sleep(sleepsecs)
         return 0
@@ -97,6 +97,37 @@ class OLITestLib():
         with open(os.path.join(cls.testdir, 'offlineimap.conf'), "wt") as f:
             config.write(f)
 
+    @classmethod
+    def get_maildir_account(cls, config=None):
+        """Return account 'test' syncing two Maildir repositories
+
+        Folder syncs can be tested without an IMAP server this way: the
+        remote repository is replaced by the Maildir repository 'Remote'
+        in testdir/remote. The account has its local, remote and status
+        repository set, the folders are created by the caller. If config
+        is None, a default one will be used via get_default_config."""
+        from offlineimap import accounts
+        from offlineimap.repository import Repository
+        from offlineimap.repository.Maildir import MaildirRepository
+        if config is None:
+            config = cls.get_default_config()
+        if not config.has_option("general", "dry-run"):
+            config.set("general", "dry-run", "False")
+        config.set("Repository Maildir", "localfolders",
+                   os.path.join(cls.testdir, 'mail'))
+        if not config.has_section("Repository Remote"):
+            config.add_section("Repository Remote")
+        config.set("Repository Remote", "type", "Maildir")
+        config.set("Repository Remote", "localfolders",
+                   os.path.join(cls.testdir, 'remote'))
+        account = accounts.SyncableAccount(config, 'test')
+        if not os.path.isdir(account.getaccountmeta()):
+            os.makedirs(account.getaccountmeta())
+        account.localrepos = Repository(account, 'local')
+        account.remoterepos = MaildirRepository('Remote', account)
+        account.statusrepos = Repository(account, 'status')
+        return account
+
     @classmethod
     def delete_test_dir(cls):
         """Deletes the current test directory
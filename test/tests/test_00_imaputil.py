@@ -97,3 +97,22 @@ class TestInternalFunctions(unittest.TestCase):
         """Test imaputil.uid_sequence()"""
         res = imaputil.uid_sequence([1,2,3,4,5,10,12,13])
         self.assertEqual(res, b'1:5,10,12:13')
+
+    def test_07_uid_sequence_chunks(self):
+        """Test imaputil.uid_sequence_chunks()"""
+        res = imaputil.uid_sequence_chunks([1,2,3,4,5,10,12,13], maxlen=6)
+        self.assertEqual(res, ['1:5,10', '12:13'])
+        res = imaputil.uid_sequence_chunks(range(1, 1000), maxlen=3)
+        self.assertEqual(res, ['1:999'])
+        self.assertEqual(imaputil.uid_sequence_chunks([]), [])
+
+    def test_08_getmessageid(self):
+        """Test imaputil.getmessageid()"""
+        res = imaputil.getmessageid('Date: today\r\nMessage-ID:\r\n '
+                                    '<1@example.com>\r\n\r\nbody')
+        self.assertEqual(res, '<1@example.com>')
+        self.assertEqual(imaputil.getmessageid('Date: today\n\n'), None)
+        res = imaputil.getmessageid('Date: today\nX: y\n\nMessage-ID: <2@b>')
+        self.assertEqual(res, None)
+        res = imaputil.getmessageid('message-id : <1@example.com>\n')
+        self.assertEqual(res, '<1@example.com>')
@@ -0,0 +1,141 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import unittest
+import logging
+
+from offlineimap import accounts
+from offlineimap.contentindex import ContentIndex
+from offlineimap.repository import Repository
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+MESSAGE = 'Message-ID: <1@example.com>\r\nSubject: A\r\n\r\nbody\r\n'
+
+class TestContentIndex(unittest.TestCase):
+    """Test finding identical messages with
+    :class:`offlineimap.contentindex.ContentIndex`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        config.set('general', 'dry-run', 'False')
+        config.set('Account test', 'contentindex', 'yes')
+        config.set('Repository Maildir', 'localfolders',
+                   os.path.join(OLITestLib.testdir, 'mail'))
+        setglobalui(UI_LIST['quiet'](config))
+        account = accounts.Account(config, 'test')
+        os.makedirs(account.getaccountmeta())
+        cls.repository = Repository(account, 'local')
+        cls.contentindex = cls.repository.getcontentindex()
+        for name in ('A', 'B'):
+            OLITestLib.create_maildir(name)
+
+    def getfolder(self, name):
+        folder = self.repository.getfolder(name)
+        folder.cachemessagelist()
+        return folder
+
+    def test_01_persistence(self):
+        """Test that entries are kept in the index file"""
+        filename = os.path.join(OLITestLib.testdir, 'TestIndex')
+        index = ContentIndex(filename)
+        index.add(('<a@b>', 10, 'h1'), 'm1', '/x/1')
+        index.add(('<a@b>', 10, 'h1'), 'm2', '/x/2')
+        index.add(('<c@d>', 20, 'h2'), 'm3', '/x/3')
+        index.add((None, 30, 'h3'), 'm4', '/x/4')
+        with open(filename, 'at') as file:
+            file.write('40\th4\tm5') # truncated by a crash
+        index = ContentIndex(filename)
+        # later lines win
+        self.assertEqual(index.get(('<a@b>', 10, 'h1')), ('m2', '/x/2'))
+        self.assertEqual(index.get(('<c@d>', 20, 'h2')), ('m3', '/x/3'))
+        self.assertEqual(index.get(('<a@b>', 10, 'h2')), None)
+        self.assertEqual(len(index.entries), 2)
+
+    def test_02_linkmessage(self):
+        """Test that a message is linked to an identical local copy"""
+        src = self.getfolder('A')
+        src.savemessage(1, MESSAGE, set('S'), None)
+        srcpath = os.path.join(src.getfullname(),
+                               src.getmessagelist()[1]['filename'])
+        dst = self.getfolder('B')
+        key = src._getcontentkey(MESSAGE)
+        mtime = os.path.getmtime(srcpath)
+        self.assertTrue(dst.linkmessage(5, key, set(), mtime))
+        dstpath = os.path.join(dst.getfullname(),
+                               dst.getmessagelist()[5]['filename'])
+        self.assertTrue(dst.getmessagelist()[5]['filename'].startswith('new'))
+        self.assertTrue(os.path.samefile(srcpath, dstpath))
+        # the same message again is left alone, as are unknown ones
+        self.assertFalse(dst.linkmessage(5, key, set(), None))
+        self.assertFalse(dst.linkmessage(6, ('<2@x>',) + key[1:], set(), None))
+        self.assertFalse(dst.linkmessage(-1, key, set(), None))
+
+    def test_03_mtime(self):
+        """Test that a copy is made if the modification time differs"""
+        src = self.getfolder('A')
+        srcpath = os.path.join(src.getfullname(),
+                               src.getmessagelist()[1]['filename'])
+        dst = self.getfolder('B')
+        key = src._getcontentkey(MESSAGE)
+        rtime = int(os.path.getmtime(srcpath)) - 3600
+        self.assertTrue(dst.linkmessage(6, key, set('S'), rtime))
+        dstpath = os.path.join(dst.getfullname(),
+                               dst.getmessagelist()[6]['filename'])
+        self.assertFalse(os.path.samefile(srcpath, dstpath))
+        self.assertEqual(int(os.path.getmtime(dstpath)), rtime)
+        self.assertEqual(open(dstpath).read(), MESSAGE)
+
+    def test_04_moved(self):
+        """Test that a message renamed since it was indexed is found"""
+        src = self.getfolder('A')
+        src.savemessageflags(1, set('FS'))
+        srcpath = os.path.join(src.getfullname(),
+                               src.getmessagelist()[1]['filename'])
+        dst = self.getfolder('B')
+        key = src._getcontentkey(MESSAGE)
+        self.assertTrue(dst.linkmessage(7, key, set(), None))
+        self.assertTrue(os.path.samefile(srcpath, os.path.join(
+            dst.getfullname(), dst.getmessagelist()[7]['filename'])))
+        # the index now points at the new name
+        self.assertEqual(self.contentindex.get(key)[1], srcpath)
+
+    def test_05_md5(self):
+        """Test that a modified message is not linked"""
+        src = self.getfolder('A')
+        srcpath = os.path.join(src.getfullname(),
+                               src.getmessagelist()[1]['filename'])
+        with open(srcpath, 'at') as file:
+            file.write('edited\r\n')
+        dst = self.getfolder('B')
+        key = src._getcontentkey(MESSAGE)
+        self.assertFalse(dst.linkmessage(8, key, set(), None))
+        self.assertFalse(8 in dst.getmessagelist())
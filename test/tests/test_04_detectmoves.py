@@ -0,0 +1,105 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import unittest
+import logging
+
+from offlineimap import accounts
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+MESSAGE = 'Message-ID: <%d@example.com>\r\nSubject: A\r\n\r\nbody\r\n'
+
+class TestDetectMoves(unittest.TestCase):
+    """Test carrying out remote moves locally with
+    :meth:`offlineimap.repository.Maildir.MaildirRepository.syncremotemoves`
+    and reusing the message lists it loaded in the following folder syncs"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+        cls.account = OLITestLib.get_maildir_account(config)
+        for name in ('A', 'B'):
+            cls.account.remoterepos.makefolder(name)
+            cls.account.localrepos.makefolder(name)
+
+    def folders(self, name):
+        """Return the remote, local and status folder `name`"""
+        account = self.account
+        return (account.remoterepos.getfolder(name),
+                account.localrepos.getfolder(name),
+                account.statusrepos.getfolder(name))
+
+    def test_01_sync(self):
+        """Test that the folders sync without an IMAP server"""
+        remote, local, status = self.folders('A')
+        remote.cachemessagelist()
+        for uid in (1, 2):
+            remote.savemessage(uid, MESSAGE % uid, set('S'), None)
+        accounts.syncfolder(self.account, remote, False)
+        self.assertEqual(sorted(local.getmessageuidlist()), [1, 2])
+        self.assertEqual(sorted(status.getmessageuidlist()), [1, 2])
+
+    def test_02_moves(self):
+        """Test that a remote move is carried out locally and the lists
+        loaded for that are not loaded again"""
+        account = self.account
+        for repos in (account.remoterepos, account.localrepos,
+                      account.statusrepos):
+            repos.forgetfolders()
+        remotea, locala, statusa = self.folders('A')
+        remoteb, localb, statusb = self.folders('B')
+        # move message 2 from A to B, where it becomes message 7
+        remotea.cachemessagelist()
+        remotea.deletemessage(2)
+        remoteb.cachemessagelist()
+        remoteb.savemessage(7, MESSAGE % 2, set('S'), None)
+        remoteb.messagelist = None
+        locala.cachemessagelist()
+        inode = os.stat(os.path.join(locala.getfullname(),
+            locala.getmessagelist()[2]['filename'])).st_ino
+        loaded = account.localrepos.syncremotemoves(account.remoterepos,
+                                                    account.statusrepos)
+        self.assertEqual(sorted(f.getname() for f in loaded), ['A', 'B'])
+        self.assertEqual(locala.getmessageuidlist(), [1])
+        self.assertEqual(localb.getmessageuidlist(), [7])
+        self.assertEqual(statusb.getmessageuidlist(), [7])
+        loads = []
+        for folder in (remotea, locala, statusa, remoteb, localb, statusb):
+            folder.cachemessagelist = lambda folder=folder: loads.append(folder)
+        for folder in loaded:
+            accounts.syncfolder(account, folder, False, folder in loaded)
+        self.assertEqual(loads, [])
+        self.assertEqual(localb.getmessageuidlist(), [7])
+        self.assertEqual(sorted(statusa.getmessageuidlist()), [1])
+        # the local file was moved rather than downloaded again
+        self.assertEqual(os.stat(os.path.join(localb.getfullname(),
+            localb.getmessagelist()[7]['filename'])).st_ino, inode)
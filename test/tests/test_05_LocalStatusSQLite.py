@@ -0,0 +1,100 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestLocalStatusSQLite(unittest.TestCase):
+    """Test the writes of
+    :class:`offlineimap.folder.LocalStatusSQLite.LocalStatusSQLiteFolder`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        config.set('Account test', 'status_backend', 'sqlite')
+        setglobalui(UI_LIST['quiet'](config))
+        cls.account = OLITestLib.get_maildir_account(config)
+
+    def getfolder(self, name):
+        """Return a new folder instance of status folder `name`"""
+        statusrepos = self.account.statusrepos
+        statusrepos.forgetfolders()
+        folder = statusrepos.getfolder(name)
+        folder.cachemessagelist()
+        return folder
+
+    def stored(self, folder):
+        """Return the UIDs and flags written to the database"""
+        return dict(folder.connection.execute('SELECT id,flags from status'))
+
+    def test_01_savemessagefast(self):
+        """Test that savemessagefast() entries are written by save()"""
+        folder = self.getfolder('A')
+        folder.savemessagefast(1, None, set('S'), None)
+        folder.savemessagefast(2, None, set(), None)
+        folder.savemessagefast(-1, None, set(), None)
+        self.assertEqual(sorted(folder.getmessageuidlist()), [1, 2])
+        self.assertEqual(self.stored(folder), {})
+        folder.save()
+        self.assertEqual(self.stored(folder), {1: 'S', 2: ''})
+        self.assertEqual(self.stored(self.getfolder('A')), {1: 'S', 2: ''})
+
+    def test_02_savemessage(self):
+        """Test that other writes write the pending entries first"""
+        folder = self.getfolder('A')
+        folder.savemessagefast(3, None, set(), None)
+        folder.savemessagefast(1, None, set('FS'), None)
+        # a later savemessage() of the same UID wins
+        folder.savemessage(3, None, set('R'), None)
+        self.assertEqual(self.stored(folder), {1: 'FS', 2: '', 3: 'R'})
+        folder.savemessagefast(4, None, set(), None)
+        folder.deletemessages([2, 4])
+        self.assertEqual(self.stored(folder), {1: 'FS', 3: 'R'})
+        # deletemessagelist() drops pending entries
+        folder.savemessagefast(5, None, set(), None)
+        folder.deletemessagelist()
+        folder.save()
+        self.assertEqual(self.stored(folder), {})
+
+    def test_03_rollback(self):
+        """Test that a failed transaction leaves nothing behind"""
+        folder = self.getfolder('B')
+        folder.replacemessagelist({1: set('S'), 2: set()})
+        self.assertEqual(self.stored(folder), {1: 'S', 2: ''})
+        # the second INSERT of UID 3 violates the primary key
+        self.assertRaises(Exception, folder.sql_transaction, [
+                ('DELETE FROM status', None, False),
+                ('INSERT INTO status (id,flags) VALUES (?,?)',
+                 [(3, ''), (3, 'S')], True)])
+        # nor is the DELETE committed by the next write
+        folder.savemessageflags(1, set('RS'))
+        self.assertEqual(self.stored(self.getfolder('B')), {1: 'RS', 2: ''})
@@ -0,0 +1,168 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import shutil
+import unittest
+import logging
+
+from offlineimap import accounts
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+MESSAGE = 'Message-ID: <%d@example.com>\r\nSubject: A\r\n\r\nbody\r\n'
+
+MESSAGE = 'Message-ID: <%d@example.com>\r\nSubject: A\r\n\r\nbody\r\n'
+
+class TestCheckpoints(unittest.TestCase):
+    """Test the status checkpoints of
+    :meth:`offlineimap.folder.Base.BaseFolder.syncmessagesto_copy`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        config.set("Account test", "checkpoint-messages", "2")
+        config.set("Account test", "checkpoint-interval", "3600")
+        setglobalui(UI_LIST['quiet'](config))
+        cls.config = config
+        cls.account = OLITestLib.get_maildir_account(config)
+
+    def tearDown(self):
+        self.config.set("Account test", "checkpoint-messages", "2")
+        accounts.Account.abort_NOW_signal.clear()
+
+    def folders(self, name, count=5):
+        """Return fresh instances of the remote, local and status folder
+        `name`, creating them with `count` remote messages unless 0"""
+        account = self.account
+        for repos in (account.remoterepos, account.localrepos,
+                      account.statusrepos):
+            repos.forgetfolders()
+        if count:
+            account.remoterepos.makefolder(name)
+            account.localrepos.makefolder(name)
+        remote = account.remoterepos.getfolder(name)
+        remote.cachemessagelist()
+        for uid in range(1, count + 1):
+            remote.savemessage(uid, MESSAGE % uid, set('S'), None)
+        local = account.localrepos.getfolder(name)
+        local.cachemessagelist()
+        status = account.statusrepos.getfolder(name)
+        status.cachemessagelist()
+        return remote, local, status
+
+    def saved(self, status):
+        """Return the uids in the status file of `status` on disk"""
+        folder = status.__class__(status.getname(), status.repository)
+        folder.cachemessagelist()
+        return set(folder.getmessageuidlist())
+
+    def files(self, local):
+        """Return the number of message files of `local`"""
+        return sum(len(os.listdir(os.path.join(local.getfullname(), sub)))
+                   for sub in ('cur', 'new', 'tmp'))
+
+    def watch(self, local, status, hook):
+        """Call hook(stored, saved) before `local` stores a message,
+        with the uids it stored so far and those saved in `status`"""
+        stored = []
+        savemessage = local.savemessage
+        def watched(uid, content, flags, rtime):
+            hook(set(stored), self.saved(status))
+            stored.append(uid)
+            return savemessage(uid, content, flags, rtime)
+        local.savemessage = watched
+
+    def test_01_checkpoints(self):
+        """Test that the status gets saved every 'checkpoint-messages'
+        messages and at the end of the pass"""
+        remote, local, status = self.folders('A')
+        seen = []
+        self.watch(local, status,
+                   lambda stored, saved: seen.append((len(stored), saved)))
+        remote.syncmessagesto_copy(local, status, False)
+        self.assertEqual([(n, len(saved)) for n, saved in seen],
+                         [(0, 0), (1, 0), (2, 2), (3, 2), (4, 4)])
+        self.assertEqual(self.saved(status), set(range(1, 6)))
+
+    def test_02_every_message(self):
+        """Test that checkpoint-messages = 1 saves the status after every
+        message, so that a crash loses at most the message being copied"""
+        self.config.set("Account test", "checkpoint-messages", "1")
+        remote, local, status = self.folders('B')
+        seen = []
+        self.watch(local, status,
+                   lambda stored, saved: seen.append((stored, saved)))
+        remote.syncmessagesto_copy(local, status, False)
+        self.assertEqual(len(seen), 5)
+        for stored, saved in seen:
+            self.assertEqual(stored, saved)
+        self.assertEqual(self.saved(status), set(range(1, 6)))
+
+    def test_03_abort(self):
+        """Test that an aborted pass saves what it copied and the next
+        one copies the rest"""
+        remote, local, status = self.folders('C')
+        def abort(stored, saved):
+            if len(stored) == 2:
+                # SIGTERM while the third message gets copied
+                accounts.Account.abort_NOW_signal.set()
+        self.watch(local, status, abort)
+        remote.syncmessagesto_copy(local, status, False)
+        self.assertEqual(len(local.getmessageuidlist()), 3)
+        self.assertEqual(self.saved(status), set(local.getmessageuidlist()))
+        accounts.Account.abort_NOW_signal.clear()
+        remote.syncmessagesto_copy(local, status, False)
+        self.assertEqual(self.files(local), 5)
+        self.assertEqual(self.saved(status), set(range(1, 6)))
+
+    def test_04_crash(self):
+        """Test that a sync resuming from the last checkpoint after a
+        crash neither duplicates nor loses messages"""
+        remote, local, status = self.folders('D')
+        checkpoint = status.filename + '.crash'
+        crash = []
+        def snapshot(stored, saved):
+            if len(stored) == 3:
+                # we get killed here: three messages got stored, the
+                # status on disk is the one of the last checkpoint
+                shutil.copy(status.filename, checkpoint)
+                crash.extend([stored, saved])
+        self.watch(local, status, snapshot)
+        remote.syncmessagesto_copy(local, status, False)
+        stored, saved = crash
+        self.assertEqual(len(saved), 2)
+        self.assertTrue(saved < stored)
+        os.rename(checkpoint, status.filename)
+        remote, local, status = self.folders('D', 0)
+        self.assertEqual(self.saved(status), saved)
+        remote.syncmessagesto_copy(local, status, False)
+        self.assertEqual(self.files(local), 5)
+        self.assertEqual(sorted(local.getmessageuidlist()), range(1, 6))
+        self.assertEqual(self.saved(status), set(range(1, 6)))
@@ -0,0 +1,134 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import threading
+import time
+import unittest
+import logging
+
+
+from offlineimap.error import OfflineImapError
+from offlineimap.folderlease import FolderLeases
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+MESSAGE = 'Message-ID: <%d@example.com>\r\nSubject: A\r\n\r\nbody\r\n'
+
+class TestFolderLeases(unittest.TestCase):
+    """Test the folder leases of :mod:`offlineimap.folderlease`"""
+
+    def leases(self, owner, duration=30):
+        """Return the FolderLeases of process `owner` in the test dir"""
+        leases = FolderLeases(os.path.join(OLITestLib.testdir, 'leases'),
+                              duration)
+        leases.owner = owner
+        self.addCleanup(leases.releaseall)
+        return leases
+
+    def renewers(self):
+        return [thread for thread in threading.enumerate()
+                if thread.name == "Folder lease renewal"]
+
+    def test_01_acquire(self):
+        """Test that a lease is held until it's released"""
+        leases = self.leases('a 1')
+        self.assertTrue(leases.acquire('INBOX'))
+        self.assertTrue(leases.acquire('INBOX'))
+        self.assertTrue(leases.acquire(FolderLeases.ACCOUNT))
+        self.assertTrue(leases.holds('INBOX'))
+        leases.check('INBOX')
+        with open(leases.held['INBOX']) as file:
+            self.assertEqual(file.read(), 'a 1\n')
+        leases.releaseall()
+        self.assertFalse(leases.holds('INBOX'))
+        self.assertEqual(os.listdir(leases.directory), [])
+
+    def test_02_conflict(self):
+        """Test that a fresh lease of another process is respected"""
+        leases, other = self.leases('a 1'), self.leases('b 2')
+        self.assertTrue(leases.acquire('INBOX/a:b'))
+        self.assertFalse(other.acquire('INBOX/a:b'))
+        self.assertFalse(other.holds('INBOX/a:b'))
+        self.assertRaises(OfflineImapError, other.check, 'INBOX/a:b')
+        self.assertTrue(other.acquire('INBOX'))
+        other.releaseall()
+        self.assertTrue(leases.holds('INBOX/a:b'))
+
+    def test_03_stale(self):
+        """Test that an expired lease gets taken over and its former
+        holder neither renews nor releases it then"""
+        leases, other = self.leases('a 1'), self.leases('b 2')
+        self.assertTrue(leases.acquire('INBOX'))
+        path = leases.held['INBOX']
+        os.utime(path, (0, 0))
+        self.assertTrue(other.acquire('INBOX'))
+        self.assertEqual(os.listdir(leases.directory), ['INBOX.lease'])
+        self.assertRaises(OfflineImapError, leases.check, 'INBOX')
+        leases.releaseall()
+        self.assertTrue(other.holds('INBOX'))
+
+    def test_04_renew(self):
+        """Test that leases are renewed, also while another process
+        looks at them to break them"""
+        leases, other = self.leases('a 1'), self.leases('b 2')
+        self.assertTrue(leases.acquire('INBOX'))
+        path = leases.held['INBOX']
+        os.utime(path, (0, 0))
+        leases.renew()
+        self.assertFalse(leases._expired(path))
+        self.assertFalse(other.acquire('INBOX'))
+        # another process renamed it away to break it and puts it back
+        os.rename(path, path + '.stale')
+        putback = threading.Timer(0.05, os.rename, (path + '.stale', path))
+        putback.start()
+        leases.renew()
+        putback.join()
+        self.assertTrue(leases.holds('INBOX'))
+        # and one that was deleted is lost
+        os.unlink(path)
+        leases.renew()
+        self.assertFalse(leases.holds('INBOX'))
+
+    def test_05_renewer(self):
+        """Test that only one renewal thread runs, also after releasing
+        and acquiring leases again"""
+        leases = self.leases('a 1', duration=0.3)
+        self.assertTrue(leases.acquire('INBOX'))
+        self.assertTrue(leases.acquire('Sent'))
+        first = leases._renewer
+        self.assertEqual(self.renewers(), [first])
+        leases.releaseall()
+        self.assertTrue(leases.acquire('INBOX'))
+        self.assertFalse(first.is_alive())
+        self.assertEqual(len(self.renewers()), 1)
+        mtime = os.stat(leases.held['INBOX']).st_mtime
+        os.utime(leases.held['INBOX'], (mtime - 10, mtime - 10))
+        time.sleep(0.2)
+        self.assertTrue(os.stat(leases.held['INBOX']).st_mtime >= mtime)
+        leases.releaseall()
+        self.assertEqual(self.renewers(), [])
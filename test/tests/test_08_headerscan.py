@@ -0,0 +1,59 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+
+from offlineimap import headerscan
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestHeaderScan(unittest.TestCase):
+    """Test the header scanner of :mod:`offlineimap.headerscan`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+
+    def test_01_headerscan(self):
+        """Test headerscan.headerend(), getheaders() and getheaderall()"""
+        self.assertEqual(headerscan.headerend('A: 1\r\nB: 2\r\n\r\nbody'), 12)
+        self.assertEqual(headerscan.headerend('A: 1\nB: 2\n\nbody'), 10)
+        self.assertEqual(headerscan.headerend('A: 1\nB: 2\n'), 10)
+        self.assertEqual(headerscan.headerend('\r\nA: 1\r\n\r\n'), 0)
+        self.assertEqual(headerscan.headerend('\nA: 1\n\n'), 0)
+        # folded values are unfolded, names are case insensitive
+        content = 'To: a@b,\r\n\tc@d\r\nX-Tag: 1\r\nx-tag:  2 \r\n\r\nX-Tag: 3'
+        self.assertEqual(headerscan.getheaders(content, ['to', 'X-TAG', 'Cc']),
+                         {'to': 'a@b,\tc@d', 'X-TAG': '1'})
+        self.assertEqual(headerscan.getheaderall(content, 'X-Tag'), ['1', '2'])
+        self.assertEqual(headerscan.getheaderall('\nX-Tag: 1\n', 'X-Tag'), [])
+        self.assertEqual(headerscan.headerdigest('A: 1\r\n\r\nbody'),
+                         headerscan.headerdigest('A: 1\n\nother body'))
@@ -0,0 +1,60 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+
+from offlineimap import msgtransform
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestMsgTransform(unittest.TestCase):
+    """Test the message transformations of :mod:`offlineimap.msgtransform`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+
+    def test_01_addheader(self):
+        """Test msgtransform.addheader()"""
+        res = msgtransform.addheader('A: 1\r\n\r\nbody', 'X', 'y')
+        self.assertEqual(res, 'A: 1\r\nX: y\r\n\r\nbody')
+        res = msgtransform.addheader('A: 1\n\nbody\r\n', 'X', 'y')
+        self.assertEqual(res, 'A: 1\nX: y\n\nbody\r\n')
+        # no body
+        res = msgtransform.addheader('A: 1\r\n', 'X', 'y')
+        self.assertEqual(res, 'A: 1\r\nX: y\r\n')
+        res = msgtransform.addheader('A: 1', 'X', 'y')
+        self.assertEqual(res, 'X: y\r\nA: 1')
+        # no headers at all, just a body
+        res = msgtransform.addheader('\r\nbody', 'X', 'y')
+        self.assertEqual(res, 'X: y\r\n\r\nbody')
+        res = msgtransform.addheader('\nbody', 'X', 'y')
+        self.assertEqual(res, 'X: y\n\nbody')
@@ -0,0 +1,275 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import unittest
+import logging
+
+from offlineimap import imapserver
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class FakeRepos(object):
+    """Repository whose getX() methods return the keyword argument X
+    it was created with, or None"""
+    def __init__(self, **values):
+        self.values = values
+    def getconfig(self): return None
+    def getmaxconnections(self): return 4
+    def __getattr__(self, name):
+        return lambda: self.values.get(name[3:].lstrip('_'))
+
+class FakeIMAP4(object):
+    """Connection that was greeted with `capabilities`"""
+    def __init__(self, capabilities):
+        self.capabilities = tuple(capabilities.split())
+    def capability(self):
+        return 'OK', [' '.join(self.capabilities + ('ASKED',))]
+
+class TestIMAPServer(unittest.TestCase):
+    """Test the connection handling of :mod:`offlineimap.imapserver`
+    without an IMAP server"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+
+    def test_01_acquireconnection_affinity(self):
+        """Test the connection preference of IMAPServer.acquireconnection()"""
+        class FakeConnection(object):
+            Terminate = False
+            def __init__(self, folder, readonly):
+                self.folder, self.is_readonly = folder, readonly
+            def getselectedfolder(self): return self.folder
+        server = imapserver.IMAPServer(FakeRepos())
+        server.delim = '.' # known from opening the connections
+        conns = [FakeConnection('A', False), FakeConnection('B', False),
+                 FakeConnection('B', True), FakeConnection(None, False)]
+        for conn, owner in zip(conns, [0, 0, 0, imapserver.currentThread().ident]):
+            server.availableconnections.append(conn)
+            server.lastowner[conn] = owner
+        # without a SELECTed match, the one this thread used last
+        imapobj = server.acquireconnection(folder='C')
+        self.assertIs(imapobj, conns[3])
+        server.releaseconnection(imapobj)
+        # but a match of folder and mode comes first
+        imapobj = server.acquireconnection(folder='B', readonly=True)
+        self.assertIs(imapobj, conns[2])
+        server.releaseconnection(imapobj)
+        imapobj = server.acquireconnection(folder='B')
+        self.assertIs(imapobj, conns[1])
+        server.releaseconnection(imapobj)
+        self.assertEqual(server.getselecthitrate(), 2.0 / 3)
+
+    def test_02_serverinfo(self):
+        """Test the server info cache of IMAPServer.setcapabilities(),
+        getserverinfo() and updateserverinfo()"""
+        path = os.path.join(OLITestLib.testdir, 'serverinfo')
+        repos = FakeRepos(serverinfofile=path, host='imap.example.com',
+                          user='a', reference='')
+        server = imapserver.IMAPServer(repos)
+        preauth = 'IMAP4rev1 AUTH=PLAIN'
+        self.assertEqual(server.getserverinfo(preauth), {})
+        # the capabilities of the login response get cached
+        imapobj = FakeIMAP4(preauth)
+        server.setcapabilities(imapobj, preauth,
+                               ['[CAPABILITY IMAP4rev1 Idle] Logged in'])
+        self.assertEqual(imapobj.capabilities, ('IMAP4REV1', 'IDLE'))
+        server.updateserverinfo(preauth, delim='/', root='')
+        # and used by the next process
+        server = imapserver.IMAPServer(repos)
+        info = server.getserverinfo(preauth)
+        self.assertEqual((info['capabilities'], info['delim'], info['root']),
+                         ('IMAP4REV1 IDLE', '/', ''))
+        imapobj = FakeIMAP4(preauth)
+        server.setcapabilities(imapobj, preauth, [None])
+        self.assertEqual(imapobj.capabilities, ('IMAP4REV1', 'IDLE'))
+        # it's not valid for other servers or accounts
+        other = imapserver.IMAPServer(FakeRepos(serverinfofile=path,
+            host='imap.example.com', user='b', reference=''))
+        self.assertEqual(other.getserverinfo(preauth), {})
+        # or if the server changed
+        changed = preauth + ' STARTTLS'
+        self.assertEqual(server.getserverinfo(changed), {})
+        imapobj = FakeIMAP4(changed)
+        server.setcapabilities(imapobj, changed, [None])
+        self.assertEqual(imapobj.capabilities,
+                         ('IMAP4REV1', 'AUTH=PLAIN', 'STARTTLS', 'ASKED'))
+        server = imapserver.IMAPServer(repos)
+        self.assertEqual(server.getserverinfo(preauth), {})
+        info = server.getserverinfo(changed)
+        self.assertEqual(info['capabilities'],
+                         'IMAP4REV1 AUTH=PLAIN STARTTLS ASKED')
+        self.assertFalse('delim' in info)
+        # nothing is cached if it's disabled
+        os.unlink(path)
+        server = imapserver.IMAPServer(FakeRepos(host='imap.example.com',
+                                                 user='a', reference=''))
+        server.setcapabilities(FakeIMAP4(preauth), preauth,
+                               ['[CAPABILITY IMAP4rev1] Logged in'])
+        self.assertEqual(server.getserverinfo(preauth), {})
+        self.assertFalse(os.path.exists(path))
+
+    def test_03_connectionpool(self):
+        """Test the sharing and host limit of imapserver.ConnectionPool"""
+        class FakeConnection(object):
+            loggedout = False
+            def logout(self): self.loggedout = True
+        pool = imapserver.getconnectionpool(('test_12', 'a'), 'test_12', 2)
+        self.assertIs(imapserver.getconnectionpool(('test_12', 'a'),
+                                                   'test_12', 0), pool)
+        other = imapserver.getconnectionpool(('test_12', 'b'), 'test_12', 3)
+        hostlimit = pool.hostlimit
+        self.assertIs(other.hostlimit, hostlimit)
+        self.assertEqual(hostlimit.limit, 2)
+        self.assertTrue(hostlimit.acquire(pool))
+        self.assertTrue(hostlimit.acquire(other))
+        self.assertFalse(hostlimit.acquire(pool, wait=False))
+        # at the limit, an idle connection of the other pool is closed
+        idle = FakeConnection()
+        other.available.append(idle)
+        other.lastowner[idle] = None
+        self.assertTrue(hostlimit.acquire(pool))
+        self.assertTrue(idle.loggedout)
+        self.assertEqual((other.available, other.lastowner), ([], {}))
+        self.assertEqual(hostlimit.count, 2)
+
+    def test_04_poolkey(self):
+        """Test that only connections set up the same way are shared"""
+        values = dict(host='imap.example.com', user='a', ssl=True,
+                      sslcacertfile='/etc/ssl/certs/ca-certificates.crt')
+        server = imapserver.IMAPServer(FakeRepos(**values))
+        self.assertIs(imapserver.IMAPServer(FakeRepos(**values)).pool,
+                      server.pool)
+        for name, value in (('user', 'b'), ('sslcacertfile', None),
+                            ('sslcacertfile', '/etc/ssl/other.crt'),
+                            ('ssl_fingerprint', 'ab' * 20),
+                            ('sslclientkey', '/home/a/.key')):
+            other = dict(values)
+            other[name] = value
+            other = imapserver.IMAPServer(FakeRepos(**other))
+            self.assertFalse(other.pool is server.pool, name)
+            # but the host limit is the same
+            self.assertIs(other.pool.hostlimit, server.pool.hostlimit)
+
+    def test_05_maintainconnections(self):
+        """Test that IMAPServer.maintainconnections() replaces broken
+        connections, but not expired ones"""
+        class FakeConnection(object):
+            identifier = 'test_05'
+            def __init__(self, broken):
+                self.broken, self.loggedout = broken, False
+            def noop(self):
+                if self.broken:
+                    raise IOError('connection reset')
+            def logout(self): self.loggedout = True
+        server = imapserver.IMAPServer(FakeRepos(host='test_05',
+                                                 connectionttl=60))
+        reopened = []
+        server.prewarmconnection = lambda: reopened.append(True)
+        now = imapserver.time.time()
+        conns = [FakeConnection(False), FakeConnection(True),
+                 FakeConnection(False)]
+        for conn, idlesince in zip(conns, (now, now, now - 120)):
+            server.pool.hostlimit.acquire(server.pool)
+            server.availableconnections.append(conn)
+            server.pool.idlesince[conn] = idlesince
+        self.assertEqual(server.maintainconnections(3), 2)
+        self.assertEqual(server.availableconnections, conns[:1])
+        self.assertEqual([c.loggedout for c in conns], [False, True, True])
+        self.assertEqual(len(reopened), 1)
+
+    def test_06_getidlers(self):
+        """Test that NOTIFY is only used together with IDLE"""
+        class FakeConnection(object):
+            Terminate = is_readonly = False
+            def __init__(self, capabilities):
+                self.capabilities = capabilities
+            def getselectedfolder(self): return None
+        server = imapserver.IMAPServer(FakeRepos(host='test_06',
+            idlefolders=['INBOX', 'Lists'], idlesubscribed=True))
+        server.delim = '.' # known from opening the connections
+        for capabilities, types in (
+                (('IMAP4REV1', 'NOTIFY', 'IDLE'), [imapserver.NotifyThread]),
+                (('IMAP4REV1', 'NOTIFY'), [imapserver.IdleThread] * 2),
+                (('IMAP4REV1', 'IDLE'), [imapserver.IdleThread] * 2)):
+            server.availableconnections.append(FakeConnection(capabilities))
+            idlers = server.getidlers(60)
+            self.assertEqual([type(idler) for idler in idlers], types)
+            if types == [imapserver.IdleThread] * 2:
+                self.assertEqual([idler.folder for idler in idlers],
+                                 ['INBOX', 'Lists'])
+            del server.availableconnections[:]
+
+    def test_07_autotuner(self):
+        """Test the AIMD limits of imapserver.Autotuner"""
+        tuner = imapserver.Autotuner('R', (1, 4), (10, 50))
+        window = imapserver.Autotuner.WINDOW
+        tuner.waited = True
+        for i in range(window):
+            tuner.sample(0.1, 1000)
+        self.assertEqual((tuner.connections, tuner.batchsize), (2, 20))
+        # not limited by the connections, only the batch size grows
+        tuner.throughput = None # don't depend on the timing
+        for i in range(window):
+            tuner.sample(0.1, 1000)
+        self.assertEqual((tuner.connections, tuner.batchsize), (2, 30))
+        tuner.waited = True
+        for i in range(window):
+            tuner.sample(1.0, 1000)
+        self.assertEqual((tuner.connections, tuner.batchsize), (1, 15))
+        tuner.connections, tuner.batchsize = 4, 50
+        tuner.failure()
+        self.assertEqual((tuner.connections, tuner.batchsize), (2, 25))
+
+    def test_08_throttling(self):
+        """Test the detection of throttling and imapserver.Backoff"""
+        import time
+        from offlineimap import imaplibutil
+        self.assertEqual(imaplibutil.throttlecode(
+            ['[THROTTLED] Too many commands']), 'THROTTLED')
+        self.assertEqual(imaplibutil.throttlecode(
+            '[unavailable] try again later'), 'UNAVAILABLE')
+        self.assertEqual(imaplibutil.throttlecode(['[NONEXISTENT]']), None)
+        backoff = imapserver.Backoff('host')
+        backoff.throttled('LIMIT')
+        first = backoff.until
+        # the pause is not extended while it lasts
+        backoff.throttled('LIMIT')
+        self.assertEqual(backoff.until, first)
+        self.assertTrue(backoff.BASE / 2.0 <= first - time.time() <=
+                        backoff.BASE)
+        backoff.until = 0
+        backoff.throttled('LIMIT')
+        self.assertTrue(backoff.BASE <= backoff.until - time.time() <=
+                        2 * backoff.BASE)
+        backoff.until = 0
+        backoff.succeeded()
+        self.assertEqual(backoff.failures, 0)
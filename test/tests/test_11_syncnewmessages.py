@@ -0,0 +1,209 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+
+from offlineimap import accounts, threadutil
+from offlineimap.error import OfflineImapError
+from offlineimap.folder.IMAP import IMAPFolder
+from offlineimap.repository.IMAP import IMAPRepository
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+MESSAGE = 'Message-ID: <%d@example.com>\r\nSubject: A\r\n\r\nbody\r\n'
+FOLDER = 'INBOX.OLItest'
+
+def uidset(sequence):
+    """Return the UIDs of an IMAP sequence set like '1:3,7'"""
+    uids = set()
+    for part in sequence.split(','):
+        first, sep, last = part.partition(':')
+        uids.update(range(int(first), int(last or first) + 1))
+    return uids
+
+class FakeIMAP4(object):
+    """Connection to a server with the messages {uid: content} in FOLDER
+
+    It records the UID commands it gets."""
+    Terminate = is_readonly = False
+    capabilities = ('IMAP4REV1',)
+    class abort(Exception): pass
+    class readonly(Exception): pass
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.commands = []
+        self.searchfails = False
+
+    def getselectedfolder(self): return FOLDER
+
+    def select(self, mailbox=FOLDER, readonly=False, force=False):
+        return 'OK', [str(len(self.messages))]
+
+    def response(self, code):
+        return 'OK', ['1']
+
+    def uid(self, command, *args):
+        self.commands.append((command,) + args)
+        if command == 'search':
+            if self.searchfails:
+                return 'NO', ['search failed']
+            found = sorted(uidset(args[1]).intersection(self.messages))
+            return 'OK', [' '.join(str(uid) for uid in found)]
+        if args[1] == '(FLAGS UID)':
+            first = int(args[0].strip("'").split(':')[0])
+            uids = sorted(self.messages)
+            return 'OK', ['%d (FLAGS (\\Seen) UID %d)' % (num + 1, uid)
+                          for num, uid in enumerate(uids)
+                          if uid >= first or uid == uids[-1]]
+        uid = int(args[0])
+        if uid not in self.messages:
+            return 'OK', [None]
+        content = self.messages[uid]
+        return 'OK', [('1 (UID %d BODY[] {%d}' % (uid, len(content)),
+                       content), ')']
+
+class FakeIMAPServer(object):
+    """IMAPServer handing out a single connection"""
+    delim = '.'
+    def __init__(self, imapobj):
+        self.imapobj = imapobj
+    def acquireconnection(self, folder=None, readonly=False):
+        return self.imapobj
+    def releaseconnection(self, imapobj, drop_conn=False):
+        pass
+    def connectionwait(self):
+        pass
+
+class TestSyncNewMessages(unittest.TestCase):
+    """Test the IDLE fast path :func:`offlineimap.accounts.syncnewmessages`
+    and :meth:`offlineimap.folder.IMAP.IMAPFolder.getexcludeduids`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        config.set("Repository IMAP", "remotehost", "imap.example.com")
+        config.set("Repository IMAP", "remoteuser", "test")
+        setglobalui(UI_LIST['quiet'](config))
+        cls.config = config
+        cls.account = OLITestLib.get_maildir_account(config)
+        cls.account.remoterepos = IMAPRepository('IMAP', cls.account)
+        cls.account.localrepos.makefolder(FOLDER)
+        threadutil.initInstanceLimit('MSGCOPY_IMAP', 1)
+
+    def setUp(self):
+        account = self.account
+        self.imapobj = FakeIMAP4({})
+        account.remoterepos.imapserver = FakeIMAPServer(self.imapobj)
+        self.remote = IMAPFolder(account.remoterepos.imapserver, FOLDER,
+                                 account.remoterepos)
+
+    def folders(self):
+        """Return fresh instances of the local and status folder"""
+        account = self.account
+        account.localrepos.forgetfolders()
+        account.statusrepos.forgetfolders()
+        local = account.localrepos.getfolder(FOLDER)
+        local.cachemessagelist()
+        status = account.statusrepos.getfolder(FOLDER)
+        status.cachemessagelist()
+        return local, status
+
+    def serve(self, *uids):
+        """Let the server have messages `uids`"""
+        self.imapobj.messages.clear()
+        for uid in uids:
+            self.imapobj.messages[uid] = MESSAGE % uid
+
+    def fetched(self):
+        """Return the UIDs of the messages downloaded so far"""
+        return sorted(int(args[1]) for args in self.imapobj.commands
+                      if args[0] == 'fetch' and args[2] == '(BODY.PEEK[])')
+
+    def test_01_unsynced(self):
+        """Test that a folder that was never synced needs a full sync"""
+        self.serve(1, 2)
+        self.assertFalse(accounts.syncnewmessages(self.account, self.remote))
+        self.assertEqual(self.imapobj.commands, [])
+        # so do the ones maxage restricts
+        local, status = self.folders()
+        status.savemessage(1, None, set('S'), 0)
+        self.config.set("Account test", "maxage", "30")
+        try:
+            self.assertFalse(accounts.syncnewmessages(self.account,
+                                                      self.remote))
+        finally:
+            self.config.remove_option("Account test", "maxage")
+        status.deletemessage(1)
+
+    def test_02_new(self):
+        """Test that only the new messages are fetched"""
+        local, status = self.folders()
+        for uid in (1, 2, 3):
+            local.savemessage(uid, MESSAGE % uid, set('S'), None)
+            status.savemessage(uid, None, set('S'), 0)
+        self.serve(1, 2, 3, 4, 5)
+        self.assertTrue(accounts.syncnewmessages(self.account, self.remote))
+        self.assertEqual(self.fetched(), [4, 5])
+        self.assertEqual([args[0] for args in self.imapobj.commands],
+                         ['fetch'] * 3)
+        local, status = self.folders()
+        self.assertEqual(sorted(local.getmessageuidlist()), range(1, 6))
+        self.assertEqual(sorted(status.getmessageuidlist()), range(1, 6))
+
+    def test_03_expunged(self):
+        """Test that expunged messages are deleted, and only those"""
+        self.serve(1, 3, 4, 5, 6)
+        self.assertTrue(accounts.syncnewmessages(self.account, self.remote))
+        self.assertEqual(self.fetched(), [6])
+        searches = [args for args in self.imapobj.commands
+                    if args[0] == 'search']
+        self.assertEqual(searches, [('search', 'UID', '1:5')])
+        local, status = self.folders()
+        self.assertEqual(sorted(local.getmessageuidlist()), [1, 3, 4, 5, 6])
+        self.assertEqual(sorted(status.getmessageuidlist()), [1, 3, 4, 5, 6])
+
+    def test_04_getexcludeduids(self):
+        """Test asking the server which UIDs outside the message list
+        still exist"""
+        remote = self.remote
+        self.serve(1, 3, 7)
+        self.assertEqual(remote.cachenewmessages(7), 3)
+        self.assertEqual(remote.getmessageuidlist(), [7])
+        self.assertEqual(remote.getexcludeduids([-1, 1, 2, 3]), set([1, 3]))
+        # the answers are kept
+        self.assertEqual(remote.getexcludeduids([2, 3, 4]), set([3]))
+        self.assertEqual([args[2] for args in self.imapobj.commands
+                          if args[0] == 'search'], ['1:3', '4'])
+        self.imapobj.searchfails = True
+        self.assertRaises(OfflineImapError, remote.getexcludeduids, [5])
+        # nothing is left out of a complete message list
+        remote.messagelistpartial = False
+        self.assertEqual(remote.getexcludeduids([1, 3]), set())
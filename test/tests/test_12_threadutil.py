@@ -0,0 +1,64 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+
+from offlineimap import threadutil
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestThreadUtil(unittest.TestCase):
+    """Test the thread helpers of :mod:`offlineimap.threadutil`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+
+    def test_01_prioritylane(self):
+        """Test that bulk work waits for priority work of other threads"""
+        import threading
+        lane = threadutil.PriorityLane()
+        lane.wait() # nobody in the lane
+        lane.enter()
+        lane.enter()
+        lane.wait() # our own priority work does not block us
+        waited = threading.Event()
+        def bulk():
+            lane.wait()
+            waited.set()
+        thread = threading.Thread(target=bulk)
+        thread.start()
+        self.assertFalse(waited.wait(0.1))
+        lane.leave()
+        self.assertFalse(waited.wait(0.1))
+        lane.leave()
+        self.assertTrue(waited.wait(5))
+        thread.join()
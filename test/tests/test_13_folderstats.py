@@ -0,0 +1,74 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+
+from offlineimap import folderstats
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestFolderStats(unittest.TestCase):
+    """Test the folder scheduling of :mod:`offlineimap.folderstats`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+
+    def test_01_folderstats(self):
+        """Test the folder scheduling of folderstats.FolderStats"""
+        import os, tempfile, time
+        class FakeFolder(object):
+            def __init__(self, name): self.name = name
+            def getvisiblename(self): return self.name
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            refresh = lambda name: 24 * 60 if name == 'Archive' else None
+            stats = folderstats.FolderStats(path, refresh)
+            now = time.time()
+            for hours in (48, 24, 0):
+                start = now - hours * 3600 - 10
+                stats.record('INBOX', start, True)
+                stats.record('Archive', start, False)
+                stats.record('Lists', start, hours == 24)
+            stats.save()
+            stats = folderstats.FolderStats(path, refresh)
+            self.assertEqual(stats.likelihood('New'), 1.0)
+            self.assertEqual(stats.likelihood('Archive'), 0.0)
+            self.assertTrue(0 < stats.likelihood('Lists') <
+                            stats.likelihood('INBOX') < 1)
+            folders = [FakeFolder(name) for name in
+                       ('Archive', 'Lists', 'INBOX', 'New')]
+            # Archive is not due yet
+            self.assertEqual([f.name for f in stats.schedule(folders)],
+                             ['New', 'INBOX', 'Lists'])
+        finally:
+            os.unlink(path)
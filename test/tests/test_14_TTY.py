@@ -0,0 +1,63 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import threading
+import time
+import unittest
+import logging
+
+from offlineimap import accounts
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestTTYUI(unittest.TestCase):
+    """Test the default UI :class:`offlineimap.ui.TTY.TTYUI`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        config.set("general", "dry-run", "False")
+        cls.ui = UI_LIST['ttyui'](config)
+        setglobalui(cls.ui)
+        cls.account = accounts.Account(config, 'test')
+
+    def test_01_wake(self):
+        """Test that waking an account ends its sleep right away"""
+        waker = threading.Timer(0.2, self.account.wake)
+        waker.start()
+        start = time.time()
+        self.assertTrue(self.ui.sleep(60, self.account))
+        self.assertTrue(time.time() - start < 5)
+        waker.join()
+
+    def test_02_timeout(self):
+        """Test that an account sleeps for as long as it's told to"""
+        start = time.time()
+        self.assertFalse(self.ui.sleep(1, self.account))
+        self.assertTrue(time.time() - start >= 0.9)
@@ -0,0 +1,154 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import os
+import socket
+import stat
+import unittest
+import logging
+
+from offlineimap import controlsocket
+from offlineimap.error import OfflineImapError
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class FakeAccount(object):
+    """Account that records what it was told to do"""
+    def __init__(self, name):
+        self.name = name
+        self.paused = False
+        self.progress = controlsocket.SyncProgress()
+        self.calls = []
+    def wake(self):
+        self.calls.append('wake')
+    def requestfolder(self, foldername):
+        self.calls.append(foldername)
+    def pause(self):
+        self.paused = True
+    def resume(self):
+        self.paused = False
+
+class TestControlSocket(unittest.TestCase):
+    """Test the protocol of :class:`offlineimap.controlsocket.ControlServer`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+        cls.path = os.path.join(OLITestLib.testdir, 'control')
+
+    def setUp(self):
+        self.accounts = {'a': FakeAccount('a'), 'b': FakeAccount('b')}
+        controlsocket.accounts.clear()
+        controlsocket.accounts.update(self.accounts)
+        self.server = controlsocket.ControlServer(self.path)
+        self.server.start()
+        self.client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.client.connect(self.path)
+        self.replies = self.client.makefile('r')
+
+    def tearDown(self):
+        self.replies.close()
+        self.client.close()
+        self.server.close()
+        controlsocket.accounts.clear()
+
+    def command(self, line):
+        """Send command `line`, return the lines of the reply"""
+        self.client.sendall(line + '\n')
+        lines = []
+        while True:
+            lines.append(self.replies.readline().rstrip('\n'))
+            if not lines[-1].startswith('* '):
+                return lines
+
+    def test_01_sync(self):
+        """Test requesting the sync of an account and of a folder"""
+        self.assertEqual(self.command('sync-account a'),
+                         ['OK sync of a requested'])
+        self.assertEqual(self.command('SYNC-FOLDER b "Sent Items"'),
+                         ['OK sync of Sent Items in b requested'])
+        self.assertEqual(self.accounts['a'].calls, ['wake'])
+        self.assertEqual(self.accounts['b'].calls, ['Sent Items'])
+
+    def test_02_pause(self):
+        """Test pausing and resuming one or all accounts, and status"""
+        self.assertEqual(self.command('pause a'), ['OK paused'])
+        self.assertEqual([self.accounts[name].paused for name in 'ab'],
+                         [True, False])
+        status = self.command('status')
+        self.assertEqual(len(status), 3)
+        self.assertTrue(status[0].startswith('* a state=starting '))
+        self.assertTrue(status[0].endswith(' paused'))
+        self.assertTrue(status[1].startswith('* b state=starting '))
+        self.assertFalse(status[1].endswith(' paused'))
+        self.assertEqual(status[2], 'OK status done')
+        self.assertEqual(self.command('pause'), ['OK paused'])
+        self.assertEqual(self.command('resume b'), ['OK resumed'])
+        self.assertEqual([self.accounts[name].paused for name in 'ab'],
+                         [True, False])
+        self.assertEqual(self.command('resume'), ['OK resumed'])
+        self.assertEqual([self.accounts[name].paused for name in 'ab'],
+                         [False, False])
+        self.accounts['b'].progress.setstate('syncing')
+        status = self.command('status b')
+        self.assertEqual(len(status), 2)
+        self.assertTrue(status[0].startswith('* b state=syncing '))
+
+    def test_03_bad_input(self):
+        """Test the replies to invalid commands"""
+        self.assertEqual(self.command('resync a'),
+                         ['NO unknown command resync'])
+        self.assertEqual(self.command('sync-account'),
+                         ['NO wrong number of arguments to sync-account'])
+        self.assertEqual(self.command('status a b'),
+                         ['NO wrong number of arguments to status'])
+        self.assertEqual(self.command('sync-account c'),
+                         ["NO unknown account 'c'"])
+        self.assertTrue(self.command('sync-folder a "Sent')[0].
+                        startswith('NO '))
+        # empty lines are ignored, the connection is still usable
+        self.assertEqual(self.command('\nsync-account a'),
+                         ['OK sync of a requested'])
+
+    def test_04_socket(self):
+        """Test that only we may use the socket, and that a live one is
+        not taken over while a stale one is"""
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o600)
+        self.assertRaises(OfflineImapError,
+                          controlsocket.ControlServer, self.path)
+        self.assertEqual(self.command('sync-account a'),
+                         ['OK sync of a requested'])
+        # left behind by a crashed instance
+        stale = os.path.join(OLITestLib.testdir, 'stale')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(stale)
+        sock.close()
+        controlsocket.ControlServer(stale).close()
+        self.assertFalse(os.path.exists(stale))
@@ -0,0 +1,84 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+
+from offlineimap import eventloop
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestEventLoop(unittest.TestCase):
+    """Test reading IMAP responses in :mod:`offlineimap.eventloop`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+
+    def test_01_eventloop(self):
+        """Test reading responses with eventloop.EventLoop"""
+        import os, threading
+        class FakeIMAP4(object):
+            TerminateReader = Terminate = False
+            idle_rqb = resp_timeout = decompressor = None
+            read_size = 4096
+            def __init__(self):
+                self.read_fd, self.write_fd = os.pipe()
+                self.lines = []
+                self.done = threading.Event()
+            def read_into(self, buf):
+                data = os.read(self.read_fd, len(buf))
+                buf[:len(data)] = data
+                return len(data)
+            def _put_response(self, line):
+                self.lines.append(line)
+                if line.startswith('A1 '):
+                    self.done.set()
+            def _abort_commands(self, typ, val):
+                self.done.set()
+            def _log(self, level, msg):
+                pass
+        loop = eventloop.EventLoop()
+        imapobjs = [FakeIMAP4(), FakeIMAP4()]
+        for imapobj in imapobjs:
+            loop.register(imapobj)
+        for data in ('* 1 FETCH (BODY[] {5}\r\nab', 'c\r\n)\r\nA1 O',
+                     'K done\r\n'):
+            for imapobj in imapobjs:
+                os.write(imapobj.write_fd, data)
+        for imapobj in imapobjs:
+            self.assertTrue(imapobj.done.wait(5))
+            self.assertEqual(imapobj.lines, ['* 1 FETCH (BODY[] {5}\r\n',
+                                             'abc\r\n', ')\r\n',
+                                             'A1 OK done\r\n'])
+            loop.unregister(imapobj)
+            os.close(imapobj.read_fd)
+            os.close(imapobj.write_fd)
+        self.assertEqual(loop.readers, {})
@@ -0,0 +1,67 @@
+# Copyright (C) 2012- Sebastian Spaeth & contributors
+#
+#    This program is free software; you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation; either version 2 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, write to the Free Software
+#    Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+import unittest
+import logging
+
+from offlineimap.imaplib2 import ReadBuffer
+from offlineimap.ui import UI_LIST, setglobalui
+
+from test.OLItest import OLITestLib
+
+# Things need to be setup first, usually setup.py initializes everything.
+# but if e.g. called from command line, we take care of default values here:
+if not OLITestLib.cred_file:
+    OLITestLib(cred_file='./test/credentials.conf', cmd='./offlineimap.py')
+
+def setUpModule():
+    logging.info("Set Up test module %s" % __name__)
+    tdir = OLITestLib.create_test_dir(suffix=__name__)
+
+def tearDownModule():
+    logging.info("Tear Down test module")
+    OLITestLib.delete_test_dir()
+
+class TestReadBuffer(unittest.TestCase):
+    """Test splitting IMAP responses with
+    :class:`offlineimap.imaplib2.ReadBuffer`"""
+
+    @classmethod
+    def setUpClass(cls):
+        config = OLITestLib.get_default_config()
+        setglobalui(UI_LIST['quiet'](config))
+
+    def test_01_readbuffer(self):
+        """Test splitting responses with imaplib2.ReadBuffer"""
+        class FakeIMAP4(object):
+            def __init__(self, data):
+                self.data = data
+            def read_into(self, buf):
+                data, self.data = self.data[:len(buf)], self.data[len(buf):]
+                buf[:len(data)] = data
+                return len(data)
+        body = 'x' * 1000 + '\r\n'
+        responses = ['* 1 FETCH (BODY[] {%d}\r\n' % len(body), body,
+                     ' BODY[HEADER] {3}\r\n', 'a\r\n', ')\r\n',
+                     '* 2 FETCH (BODY[] {0}\r\n', ')\r\n',
+                     'A1 OK {5}\r\n', '* OK ' + 'y' * 200 + '\r\n']
+        # one byte at a time as when starting TLS, and in large reads
+        for size in (1, 4096):
+            imapobj = FakeIMAP4(''.join(responses))
+            readbuf = ReadBuffer(imapobj, 64)
+            result = []
+            while readbuf.read(size):
+                result.extend(readbuf.responses())
+            self.assertEqual(result, responses)